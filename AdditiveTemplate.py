@@ -0,0 +1,149 @@
+from bisect import bisect_right
+from dataclasses import dataclass, replace
+import math
+import mmap
+import operator
+from pathlib import Path
+import re
+from typing import Optional, Union
+from .GcodeMerger import SpliceSegment, map_file, write_splice_plan
+
+
+@dataclass(frozen=True)
+class AdditiveOptions:
+    '''The options of the additive post processor that only change the blocks written between template markers'''
+    useImaging: bool = True
+    laserScanning: bool = False
+    collectLoadCellData: bool = False
+    dryingTime: int = 0
+    adaptiveDrying: bool = False  # dryingTime is the minimum time of a layer, including printing it
+    finishing: bool = False
+    defectCorrection: bool = False
+    firstCorrectionLayer: int = 2
+
+
+@dataclass
+class TemplateVariant:
+    '''A variant of an option-dependent block, between ;TEMPLATE_BEGIN and ;TEMPLATE_END markers'''
+    name: str
+    conditions: list[tuple[str, str, int]]  # option, operator and value, e.g. ("dryingTime", ">", 0)
+    start: int  # byte offset of the begin marker
+    content: range  # byte range of the G-code of the variant
+    end: int  # byte offset after the end marker
+
+
+class AdditiveTemplate:
+    '''Additive G-code posted once with template markers (the templateMarkers property of the additive post processor),
+    with every variant of the blocks that depend on the options, e.g. imaging, drying and defect correction, tagged with
+    the options it is written for. Any number of option variants can then be rendered from it without running the post
+    processor again, by keeping the variants of the options and removing the others and the markers.
+    Only the drying time is set here, as the post processor cannot write a variant for each drying time.
+    With adaptive drying, each layer only dries for as long as it takes to reach the minimum layer time, estimated by
+    GcodeAnalyzer like the print time of the layers, so that small layers dry long enough and large layers are not
+    held up. Without NumPy, every layer dries for the minimum layer time.'''
+
+    MARKER_PATTERN = re.compile(rb"^;TEMPLATE_(?P<kind>BEGIN|END) (?P<name>[A-Z_]+)(?P<conditions>[^\r\n]*)(?:\r?\n)?",
+                                re.MULTILINE)
+    CONDITION_PATTERN = re.compile(r"(?P<option>\w+)(?P<operator>>=|<=|=|<|>)(?P<value>-?\d+)")
+    DRYING_TIME_PATTERN = re.compile(rb"(?<=#620=)\d+|(?<=;DT: )\d+")
+    OPERATORS = {"=": operator.eq, "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+
+    def __init__(self, template_file: Path, rapid_feed: float = 3000, max_workers: Optional[int] = None) -> None:
+        self.template_file = template_file
+        self.rapid_feed = rapid_feed  # mm/min, to estimate the print time of the layers
+        self.max_workers = max_workers
+
+    def render(self, options: AdditiveOptions, output_file: Path):
+        '''Write the additive G-code for the options to the output file'''
+        with open(self.template_file, 'rb') as template, map_file(template) as source, \
+                open(output_file, 'wb', buffering=0) as outfile:
+            blocks = self._find_blocks(source)
+            layer_times = self._estimate_layer_times(blocks) if options.adaptiveDrying else None
+            write_splice_plan(template, source, self._create_splice_plan(blocks, source, options, layer_times), outfile)
+
+    def _find_blocks(self, source: Union[mmap.mmap, bytes]) -> list[list[TemplateVariant]]:
+        '''Returns the variants of each block, which are written one after the other'''
+        blocks: list[list[TemplateVariant]] = []
+        begin = None
+        for marker in self.MARKER_PATTERN.finditer(source):
+            name = marker.group('name').decode()
+            if marker.group('kind') == b"BEGIN":
+                if begin is not None:
+                    raise ValueError(f"Template marker {begin.group().decode().strip()} is not ended")
+                begin = marker
+                continue
+            if begin is None or begin.group('name').decode() != name:
+                raise ValueError(f"Template marker {marker.group().decode().strip()} is not begun")
+            variant = TemplateVariant(name, self._parse_conditions(begin.group('conditions').decode()), begin.start(),
+                                      range(begin.end(), marker.start()), marker.end())
+            if blocks and blocks[-1][-1].end == variant.start and blocks[-1][-1].name == name:
+                blocks[-1].append(variant)
+            else:
+                blocks.append([variant])
+            begin = None
+        if begin is not None:
+            raise ValueError(f"Template marker {begin.group().decode().strip()} is not ended")
+        return blocks
+
+    def _parse_conditions(self, conditions: str) -> list[tuple[str, str, int]]:
+        parsed_conditions = []
+        for condition in conditions.split():
+            match = self.CONDITION_PATTERN.fullmatch(condition)
+            if match is None or match.group('option') not in AdditiveOptions.__dataclass_fields__:
+                raise ValueError(f"Invalid template condition {condition}")
+            parsed_conditions.append((match.group('option'), match.group('operator'), int(match.group('value'))))
+        return parsed_conditions
+
+    def _estimate_layer_times(self, blocks: list[list[TemplateVariant]]) -> Optional[list[float]]:
+        '''Returns the estimated print time in seconds of the layer ending at each drying and photo block, or None
+        without NumPy. The drying after a layer is written at the start of the next layer, except for the last layer,
+        where it is written at the end of the program.'''
+        try:
+            from .GcodeAnalyzer import GcodeAnalyzer
+        except ImportError:  # NumPy is not bundled with Fusion's Python
+            return None
+        layers = GcodeAnalyzer(self.rapid_feed, self.max_workers).analyze(self.template_file).layers
+        layer_starts = [layer.start for layer in layers]
+        layer_times = []
+        last_position = None
+        for block in blocks:
+            if block[0].name != "DRY_PHOTO":
+                continue
+            position = bisect_right(layer_starts, block[0].start) - 1
+            layer_position = position - 1 if position > 0 and position != last_position else position
+            layer_times.append(layers[layer_position].print_time if layer_position >= 0 else 0.0)
+            last_position = position
+        return layer_times
+
+    def _create_splice_plan(self, blocks: list[list[TemplateVariant]], source: Union[mmap.mmap, bytes],
+                            options: AdditiveOptions, layer_times: Optional[list[float]]) -> list[SpliceSegment]:
+        splice_plan: list[SpliceSegment] = []
+        position = 0
+        layer_times_iter = iter(layer_times or [])
+        for block in blocks:
+            block_options = options
+            if block[0].name == "DRY_PHOTO" and layer_times is not None:
+                block_options = replace(options, dryingTime=_get_drying_time(options, next(layer_times_iter)))
+            splice_plan.append(range(position, block[0].start))
+            for variant in block:
+                if not self._is_selected(variant, block_options):
+                    continue
+                if variant.name in ("DRYING_TIME", "DRY_PHOTO"):
+                    splice_plan.append(self.DRYING_TIME_PATTERN.sub(str(block_options.dryingTime).encode(),
+                                                                    source[variant.content.start:variant.content.stop]))
+                else:
+                    splice_plan.append(variant.content)
+            position = block[-1].end
+        splice_plan.append(range(position, len(source)))
+        return splice_plan
+
+    def _is_selected(self, variant: TemplateVariant, options: AdditiveOptions) -> bool:
+        return all(self.OPERATORS[operator_name](int(getattr(options, option)), value)
+                   for option, operator_name, value in variant.conditions)
+
+
+def _get_drying_time(options: AdditiveOptions, layer_time: float) -> int:
+    '''Drying time in whole seconds that makes the layer take at least the minimum layer time'''
+    if options.dryingTime <= 0:
+        return 0
+    return max(0, math.ceil(options.dryingTime - layer_time))
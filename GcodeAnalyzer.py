@@ -0,0 +1,397 @@
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+import mmap
+import multiprocessing
+import os
+from pathlib import Path
+import re
+from typing import Iterator, Optional, Union
+import numpy as np
+from .GcodeMerger import map_file
+from . import gcode_pipeline
+
+AXES = b"XYZAB"
+
+
+@dataclass
+class LayerStatistics:
+    number: int
+    start: int  # byte offset of the layer comment
+    print_time: float  # s
+    drying_time: float  # s, of the drying after the layer
+    milling_time: float  # s, of the milling inserts in the layer
+    extrusion_a: float
+    extrusion_b: float
+
+
+@dataclass
+class InsertStatistics:
+    kind: str  # LAYER_REMOVAL, OVEREXTRUSION_REMOVAL, FINISHING or SUBPROGRAM
+    z: Optional[float]
+    layer: Optional[int]
+    time: float  # s
+    cutting_distance: float  # mm
+    travel_distance: float  # mm
+
+
+@dataclass
+class GcodeStatistics:
+    '''Times are in seconds, distances in mm, extrusion in the units of the A and B axes'''
+    line_count: int = 0
+    print_time: float = 0
+    drying_time: float = 0
+    milling_time: float = 0
+    other_time: float = 0  # moves outside the layers and inserts, e.g. the header and the end of the program
+    cutting_distance: float = 0  # extruding moves while printing, feed moves while milling
+    travel_distance: float = 0
+    extrusion_a: float = 0
+    extrusion_b: float = 0
+    layers: list[LayerStatistics] = field(default_factory=list)
+    inserts: list[InsertStatistics] = field(default_factory=list)
+
+    @property
+    def total_time(self) -> float:
+        return self.print_time + self.drying_time + self.milling_time + self.other_time
+
+    def report(self) -> str:
+        lines = [f"Lines: {self.line_count:,}",
+                 f"Layers: {len(self.layers)}",
+                 f"Machine time: {_format_duration(self.total_time)} (printing {_format_duration(self.print_time)}, "
+                 f"drying {_format_duration(self.drying_time)}, milling {_format_duration(self.milling_time)})",
+                 f"Cutting distance: {self.cutting_distance / 1000:.2f} m, travel distance: {self.travel_distance / 1000:.2f} m",
+                 f"Extrusion: A {self.extrusion_a:.3f}, B {self.extrusion_b:.3f}"]
+        if self.layers:
+            slowest = max(self.layers, key=lambda layer: layer.print_time)
+            fastest = min(self.layers, key=lambda layer: layer.print_time)
+            lines.append(f"Layer print time: {_format_duration(fastest.print_time)} (layer {fastest.number}) to "
+                         f"{_format_duration(slowest.print_time)} (layer {slowest.number})")
+        for kind in sorted({insert.kind for insert in self.inserts}):
+            inserts = [insert for insert in self.inserts if insert.kind == kind]
+            lines.append(f"{kind}: {len(inserts)} inserts, {_format_duration(sum(insert.time for insert in inserts))}")
+        return "\n".join(lines)
+
+
+class GcodeAnalyzer:
+    '''Estimates the machine time, distances and extrusion of a combined program (or of the additive G-code alone),
+    per layer and per milling insert, from the lengths and feeds of the moves. Acceleration is ignored.
+    The program is parsed into NumPy arrays chunk by chunk: the words are found and converted to numbers in C,
+    and the modal state (positions, feed, motion and distance mode) is carried forward with cumulative sums and
+    maximum accumulations instead of a Python loop per line, so that 10 million lines take seconds.
+    Lines with parameters or control flow (e.g. IF, GOTO, #620=) are not moves and are skipped. As none of the defect
+    correction branches are taken, the statistics are those of a print without corrections.
+    Subprograms are counted once, where they are written at the end of the program.'''
+
+    CHUNK_SIZE = 8 * 1024 * 1024
+    TOKEN_WIDTH = 12  # characters of a number
+    DRYING_PATTERN = re.compile(rb"#620=(?P<time>[\d.]+)")
+    # patterns start with a literal, which is searched for much faster than a line start
+    LAYER_PATTERN = re.compile(rb";\s*Layer (?P<number>\d+) of \d+")
+    INSERT_PATTERN = re.compile(rb";MILLING_INSERT_(?P<marker>START|END)(?P<words>[^\r\n]*)")
+
+    def __init__(self, rapid_feed: float, max_workers: Optional[int] = None) -> None:
+        self.rapid_feed = rapid_feed  # mm/min
+        self.max_workers = max_workers or os.cpu_count() or 1
+
+    def analyze(self, gcode_file: Path) -> GcodeStatistics:
+        with open(gcode_file, 'rb') as gcode, map_file(gcode) as source:
+            return self._analyze(gcode_file, source)
+
+    def _analyze(self, gcode_file: Path, source: Union[mmap.mmap, bytes]) -> GcodeStatistics:
+        layer_matches = [match for match in self.LAYER_PATTERN.finditer(source) if _is_line_start(source, match.start())]
+        layer_starts = [match.start() for match in layer_matches]
+        layer_numbers = [int(match.group('number')) for match in layer_matches]
+        inserts, insert_boundaries = self._find_inserts(source, layer_starts, layer_numbers)
+
+        # region 0 is outside of the layers, then a region per layer (printing) and per insert (milling)
+        region_count = 1 + len(layer_starts) + len(inserts)
+        times = np.zeros(region_count)
+        cutting_distances = np.zeros(region_count)
+        travel_distances = np.zeros(region_count)
+        extrusions = np.zeros((2, region_count))
+        state = _ModalState()
+        line_count = 0
+        for chunk in self._parse_chunks(gcode_file, source):
+            moves = self._find_moves(chunk, state)
+            line_count += len(chunk.offsets)
+            offsets = moves.offsets
+            insert_position = np.searchsorted(insert_boundaries, offsets, side='right')
+            is_milling = insert_position % 2 == 1
+            regions = np.where(is_milling, 1 + len(layer_starts) + insert_position // 2,
+                               np.searchsorted(layer_starts, offsets, side='right'))
+            is_travel = (moves.motion == 0) | (~is_milling & (moves.deltas[3] == 0) & (moves.deltas[4] == 0))
+            times += np.bincount(regions, moves.times, region_count)
+            cutting_distances += np.bincount(regions, np.where(is_travel, 0, moves.lengths), region_count)
+            travel_distances += np.bincount(regions, np.where(is_travel, moves.lengths, 0), region_count)
+            for axis in range(2):
+                extrusions[axis] += np.bincount(regions, moves.deltas[3 + axis], region_count)
+
+        drying_times = self._find_drying_times(source, layer_starts)
+        layer_regions = slice(1, 1 + len(layer_starts))
+        insert_regions = slice(1 + len(layer_starts), region_count)
+        milling_times: dict[Optional[int], float] = {}
+        for insert, time, cutting_distance, travel_distance in zip(inserts, times[insert_regions],
+                                                                    cutting_distances[insert_regions],
+                                                                    travel_distances[insert_regions]):
+            insert.time, insert.cutting_distance, insert.travel_distance = float(time), float(cutting_distance), \
+                float(travel_distance)
+            milling_times[insert.layer] = milling_times.get(insert.layer, 0) + insert.time
+        layers = [LayerStatistics(number, start, float(print_time), drying_time, milling_times.get(number, 0),
+                                  float(extrusion_a), float(extrusion_b))
+                  for number, start, print_time, drying_time, extrusion_a, extrusion_b
+                  in zip(layer_numbers, layer_starts, times[layer_regions], drying_times,
+                         extrusions[0][layer_regions], extrusions[1][layer_regions])]
+        return GcodeStatistics(line_count=line_count,
+                               print_time=float(times[layer_regions].sum()),
+                               drying_time=sum(drying_times),
+                               milling_time=float(times[insert_regions].sum()),
+                               other_time=float(times[0]),
+                               cutting_distance=float(cutting_distances.sum()),
+                               travel_distance=float(travel_distances.sum()),
+                               extrusion_a=float(extrusions[0].sum()),
+                               extrusion_b=float(extrusions[1].sum()),
+                               layers=layers,
+                               inserts=inserts)
+
+    def _find_inserts(self, source: Union[mmap.mmap, bytes], layer_starts: list[int],
+                      layer_numbers: list[int]) -> tuple[list[InsertStatistics], np.ndarray]:
+        '''Returns the inserts and the offsets where they start and end, alternating'''
+        inserts = []
+        boundaries = []
+        for match in self.INSERT_PATTERN.finditer(source):
+            if not _is_line_start(source, match.start()):
+                continue
+            is_start = match.group('marker') == b"START"
+            if is_start == (len(boundaries) % 2 == 1):
+                continue  # unpaired marker
+            boundaries.append(match.start())
+            if is_start:
+                words = match.group('words').decode().split()
+                layer_position = bisect_right(layer_starts, match.start()) - 1
+                inserts.append(InsertStatistics(kind=words[0] if words else "",
+                                                z=float(words[-1]) if len(words) >= 4 and words[-2] == "Z" else None,
+                                                layer=layer_numbers[layer_position] if layer_position >= 0 else None,
+                                                time=0, cutting_distance=0, travel_distance=0))
+        return inserts, np.array(boundaries, dtype=np.int64)
+
+    def _find_drying_times(self, source: Union[mmap.mmap, bytes], layer_starts: list[int]) -> list[float]:
+        '''The drying after a layer is written at the start of the next layer, like its Z (see LayerIndex),
+        except for the last layer, where it is written at the end of the program'''
+        drying_times = [0.0] * len(layer_starts)
+        last_layer_position = None
+        for match in self.DRYING_PATTERN.finditer(source):
+            layer_position = bisect_right(layer_starts, match.start()) - 1
+            if layer_position < 0:
+                continue
+            if layer_position > 0 and layer_position != last_layer_position:
+                drying_times[layer_position - 1] += float(match.group('time'))
+            else:
+                drying_times[layer_position] += float(match.group('time'))
+            last_layer_position = layer_position
+        return drying_times
+
+    def _read_chunks(self, source: Union[mmap.mmap, bytes]) -> Iterator[tuple[int, int]]:
+        '''Yields the start and end offsets of chunks of whole lines'''
+        start = 0
+        while start < len(source):
+            end = source.find(b"\n", min(start + self.CHUNK_SIZE, len(source)) - 1) + 1 or len(source)
+            yield start, end
+            start = end
+
+    def _parse_chunks(self, gcode_file: Path, source: Union[mmap.mmap, bytes]) -> Iterator['ParsedChunk']:
+        '''Parses the chunks in a pool of worker processes for large files, see gcode_pipeline.
+        At most a few chunks per worker are in flight, and they are yielded in order.'''
+        python_executable = gcode_pipeline.find_python_executable()
+        if self.max_workers <= 1 or len(source) < gcode_pipeline.MIN_PARALLEL_FILE_SIZE or python_executable is None:
+            for start, end in self._read_chunks(source):
+                yield parse_chunk(source[start:end], start, self.TOKEN_WIDTH)
+            return
+
+        context = multiprocessing.get_context('spawn')
+        context.set_executable(str(python_executable))
+        gcode_pipeline._add_package_root_to_path()
+        with ProcessPoolExecutor(self.max_workers, mp_context=context) as executor:
+            in_flight: deque[Future] = deque()
+            for start, end in self._read_chunks(source):
+                in_flight.append(executor.submit(parse_file_chunk, gcode_file, start, end, self.TOKEN_WIDTH))
+                if len(in_flight) >= 2 * self.max_workers:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+
+    def _find_moves(self, chunk: 'ParsedChunk', state: '_ModalState') -> '_Moves':
+        '''Carries the modal state through the lines of the chunk and returns its moves'''
+        line_count = len(chunk.offsets)
+        columns = chunk.columns
+        motion = _forward_fill(chunk.motion, ~np.isnan(chunk.motion), state.motion)
+        is_absolute = _forward_fill(chunk.distance_mode == 90, ~np.isnan(chunk.distance_mode), state.is_absolute)
+        feed = _forward_fill(columns[b"F"], ~np.isnan(columns[b"F"]), state.feed)
+
+        positions = np.empty((len(AXES), line_count))
+        is_move = np.zeros(line_count, dtype=bool)
+        for axis, letter in enumerate(AXES):
+            column = columns[bytes((letter,))]
+            is_given = ~np.isnan(column) & (~chunk.is_non_work_move | chunk.is_position_reset)
+            is_set = is_given & (is_absolute | chunk.is_position_reset)
+            increments = np.cumsum(np.where(is_given & ~is_set, column, 0))
+            # the position is the last set value plus the increments since
+            bases = _forward_fill(column - increments, is_set, state.positions[axis])
+            positions[axis] = bases + increments
+            is_move |= is_given & ~chunk.is_position_reset
+        previous_positions = np.concatenate((np.array(state.positions)[:, None], positions[:, :-1]), axis=1)
+        deltas = np.where(is_move, positions - previous_positions, 0)
+
+        lengths = np.sqrt((deltas[:3] ** 2).sum(axis=0))
+        is_arc = is_move & ((motion == 2) | (motion == 3)) & (~np.isnan(columns[b"I"]) | ~np.isnan(columns[b"J"]))
+        if is_arc.any():
+            lengths[is_arc] = _arc_lengths(previous_positions[:, is_arc], positions[:, is_arc], deltas[2, is_arc],
+                                           np.nan_to_num(columns[b"I"][is_arc]), np.nan_to_num(columns[b"J"][is_arc]),
+                                           motion[is_arc] == 2)
+        # moves of the extrusion axes only, e.g. the pressure increase, take their time too
+        move_lengths = np.where(lengths > 0, lengths, np.hypot(deltas[3], deltas[4]))
+        move_feeds = np.where(motion == 0, self.rapid_feed, feed)
+        times = np.divide(move_lengths * 60, move_feeds, out=np.zeros(line_count), where=is_move & (move_feeds > 0))
+
+        if line_count:
+            state.motion, state.is_absolute, state.feed = float(motion[-1]), bool(is_absolute[-1]), float(feed[-1])
+            state.positions = [float(position) for position in positions[:, -1]]
+        return _Moves(chunk.offsets[is_move], motion[is_move], lengths[is_move], deltas[:, is_move], times[is_move])
+
+
+@dataclass
+class ParsedChunk:
+    '''The words of each line of a chunk, which do not depend on the lines before the chunk'''
+    offsets: np.ndarray  # of the lines in the file
+    columns: dict[bytes, np.ndarray]  # value of each letter on each line, or NaN
+    motion: np.ndarray  # G0 to G3, or NaN
+    distance_mode: np.ndarray  # G90 or G91, or NaN
+    is_position_reset: np.ndarray  # G92
+    is_non_work_move: np.ndarray  # coordinates that are not moves in the work coordinates, e.g. G53, G28, G52 or G92
+
+
+def parse_file_chunk(gcode_file: Path, start: int, end: int, token_width: int) -> ParsedChunk:
+    '''Runs in the worker processes, which read their chunk themselves rather than receiving it'''
+    with open(gcode_file, 'rb') as gcode:
+        gcode.seek(start)
+        return parse_chunk(gcode.read(end - start), start, token_width)
+
+
+def parse_chunk(chunk: bytes, chunk_start: int, token_width: int) -> ParsedChunk:
+    text = np.frombuffer(chunk + b"\n" * (not chunk.endswith(b"\n")) + b"\0" * token_width, dtype=np.uint8)
+    line_ends = np.flatnonzero(text == ord("\n"))
+    line_count = len(line_ends)
+    line_starts = np.concatenate(([0], line_ends[:-1] + 1))
+
+    # code ends at the first comment of the line
+    comment_positions = np.flatnonzero((text == ord(";")) | (text == ord("(")))
+    code_ends = line_ends.copy()
+    comment_lines, first_comments = np.unique(np.searchsorted(line_ends, comment_positions), return_index=True)
+    code_ends[comment_lines] = comment_positions[first_comments]
+
+    # parameters and control flow are not moves
+    control_positions = np.flatnonzero((text == ord("#")) | (text == ord("[")))
+    control_lines = np.searchsorted(line_ends, control_positions)
+    is_control_line = np.zeros(line_count, dtype=bool)
+    is_control_line[control_lines[control_positions < code_ends[control_lines]]] = True
+
+    # words are a letter directly followed by a number
+    letter_positions = np.flatnonzero(text - np.uint8(ord("A")) < 26)
+    word_positions = letter_positions[_NUMBER_CHARACTERS[text[letter_positions + 1]]]
+    word_lines = np.searchsorted(line_ends, word_positions)
+    is_code = (word_positions < code_ends[word_lines]) & ~is_control_line[word_lines]
+    word_positions, word_lines = word_positions[is_code], word_lines[is_code]
+    letters = text[word_positions]
+    values = _parse_numbers(text, word_positions + 1, token_width)
+
+    columns = {}
+    for letter in b"XYZABFIJK":
+        is_letter = letters == letter
+        column = np.full(line_count, np.nan)
+        column[word_lines[is_letter]] = values[is_letter]
+        columns[bytes((letter,))] = column
+    is_g = letters == ord("G")
+    g_lines, g_codes = word_lines[is_g], values[is_g]
+    is_position_reset = np.zeros(line_count, dtype=bool)
+    is_position_reset[g_lines[g_codes == 92]] = True
+    is_non_work_move = np.zeros(line_count, dtype=bool)
+    is_non_work_move[g_lines[np.isin(g_codes, (28, 30, 52, 53, 92))]] = True
+    return ParsedChunk(line_starts + chunk_start, columns,
+                       _g_code_column(line_count, g_lines, g_codes, (0, 1, 2, 3)),
+                       _g_code_column(line_count, g_lines, g_codes, (90, 91)),
+                       is_position_reset, is_non_work_move)
+
+
+def _parse_numbers(text: np.ndarray, starts: np.ndarray, width: int) -> np.ndarray:
+    '''Converts the numbers starting at the positions to floats, in C'''
+    tokens = np.lib.stride_tricks.sliding_window_view(text, width)[starts]
+    is_number = _NUMBER_CHARACTERS[tokens]
+    is_number[:, -1] = False
+    tokens *= np.arange(width) < is_number.argmin(axis=1)[:, None]  # up to the first character of something else
+    numbers = tokens.view(f"S{width}").ravel()
+    try:
+        return numbers.astype(np.float64)
+    except ValueError:  # e.g. "1.2.3" or "-", which are NaN rather than converting the whole chunk one by one
+        is_digit = tokens - np.uint8(ord("0")) < 10
+        is_valid = (is_digit.any(axis=1) & ((tokens == ord(".")).sum(axis=1) <= 1)
+                    & ~((tokens[:, 1:] == ord("+")) | (tokens[:, 1:] == ord("-"))).any(axis=1))
+        values = np.full(len(numbers), np.nan)
+        values[is_valid] = numbers[is_valid].astype(np.float64)
+        return values
+
+
+@dataclass
+class _ModalState:
+    motion: float = 0
+    is_absolute: bool = True
+    feed: float = 0
+    positions: list[float] = field(default_factory=lambda: [0.0] * len(AXES))
+
+
+@dataclass
+class _Moves:
+    offsets: np.ndarray  # of the lines in the file
+    motion: np.ndarray
+    lengths: np.ndarray  # mm
+    deltas: np.ndarray  # per axis
+    times: np.ndarray  # s
+
+
+_NUMBER_CHARACTERS = np.zeros(256, dtype=bool)
+_NUMBER_CHARACTERS[list(b"+-.0123456789")] = True
+
+
+def _g_code_column(line_count: int, g_lines: np.ndarray, g_codes: np.ndarray, group: tuple[float, ...]) -> np.ndarray:
+    '''Returns the G code of the modal group on each line, or NaN'''
+    column = np.full(line_count, np.nan)
+    is_in_group = np.isin(g_codes, group)
+    column[g_lines[is_in_group]] = g_codes[is_in_group]
+    return column
+
+
+def _forward_fill(values: np.ndarray, is_set: np.ndarray, initial):
+    '''Returns the last set value on or before each position, or the initial value before the first'''
+    last_set = np.where(is_set, np.arange(len(values)), -1)
+    np.maximum.accumulate(last_set, out=last_set)
+    return np.where(last_set >= 0, values[np.maximum(last_set, 0)], initial)
+
+
+def _arc_lengths(starts: np.ndarray, ends: np.ndarray, z_deltas: np.ndarray, i: np.ndarray, j: np.ndarray,
+                 is_clockwise: np.ndarray) -> np.ndarray:
+    '''Lengths of arcs in the XY plane with incremental centres, including helical Z moves'''
+    centre_x, centre_y = starts[0] + i, starts[1] + j
+    start_angles = np.arctan2(starts[1] - centre_y, starts[0] - centre_x)
+    end_angles = np.arctan2(ends[1] - centre_y, ends[0] - centre_x)
+    sweeps = np.where(is_clockwise, start_angles - end_angles, end_angles - start_angles) % (2 * np.pi)
+    sweeps[sweeps == 0] = 2 * np.pi  # full circle
+    return np.hypot(np.hypot(i, j) * sweeps, z_deltas)
+
+
+def _is_line_start(source: Union[mmap.mmap, bytes], offset: int) -> bool:
+    return offset == 0 or source[offset - 1:offset] == b"\n"
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
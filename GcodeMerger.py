@@ -0,0 +1,284 @@
+from collections import Counter
+from dataclasses import dataclass
+from decimal import Decimal
+import hashlib
+import mmap
+import os
+from pathlib import Path
+import re
+import shutil
+import sys
+from typing import BinaryIO, Optional, Union
+from .PlanarisingIndex import PlanarisingIndex
+from . import gcode_utils
+
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
+# A splice plan is a list of segments: byte ranges of the additive G-code, whole files, or literal bytes
+SpliceSegment = Union[range, Path, bytes]
+
+
+@dataclass
+class Placeholder:
+    kind: str
+    height: float
+    start: int  # byte offset of the placeholder in the additive G-code
+    end: int
+
+
+@dataclass
+class _SubprogramCall:
+    '''A planarising toolpath that may be output as a subprogram call'''
+    digest: bytes  # hash of the toolpath with Z normalised to the toolpath height
+    height_um: int
+    path: Path
+    normalised_gcode: bytes  # the toolpath with Z normalised, kept from the read that found the call
+    line_ending: bytes
+
+
+class GcodeMerger:
+    '''Combines additive G-code with milling G-code by replacing the placeholders written by the additive post processor.
+    The additive G-code is memory-mapped and only scanned for placeholder offsets. The output is then spliced together
+    from byte ranges of the additive G-code and whole milling files, copied by the kernel where the platform allows it,
+    so the G-code is never decoded or held in memory.
+    With subprograms enabled, planarising toolpaths that only differ in Z are output once as a subprogram after the
+    end of the main program, and called with a G52 Z offset at each placeholder that uses them.
+    Over-extrusion removals use the skim toolpath at their height where one was exported, as only the top of the layer
+    needs to be cut, and the planarising toolpath otherwise.'''
+
+    PLACEHOLDER_PATTERN = re.compile(
+        rb";PLACEHOLDER_(?P<kind>LAYER_REMOVAL|OVEREXTRUSION_REMOVAL|FINISHING) at Z ?(?P<height>[\d.]+)")
+    SUBPROGRAM_PATTERN = re.compile(rb"^O\d+|M0*9[89](?!\d)", re.MULTILINE)
+    FIRST_SUBPROGRAM_NUMBER = 1000  # above the subprogram numbers used by mach4mill.cps
+    # milling inserts are wrapped in these comments so that later stages can tell them apart from additive G-code
+    INSERT_START_MARKER = b";MILLING_INSERT_START"
+    INSERT_END_MARKER = b";MILLING_INSERT_END"
+
+    def __init__(self,
+                 planarising_index: Optional[PlanarisingIndex] = None,
+                 finishing_file: Optional[Path] = None,
+                 use_subprograms: bool = False,
+                 skim_index: Optional[PlanarisingIndex] = None) -> None:
+        self.planarising_index = planarising_index
+        self.finishing_file = finishing_file
+        self.use_subprograms = use_subprograms
+        self.skim_index = skim_index
+        self._subprogram_calls: dict[Path, Optional[_SubprogramCall]] = {}
+
+    @classmethod
+    def find_placeholders(cls, additive_file: Path) -> list[Placeholder]:
+        '''Returns every placeholder in the additive G-code, in order of appearance'''
+        with open(additive_file, 'rb') as additive_gcode, map_file(additive_gcode) as source:
+            return cls._find_placeholders(source)
+
+    def merge(self, additive_file: Path, output_file: Path):
+        '''Write the additive G-code to the output file with the milling G-code inserted in place of the placeholders'''
+        with open(additive_file, 'rb') as additive_gcode, open(output_file, 'wb', buffering=0) as outfile:
+            with map_file(additive_gcode) as source:
+                splice_plan = self._create_splice_plan(self._find_placeholders(source), source)
+                write_splice_plan(additive_gcode, source, splice_plan, outfile)
+
+    @classmethod
+    def _find_placeholders(cls, source: Union[mmap.mmap, bytes]) -> list[Placeholder]:
+        return [Placeholder(match.group('kind').decode(), float(match.group('height')), match.start(), match.end())
+                for match in cls.PLACEHOLDER_PATTERN.finditer(source)]
+
+    def _create_splice_plan(self, placeholders: list[Placeholder], source: Union[mmap.mmap, bytes]) -> list[SpliceSegment]:
+        splice_plan: list[Union[SpliceSegment, _SubprogramCall]] = []
+        position = 0
+        finishing_inserted = False
+        line_ending = gcode_utils.detect_line_ending(source[:4096])
+        for placeholder in placeholders:
+            if placeholder.kind == 'FINISHING':
+                # only the first finishing placeholder is replaced
+                if self.finishing_file is None or finishing_inserted:
+                    continue
+                finishing_inserted = True
+                insert = self._get_finishing_insert()
+            elif self.planarising_index is None:
+                continue
+            else:
+                index = self._get_defect_correction_index(self.planarising_index, placeholder)
+                insert = self._get_defect_correction_insert(index, placeholder.height,
+                                                            throw_on_failure=placeholder.kind == 'LAYER_REMOVAL')
+                if self.use_subprograms and isinstance(insert, Path):
+                    insert = self._get_subprogram_call(index, placeholder.height) or insert
+            splice_plan.append(range(position, placeholder.start))
+            if isinstance(insert, (Path, _SubprogramCall)):
+                splice_plan.append(self.INSERT_START_MARKER + f" {placeholder.kind} at Z {format(placeholder.height, '.2f')}".encode()
+                                   + line_ending)
+                splice_plan.append(insert)
+                splice_plan.append(line_ending + self.INSERT_END_MARKER)
+            else:
+                splice_plan.append(insert)
+            position = placeholder.end
+
+        if not self.use_subprograms:
+            splice_plan.append(range(position, len(source)))
+            return splice_plan  # type: ignore
+
+        # subprograms go after the end of the main program, but before the closing percent sign
+        subprogram_numbers = self._number_subprograms(splice_plan)
+        program_end = _find_closing_percent_sign(source, position)
+        splice_plan.append(range(position, program_end))
+        splice_plan.append(self._get_subprograms(subprogram_numbers, line_ending))
+        splice_plan.append(range(program_end, len(source)))
+        return [self._get_subprogram_call_insert(segment, subprogram_numbers)
+                if isinstance(segment, _SubprogramCall) else segment
+                for segment in splice_plan]
+
+    def _get_defect_correction_index(self, planarising_index: PlanarisingIndex,
+                                     placeholder: Placeholder) -> PlanarisingIndex:
+        '''The skim toolpaths for over-extrusion removals that have one, the planarising toolpaths otherwise'''
+        if (placeholder.kind == 'OVEREXTRUSION_REMOVAL' and self.skim_index is not None
+                and self.skim_index.find(placeholder.height) is not None):
+            return self.skim_index
+        return planarising_index
+
+    def _get_defect_correction_insert(self, index: PlanarisingIndex, height: float, throw_on_failure: bool) -> SpliceSegment:
+        planarising_file_path = index.path(height)
+        if planarising_file_path is not None:
+            return planarising_file_path
+        if throw_on_failure:
+            raise RuntimeError(f"Layer removal gcode not found at {round(height, 2)}")
+
+        return f'; Planarising toolpath does not exist at {format(height, ".2f")} for over-extrusion removal'.encode()
+
+    def _get_subprogram_call(self, index: PlanarisingIndex, height: float) -> Optional[_SubprogramCall]:
+        '''Returns the subprogram call for the planarising toolpath, or None if it cannot be output as a subprogram'''
+        height_um, planarising_file_path = index.find(height), index.path(height)
+        if height_um is None or planarising_file_path is None:
+            return None
+        if planarising_file_path not in self._subprogram_calls:
+            planarising_gcode = index.read(height)
+            if not planarising_gcode or not planarising_gcode.strip() or self.SUBPROGRAM_PATTERN.search(planarising_gcode):
+                self._subprogram_calls[planarising_file_path] = None  # empty or calls its own subprograms
+            else:
+                normalised_gcode = gcode_utils.shift_z(planarising_gcode, -_to_mm(height_um))
+                self._subprogram_calls[planarising_file_path] = _SubprogramCall(
+                    hashlib.sha1(normalised_gcode).digest(), height_um, planarising_file_path, normalised_gcode,
+                    gcode_utils.detect_line_ending(planarising_gcode[:4096]))
+        return self._subprogram_calls[planarising_file_path]
+
+    def _number_subprograms(self, splice_plan: list) -> dict[bytes, tuple[int, _SubprogramCall]]:
+        '''Assign subprogram numbers to the toolpaths used more than once, in order of first use'''
+        calls = [segment for segment in splice_plan if isinstance(segment, _SubprogramCall)]
+        use_counts = Counter(call.digest for call in calls)
+        first_calls: dict[bytes, _SubprogramCall] = {}
+        for call in calls:
+            if use_counts[call.digest] > 1 and call.digest not in first_calls:
+                first_calls[call.digest] = call
+        return {digest: (self.FIRST_SUBPROGRAM_NUMBER + i, call) for i, (digest, call) in enumerate(first_calls.items())}
+
+    def _get_subprogram_call_insert(self, call: _SubprogramCall,
+                                    subprogram_numbers: dict[bytes, tuple[int, _SubprogramCall]]) -> SpliceSegment:
+        if call.digest not in subprogram_numbers:
+            return call.path
+        subprogram_number, _ = subprogram_numbers[call.digest]
+        return call.line_ending.join([b"G52 Z" + f"{_to_mm(call.height_um)}".encode(),
+                                 b"M98 P" + f"{subprogram_number}".encode(),
+                                 b"G52 Z0"])
+
+    def _get_subprograms(self, subprogram_numbers: dict, line_ending: bytes) -> bytes:
+        subprograms = []
+        for subprogram_number, call in subprogram_numbers.values():
+            normalised_gcode = call.normalised_gcode
+            if not normalised_gcode.endswith(b"\n"):
+                normalised_gcode += line_ending
+            subprograms.append(b"O" + f"{subprogram_number}".encode() + line_ending
+                               + self.INSERT_START_MARKER + b" SUBPROGRAM" + line_ending
+                               + normalised_gcode
+                               + self.INSERT_END_MARKER + line_ending
+                               + b"M99" + line_ending)
+        return line_ending.join(subprograms)
+
+    def _get_finishing_insert(self) -> SpliceSegment:
+        assert self.finishing_file is not None
+        if Path.exists(self.finishing_file):
+            return self.finishing_file
+        return f"finishing gcode {self.finishing_file} not found".encode()
+
+
+class _EmptyMap(bytes):
+    '''Stands in for the memory map of an empty file, which cannot be mapped'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def map_file(file: BinaryIO) -> Union[mmap.mmap, _EmptyMap]:
+    if os.fstat(file.fileno()).st_size == 0:
+        return _EmptyMap()
+    return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def write_splice_plan(source: BinaryIO, source_map: Union[mmap.mmap, bytes], splice_plan: list[SpliceSegment],
+                      outfile: BinaryIO):
+    '''Write the segments of the splice plan to the (unbuffered) output file in order'''
+    for segment in splice_plan:
+        if isinstance(segment, range):
+            _copy_range(source, source_map, segment, outfile)
+        elif isinstance(segment, Path):
+            _copy_file(segment, outfile)
+        else:
+            _write_all(outfile, segment)
+
+
+def _to_mm(height_um: int) -> Decimal:
+    return Decimal(height_um).scaleb(-3)
+
+
+def _find_closing_percent_sign(source: Union[mmap.mmap, bytes], start: int) -> int:
+    '''Returns the offset of the percent sign that closes the program, or the end of the file if there is none'''
+    position = source.rfind(b"%", start)
+    if position == -1 or source[position + 1:].strip() != b"" or (position > 0 and source[position - 1:position] not in b"\r\n"):
+        return len(source)
+    return position
+
+
+def _kernel_copy(source: BinaryIO, outfile: BinaryIO, offset: int, count: int) -> int:
+    '''Copy bytes between files without passing them through Python, where the platform supports it.
+    Returns the number of bytes copied, which may be less than count.'''
+    copied = 0
+    try:
+        while copied < count:
+            if hasattr(os, 'copy_file_range'):
+                n = os.copy_file_range(source.fileno(), outfile.fileno(), count - copied, offset + copied)
+            elif hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+                n = os.sendfile(outfile.fileno(), source.fileno(), offset + copied, count - copied)
+            else:
+                break
+            if n == 0:
+                break
+            copied += n
+    except OSError:
+        # e.g. copying across file systems on older kernels. The caller copies the rest.
+        pass
+    return copied
+
+
+def _copy_range(source: BinaryIO, source_map: Union[mmap.mmap, bytes], byte_range: range, outfile: BinaryIO):
+    copied = _kernel_copy(source, outfile, byte_range.start, len(byte_range))
+    if copied < len(byte_range):
+        with memoryview(source_map) as view:
+            _write_all(outfile, view[byte_range.start + copied:byte_range.stop])
+
+
+def _copy_file(path: Path, outfile: BinaryIO):
+    with open(path, 'rb') as source:
+        size = os.fstat(source.fileno()).st_size
+        copied = _kernel_copy(source, outfile, 0, size)
+        if copied < size:
+            source.seek(copied)
+            shutil.copyfileobj(source, outfile, COPY_BUFFER_SIZE)
+
+
+def _write_all(outfile: BinaryIO, data: Union[bytes, memoryview]):
+    '''Unbuffered writes may be partial'''
+    with memoryview(data) as view:
+        while len(view) > 0:
+            written = outfile.write(view)
+            view = view[written:]
@@ -0,0 +1,207 @@
+from bisect import bisect_right
+from dataclasses import dataclass
+import math
+import mmap
+from pathlib import Path
+import re
+from typing import Optional, Union
+from .GcodeMerger import map_file
+
+
+@dataclass
+class ValidationIssue:
+    is_error: bool  # warnings are reported, but the program may still be run
+    message: str
+    line: Optional[int] = None
+
+    def __str__(self) -> str:
+        location = f"line {self.line}: " if self.line is not None else ""
+        return f"{'Error' if self.is_error else 'Warning'}: {location}{self.message}"
+
+
+class GcodeValidator:
+    '''Checks a combined program for mistakes that would otherwise only show up on the machine:
+    unreplaced placeholders, missing toolpaths, GOTOs without a label, unpaired percent signs, and Z and feed values
+    outside the bounds of the tool (milling inserts or printing). The Z values of subprograms are checked at the lowest
+    G52 offset they are called with.
+    The program is memory-mapped and only searched for literal words with regular expressions, which are matched in C,
+    and the Z and feed patterns only match values that may be out of bounds, so that hardly any matches reach Python.'''
+
+    MAX_REPORTED_PER_CHECK = 10
+
+    PLACEHOLDER_PATTERN = re.compile(rb";PLACEHOLDER_[^\r\n]*")
+    MISSING_TOOLPATH_PATTERN = re.compile(rb"; Planarising toolpath does not exist at (?P<height>[\d.]+)")
+    MISSING_FINISHING_PATTERN = re.compile(rb"finishing gcode [^\r\n]* not found")
+    LABEL_PATTERN = re.compile(rb"\nN(?P<label>\d+)[ \t]*(?=\r?\n|\Z)")
+    GOTO_PATTERN = re.compile(rb"GOTO\s*(?P<label>\d+)")
+    PERCENT_SIGN_PATTERN = re.compile(rb"\n%[ \t]*(?=\r?\n|\Z)")
+    FIRST_LINE_PATTERN = re.compile(rb"%[ \t]*(?:\r?\n|\Z)")
+    LAST_LINE_PATTERN = re.compile(rb"\n?%\s*\Z")
+    INSERT_PATTERN = re.compile(rb";MILLING_INSERT_(?:START|END)")
+    # subprograms are written with their Z normalised to 0, and called with a G52 Z offset of the height of each call
+    SUBPROGRAM_PATTERN = re.compile(rb"(?:^|\n)O(?P<number>\d+)[ \t]*\r?\n;MILLING_INSERT_START SUBPROGRAM")
+    SUBPROGRAM_CALL_PATTERN = re.compile(rb"G52\s*Z(?P<offset>[-+]?(?:\d+\.?\d*|\.\d+))[ \t]*\r?\nM98\s*P(?P<number>\d+)")
+    # the bounds are not checked in machine coordinates, homing moves and local coordinate system offsets
+    NON_WORK_COORDINATES_PATTERN = re.compile(rb"G0*(?:52|53|28|30)(?![.\d])")
+
+    def __init__(self,
+                 printing_z_min: float = 0,
+                 milling_z_min: float = 0,
+                 printing_feed_max: float = math.inf,
+                 milling_feed_max: float = math.inf) -> None:
+        self.z_mins = {False: printing_z_min, True: milling_z_min}
+        self.feed_maxes = {False: printing_feed_max, True: milling_feed_max}
+
+    def validate(self, gcode_file: Path) -> list[ValidationIssue]:
+        with open(gcode_file, 'rb') as gcode, map_file(gcode) as source:
+            return self._validate(source)
+
+    def _validate(self, source: Union[mmap.mmap, bytes]) -> list[ValidationIssue]:
+        issues: list[ValidationIssue] = []
+        issues += self._report(source, self.PLACEHOLDER_PATTERN, True,
+                               lambda match: f"Placeholder was not replaced: {match.group().decode().strip()}")
+        issues += self._report(source, self.MISSING_TOOLPATH_PATTERN, False,
+                               lambda match: f"No over-extrusion removal toolpath at Z {match.group('height').decode()}")
+        issues += self._report(source, self.MISSING_FINISHING_PATTERN, True,
+                               lambda match: f"Finishing toolpath is missing: {match.group().decode()}")
+        issues += self._check_labels(source)
+        issues += self._check_percent_signs(source)
+        issues += self._check_bounds(source)
+        return issues
+
+    def _report(self, source: Union[mmap.mmap, bytes], pattern: re.Pattern, is_error: bool, message) -> list[ValidationIssue]:
+        issues = []
+        for count, match in enumerate(pattern.finditer(source)):
+            if count == self.MAX_REPORTED_PER_CHECK:
+                issues.append(ValidationIssue(is_error, "... and more like the above"))
+                break
+            issues.append(ValidationIssue(is_error, message(match), _line_number(source, match.start())))
+        return issues
+
+    def _check_labels(self, source: Union[mmap.mmap, bytes]) -> list[ValidationIssue]:
+        labels: set[int] = set()
+        duplicate_labels: set[int] = set()
+        for match in self.LABEL_PATTERN.finditer(source):
+            label = int(match.group('label'))
+            (duplicate_labels if label in labels else labels).add(label)
+        missing_targets = {int(match.group('label')) for match in self.GOTO_PATTERN.finditer(source)} - labels
+
+        issues = []
+        if missing_targets:
+            issues.append(ValidationIssue(True, f"GOTO without a label: {_format_labels(missing_targets)}"))
+        if duplicate_labels:
+            issues.append(ValidationIssue(True, f"Label used more than once: {_format_labels(duplicate_labels)}"))
+        return issues
+
+    def _check_percent_signs(self, source: Union[mmap.mmap, bytes]) -> list[ValidationIssue]:
+        '''The program is either delimited by a percent sign on the first and last line, or has none'''
+        offsets = [0] if self.FIRST_LINE_PATTERN.match(source) else []
+        offsets += [match.start() + 1 for match in self.PERCENT_SIGN_PATTERN.finditer(source)]
+        if not offsets:
+            return []
+        if len(offsets) == 2 and offsets[0] == 0 and self.LAST_LINE_PATTERN.match(source, offsets[1]):
+            return []
+        return [ValidationIssue(True, f"Expected a percent sign on the first and last line only, found {len(offsets)}",
+                                _line_number(source, offsets[-1]))]
+
+    def _check_bounds(self, source: Union[mmap.mmap, bytes]) -> list[ValidationIssue]:
+        # offsets where milling inserts start and end, alternating
+        insert_boundaries = [match.start() for match in self.INSERT_PATTERN.finditer(source)]
+
+        def is_milling(offset: int) -> bool:
+            return bisect_right(insert_boundaries, offset) % 2 == 1
+
+        # the Z of a subprogram is checked at the lowest offset it is called with
+        subprogram_offsets = self._get_subprogram_offsets(source)
+        subprogram_starts = sorted(subprogram_offsets)
+
+        def get_z_offset(offset: int) -> Optional[float]:
+            subprogram = bisect_right(subprogram_starts, offset) - 1
+            if subprogram < 0:
+                return 0
+            start = subprogram_starts[subprogram]
+            end = bisect_right(insert_boundaries, start)
+            if end < len(insert_boundaries) and offset > insert_boundaries[end]:
+                return 0  # after the end of the subprogram
+            return subprogram_offsets[start]
+
+        lowest_offset = min((offset for offset in subprogram_offsets.values() if offset is not None), default=0)
+        issues = []
+        for is_min_check, letter, bounds in ((True, b"Z", self.z_mins), (False, b"F", self.feed_maxes)):
+            candidate_bound = max(bounds.values()) - min(lowest_offset, 0) if is_min_check else min(bounds.values())
+            pattern = _candidate_value_pattern(letter, candidate_bound, is_min_check)
+            if pattern is None:
+                continue
+            reported = 0
+            for match in pattern.finditer(source):
+                if source[match.start() - 1:match.start()].isalpha():
+                    continue  # part of another word, e.g. a comment
+                value = float(match.group('value'))
+                if is_min_check:
+                    z_offset = get_z_offset(match.start())
+                    if z_offset is None:
+                        continue  # a subprogram that is not called
+                    value += z_offset
+                is_milling_insert = is_milling(match.start())
+                bound = bounds[is_milling_insert]
+                if (value >= bound if is_min_check else value <= bound) or not self._is_work_coordinate_move(source, match.start()):
+                    continue
+                reported += 1
+                if reported > self.MAX_REPORTED_PER_CHECK:
+                    issues.append(ValidationIssue(True, "... and more like the above"))
+                    break
+                tool = "milling" if is_milling_insert else "printing"
+                comparison = "below the minimum" if is_min_check else "above the maximum"
+                called_at = f" (Z{value:g} where it is called)" if is_min_check and get_z_offset(match.start()) else ""
+                issues.append(ValidationIssue(True, f"{letter.decode()}{match.group('value').decode()}{called_at} is "
+                                                    f"{comparison} of {bound:g} for {tool}",
+                                              _line_number(source, match.start())))
+        return issues
+
+    def _get_subprogram_offsets(self, source: Union[mmap.mmap, bytes]) -> dict[int, Optional[float]]:
+        '''The lowest G52 Z offset each subprogram is called with, or None if it is not called, by the offset of its body'''
+        call_offsets: dict[int, float] = {}
+        for match in self.SUBPROGRAM_CALL_PATTERN.finditer(source):
+            number, offset = int(match.group('number')), float(match.group('offset'))
+            call_offsets[number] = min(offset, call_offsets.get(number, offset))
+        return {match.end(): call_offsets.get(int(match.group('number')))
+                for match in self.SUBPROGRAM_PATTERN.finditer(source)}
+
+    def _is_work_coordinate_move(self, source: Union[mmap.mmap, bytes], offset: int) -> bool:
+        '''False for words in comments, and moves in machine coordinates'''
+        line_start = source.rfind(b"\n", 0, offset) + 1
+        line_end = source.find(b"\n", offset)
+        line = source[line_start:line_end if line_end != -1 else len(source)]
+        code = re.split(rb"[;(]", line, maxsplit=1)[0]
+        return len(code) > offset - line_start and self.NON_WORK_COORDINATES_PATTERN.search(code) is None
+
+
+def _candidate_value_pattern(letter: bytes, bound: float, is_min_check: bool) -> Optional[re.Pattern]:
+    '''Returns a pattern that matches every value that may be beyond the bound, and few others.
+    e.g. for a minimum Z of 1.8, only negative values and values with an integer part of 0 or 1 are matched.'''
+    if math.isinf(bound):
+        return None
+    number = rb"\d+(?:\.\d*)?|\.\d+"
+    if is_min_check:
+        if bound <= 0:
+            value = rb"-(?:" + number + rb")"
+        else:
+            integer_digits = rb"|".join(str(i).encode() for i in range(math.floor(bound) + 1))
+            value = rb"-(?:" + number + rb")|0*(?:" + integer_digits + rb")(?:\.\d*)?(?!\d)|\.\d+"
+    else:
+        # values with more integer digits than the bound, or as many and the same or a higher first digit
+        integer_part = str(math.floor(bound))
+        value = (rb"(?:\d{" + str(len(integer_part) + 1).encode() + rb",}|[" + integer_part[0].encode() + rb"-9]\d{"
+                 + str(len(integer_part) - 1).encode() + rb"}(?!\d))(?:\.\d*)?")
+    return re.compile(letter + rb"\s*(?P<value>" + value + rb")")
+
+
+def _line_number(source: Union[mmap.mmap, bytes], offset: int) -> int:
+    '''Count the lines in windows, as memory maps cannot count and slicing copies'''
+    window_size = 16 * 1024 * 1024
+    return sum(source[start:min(start + window_size, offset)].count(b"\n")
+               for start in range(0, offset, window_size)) + 1
+
+
+def _format_labels(labels: set[int]) -> str:
+    return ", ".join(f"N{label}" for label in sorted(labels))
@@ -1,14 +1,24 @@
+import hashlib
+import json
 from pathlib import Path
-import re
 import shutil
+import time
 import adsk.core
 import adsk.cam
 import adsk.fusion
 from . import config
 from . import fusion_utils
+from . import gcode_pipeline
+from . import gcode_transforms
 from . import hybrid_utils
 from .lib import fusion360utils as futil
+from .AdditiveTemplate import AdditiveOptions, AdditiveTemplate
+from .GcodeMerger import GcodeMerger
+from .GcodeValidator import GcodeValidator
 from .InDesignSlicer import InDeisgnSlicer
+from .JobEstimate import RunStatistics
+from .LayerIndex import LayerIndex
+from .PlanarisingIndex import PlanarisingIndex, to_microns
 from .PostProcessorConnector import PostProcessorConnector
 
 
@@ -50,82 +60,230 @@ class HybridPostProcessor:
                                                 finishing=Path.joinpath(tmp_output_folder, 'tmpFinishing.tap'),
                                                 planarising=Path.joinpath(tmp_output_folder, 'tmpDefectCorrection.tap'))
         post_processor_connector = PostProcessorConnector(self.ui, self.cam)
+        # the additive G-code is rendered from a template to reuse the last post, or to set the drying time per layer
+        use_additive_template = hybrid_post_config.reuseAdditivePost or hybrid_post_config.adaptiveDrying
         post_processor_connector.post_process_to_temp_files(combined_post_config=hybrid_post_config,
                                                             output_file_paths=temp_files,
-                                                            additiveSetup=additive_setup,
-                                                            finishingMillingSetup=finishing_milling_setup,
-                                                            planarisingSetup=None)
+                                                            additiveSetup=None if use_additive_template else additive_setup,
+                                                            finishingMillingSetup=finishing_milling_setup)
+        if use_additive_template:
+            additive_template = self._get_additive_template(additive_setup, hybrid_post_config, post_processor_connector)
+            additive_template.render(self._get_additive_options(hybrid_post_config), temp_files.additive)
+        if hybrid_post_config.optimiseTravels:
+            self._optimise_travels(temp_files.additive)
 
+        slicing_time, toolpath_count = None, None
         if hybrid_post_config.defectCorrection:
+            slicing_start_time = time.perf_counter()
             in_design_slicer = InDeisgnSlicer(self.rootComp, self.ui, self.cam, post_processor_connector)
-            # layer_height = additive_setup.printSetting.parameters(adsk.cam.PrintSettingItemTypes.GENERAL).itemByName("layer_height")
-            # futil.log(f"printsettings: {list(map(lambda p: p, additive_setup.printSetting.parameters(adsk.cam.PrintSettingItemTypes.GENERAL)))}")
-            # futil.log(f"printsettings/layer height: {layer_height}")
-            layer_height = config.LAYER_HEIGHT  # TODO: find out how to get layer height and first layer height from printsettings https://forums.autodesk.com/t5/fusion-api-and-scripts/how-to-access-printsetting-properties/td-p/12743370
+            # only the heights the additive G-code has placeholders for are sliced, whatever the layer heights
+            slicing_heights = self._get_slicing_heights(temp_files.additive)
+            futil.log(f"slicing at {len(slicing_heights)} heights")
+            toolpath_count = in_design_slicer.slice(temp_files, slicing_heights)
+            slicing_time = time.perf_counter() - slicing_start_time
+            if hybrid_post_config.optimiseRapids:
+                self._optimise_rapids(temp_files.planarising.parent)
 
-            futil.log(f"slicing with layer height: {layer_height}")
-            in_design_slicer.slice(temp_files, increment_mm=layer_height)
-
-        # read the additive gcode
-        if (temp_files.additive):
-            with open(temp_files.additive) as additive_tmp:
-                additive_gcode = ''.join(additive_tmp.readlines())
+        # index the planarising toolpaths and make sure every layer removal has one
+        planarising_index, skim_index = None, None
+        if hybrid_post_config.defectCorrection and temp_files.planarising:
+            planarising_index = PlanarisingIndex(temp_files.planarising.parent, config.PLANARISING_HEIGHT_TOLERANCE)
+            skim_index = PlanarisingIndex(temp_files.planarising.parent, config.PLANARISING_HEIGHT_TOLERANCE,
+                                          filename_pattern=PlanarisingIndex.SKIM_FILENAME_PATTERN)
+            self._check_planarising_heights(temp_files.additive, planarising_index)
+            futil.log(f"Exported {len(skim_index)} skim toolpaths for over-extrusion removal")
 
         # combine additive with milling
-        if hybrid_post_config.defectCorrection and temp_files.planarising:
-            combined_gcode_removed_placeholders1 = self._replace_layer_removal_placeholders(
-                additive_gcode, temp_files.planarising.parent)
-            combined_gcode_step2 = self._replace_overextrusion_removal_placeholders(
-                combined_gcode_removed_placeholders1, temp_files.planarising.parent)
+        gcode_merger = GcodeMerger(
+            planarising_index=planarising_index,
+            finishing_file=temp_files.finishing if hybrid_post_config.finishingMilling else None,
+            use_subprograms=hybrid_post_config.useSubprograms,
+            skim_index=skim_index)
+        transforms = self._get_transforms(hybrid_post_config)
+        combined_file = hybrid_post_config.outputFilePath
+        if transforms:
+            combined_file = tmp_output_folder.joinpath('tmpCombined.tap')
+            gcode_merger.merge(temp_files.additive, combined_file)
+            pipeline = gcode_pipeline.TransformPipeline(transforms, max_workers=config.TRANSFORM_WORKERS)
+            pipeline.run(combined_file, hybrid_post_config.outputFilePath, progress=lambda _: adsk.doEvents())
         else:
-            combined_gcode_step2 = additive_gcode
+            gcode_merger.merge(temp_files.additive, hybrid_post_config.outputFilePath)
 
-        if hybrid_post_config.finishingMilling and temp_files.finishing:
-            combined_gcode_step3 = self._replace_finishing_placeholder(combined_gcode_step2, temp_files.finishing)
-        else:
-            combined_gcode_step3 = combined_gcode_step2
+        # index the layers of the output, so that other tools do not need to parse it
+        output_file = hybrid_post_config.outputFilePath
+        layer_index = LayerIndex.build(output_file)
+        layer_index.save(LayerIndex.sidecar_path(output_file))
+        self._validate_output(output_file)
+        statistics = self._analyze_output(output_file)
 
-        # write the combined gcode to file
-        with open(hybrid_post_config.outputFilePath, 'w+') as outfile:
-            for line in combined_gcode_step3.splitlines(keepends=True):
-                outfile.write(line)
+        # measure this run before the transforms, to estimate the next one in the dialog
+        combined_index = LayerIndex.build(combined_file) if combined_file != output_file else layer_index
+        run_statistics = self._get_run_statistics(hybrid_post_config, combined_index, temp_files.additive.stat().st_size,
+                                                  slicing_time, toolpath_count, statistics)
+        if transforms:
+            run_statistics.transform_ratios[RunStatistics.transform_variant(hybrid_post_config)] = \
+                output_file.stat().st_size / combined_file.stat().st_size
+        run_statistics.save(self.doc.name)
 
         fusion_utils.show_folder(hybrid_post_config.outputFilePath.parent)
 
-    def _get_defect_correction_gcode(self, match: re.Match, planarising_files_folder: Path, throw_on_failure) -> str:
-        height = float(match.group('height'))
-        planarising_file_path = planarising_files_folder.joinpath(f"Planarising at {format(height, '.2f')}.tap")
-        if Path.exists(planarising_file_path):
-            with open(planarising_file_path) as planarising_gcode:
-                return ''.join(planarising_gcode.readlines())
-        else:
-            if throw_on_failure:
-                raise RuntimeError(f"Layer removal gcode not found at {round(height, 2)}")
-
-            return f'; Planarising toolpath does not exist at {format(height, ".2f")} for over-extrusion removal'
-
-    def _replace_layer_removal_placeholders(self, additive_gcode: str, planarising_files_folder: Path) -> str:
-        placeholder_pattern = re.compile(r";PLACEHOLDER_LAYER_REMOVAL at Z (?P<height>[\d.]+)")
-        return re.sub(placeholder_pattern,
-                      lambda match: self._get_defect_correction_gcode(
-                          match, planarising_files_folder, throw_on_failure=True),
-                      additive_gcode)
-
-    def _replace_overextrusion_removal_placeholders(self, additive_gcode: str, planarising_files_folder: Path) -> str:
-        placeholder_pattern = re.compile(r";PLACEHOLDER_OVEREXTRUSION_REMOVAL at Z (?P<height>[\d.]+)")
-        return re.sub(placeholder_pattern,
-                      lambda match: self._get_defect_correction_gcode(
-                          match, planarising_files_folder, throw_on_failure=False),
-                      additive_gcode)
-
-    def _replace_finishing_placeholder(self, additive_gcode: str, finishing_file: Path) -> str:
-
-        def get_finishing_gcode(_) -> str:
-            if Path.exists(finishing_file):
-                with open(finishing_file) as finishing_gcode:
-                    return ''.join(finishing_gcode.readlines())
-            else:
-                return f"finishing gcode {finishing_file} not found"
-
-        placeholder_pattern = re.compile(r";PLACEHOLDER_FINISHING at Z(?P<height>[\d.]+)")
-        return re.sub(placeholder_pattern, get_finishing_gcode, additive_gcode, 1)
+    def _optimise_travels(self, additive_file: Path):
+        '''Reorder the islands of each layer of the additive G-code, before the milling is inserted'''
+        try:
+            from .TravelOptimizer import TravelOptimizer
+        except ImportError:  # NumPy is not bundled with Fusion's Python
+            futil.log("NumPy is not installed, the travels were not optimised")
+            return
+        statistics = TravelOptimizer().optimise_file(additive_file)
+        futil.log(f"Travel ordering reordered {statistics.island_count} islands in {statistics.reordered_layer_count} "
+                  f"of {statistics.layer_count} layers, travels shortened from {statistics.original_distance:.0f} mm "
+                  f"to {statistics.optimised_distance:.0f} mm")
+
+    def _optimise_rapids(self, planarising_files_folder: Path):
+        '''Reorder the regions of each planarising and skim toolpath, before they are inserted into the output'''
+        try:
+            from .RapidOptimizer import RapidOptimizer
+        except ImportError:  # NumPy is not bundled with Fusion's Python
+            futil.log("NumPy is not installed, the rapids were not optimised")
+            return
+        optimiser = RapidOptimizer()
+        shortened_count, total_saved_distance = 0, 0.0
+        for toolpath_file in sorted(planarising_files_folder.iterdir()):
+            if (PlanarisingIndex.FILENAME_PATTERN.fullmatch(toolpath_file.name) is None
+                    and PlanarisingIndex.SKIM_FILENAME_PATTERN.fullmatch(toolpath_file.name) is None):
+                continue
+            result = optimiser.optimise_file(toolpath_file)
+            if result.saved_distance > 0:
+                futil.log(f"{toolpath_file.stem}: {result.region_count} regions, rapids shortened from "
+                          f"{result.original_distance:.1f} mm to {result.optimised_distance:.1f} mm")
+                shortened_count += 1
+                total_saved_distance += result.saved_distance
+        futil.log(f"Rapid ordering shortened {shortened_count} planarising toolpaths by {total_saved_distance:.1f} mm, "
+                  "saved by every insert of each toolpath")
+
+    def _validate_output(self, output_file: Path):
+        '''Log every issue with the output, and show the errors'''
+        validator = GcodeValidator(printing_z_min=config.PRINTING_Z_MIN,
+                                   milling_z_min=config.MILLING_Z_MIN,
+                                   printing_feed_max=config.PRINTING_FEED_MAX,
+                                   milling_feed_max=config.MILLING_FEED_MAX)
+        issues = validator.validate(output_file)
+        for issue in issues:
+            futil.log(str(issue))
+        errors = [issue for issue in issues if issue.is_error]
+        if errors:
+            fusion_utils.messageBox(self.ui, f"{output_file.name} was written, but may not run correctly:\n"
+                                    + "\n".join(map(str, errors)),
+                                    "G-code validation", icon=adsk.core.MessageBoxIconTypes.WarningIconType)
+
+    def _analyze_output(self, output_file: Path):
+        '''Log and return the estimated machine time, distances and extrusion of the output, or None without NumPy'''
+        try:
+            from .GcodeAnalyzer import GcodeAnalyzer
+        except ImportError:  # NumPy is not bundled with Fusion's Python
+            futil.log("NumPy is not installed, the output was not analysed")
+            return None
+        analyzer = GcodeAnalyzer(config.RAPID_FEED, max_workers=config.TRANSFORM_WORKERS)
+        statistics = analyzer.analyze(output_file)
+        futil.log(statistics.report())
+        return statistics
+
+    def _get_run_statistics(self, hybrid_post_config: hybrid_utils.HybridPostConfig, layer_index: LayerIndex,
+                            additive_size: int, slicing_time, toolpath_count, statistics) -> RunStatistics:
+        '''Features that were off are not measured (None)'''
+        inserts = [insert for layer in layer_index.layers for insert in layer.inserts] + layer_index.subprograms
+        run_statistics = RunStatistics(
+            layer_count=len(layer_index.layers),
+            additive_size=additive_size,
+            defect_correction_sizes={RunStatistics.merge_variant(hybrid_post_config):
+                                     sum(insert.end - insert.start for insert in inserts if insert.kind != 'FINISHING')}
+            if hybrid_post_config.defectCorrection else {},
+            finishing_size=sum(insert.end - insert.start for insert in inserts if insert.kind == 'FINISHING')
+            if hybrid_post_config.finishingMilling else None,
+            slicing_time=slicing_time,
+            toolpath_count=toolpath_count)
+        if statistics is not None:
+            run_statistics.print_time = statistics.print_time
+            run_statistics.layer_print_times = [layer.print_time for layer in statistics.layers]
+            run_statistics.other_time = statistics.other_time
+            if hybrid_post_config.finishingMilling:
+                run_statistics.finishing_time = sum(insert.time for insert in statistics.inserts
+                                                    if insert.kind == 'FINISHING')
+        return run_statistics
+
+    def _get_transforms(self, hybrid_post_config: hybrid_utils.HybridPostConfig) -> list[gcode_transforms.Transform]:
+        '''The transforms to apply to the combined G-code, in order'''
+        transforms: list[gcode_transforms.Transform] = []
+        if hybrid_post_config.fitArcs:
+            transforms.append(gcode_transforms.ArcFitter(config.ARC_FITTING_TOLERANCE))
+        if hybrid_post_config.minifyOutput:
+            transforms.append(gcode_transforms.Minifier())
+        return transforms
+
+    def _get_additive_template(self,
+                               additive_setup: adsk.cam.Setup,
+                               hybrid_post_config: hybrid_utils.HybridPostConfig,
+                               post_processor_connector: PostProcessorConnector) -> AdditiveTemplate:
+        '''Post the additive setup with template markers, or reuse the last template posted for the document'''
+        config.CACHE_FOLDER.mkdir(parents=True, exist_ok=True)
+        template_file = hybrid_utils.get_cache_path(self.doc.name, "additive template.gcode")
+        key_file = template_file.with_suffix('.json')
+        # a template is only reused for the same saved version of the document and the same toolpath parameters,
+        # posted with the same post processor
+        key = {"document": self.doc.name,
+               "version": self.doc.dataFile.versionNumber if self.doc.dataFile is not None else None,
+               "setup": additive_setup.name,
+               "toolpath": self._get_toolpath_fingerprint(additive_setup),
+               "postProcessorModified": config.ADDITIVE_POST_PROCESSOR_PATH.stat().st_mtime}
+        if hybrid_post_config.reuseAdditivePost and self.doc.isModified:
+            futil.log("The document has unsaved changes, the additive setup is posted again")
+        elif hybrid_post_config.reuseAdditivePost and template_file.exists() and key_file.exists() \
+                and json.loads(key_file.read_text()) == key:
+            futil.log(f"Reusing additive template {template_file}")
+            return AdditiveTemplate(template_file, config.RAPID_FEED, config.TRANSFORM_WORKERS)
+
+        key_file.unlink(missing_ok=True)
+        post_processor_connector.post_process_to_temp_files(
+            combined_post_config=hybrid_post_config,
+            output_file_paths=hybrid_utils.TempFilePaths(additive=template_file, finishing=None, planarising=None),
+            additiveSetup=additive_setup,
+            additive_template=True)
+        key_file.write_text(json.dumps(key))
+        return AdditiveTemplate(template_file, config.RAPID_FEED, config.TRANSFORM_WORKERS)
+
+    def _get_toolpath_fingerprint(self, setup: adsk.cam.Setup) -> str:
+        '''Hash of the parameters of the setup and its operations, which change when the toolpath is edited'''
+        fingerprint = hashlib.sha1()
+        for item in [setup] + list(setup.allOperations):
+            fingerprint.update(item.name.encode())
+            for parameter in item.parameters:
+                fingerprint.update(f"{parameter.name}={parameter.expression};".encode())
+        return fingerprint.hexdigest()
+
+    def _get_additive_options(self, hybrid_post_config: hybrid_utils.HybridPostConfig) -> AdditiveOptions:
+        return AdditiveOptions(useImaging=hybrid_post_config.useImaging,
+                               laserScanning=hybrid_post_config.laserScanning,
+                               collectLoadCellData=hybrid_post_config.collectLoadCellData,
+                               dryingTime=hybrid_post_config.dryingTime,
+                               adaptiveDrying=hybrid_post_config.adaptiveDrying,
+                               finishing=hybrid_post_config.finishingMilling,
+                               defectCorrection=hybrid_post_config.defectCorrection,
+                               firstCorrectionLayer=hybrid_post_config.firstCorrectionLayer)
+
+    def _get_slicing_heights(self, additive_file: Path) -> list[float]:
+        '''Every height with a layer or over-extrusion removal placeholder in the additive G-code, once each'''
+        placeholders = GcodeMerger.find_placeholders(additive_file)
+        heights_um = {to_microns(p.height) for p in placeholders if p.kind in ('LAYER_REMOVAL', 'OVEREXTRUSION_REMOVAL')}
+        return [height_um / 1000 for height_um in sorted(heights_um)]
+
+    def _check_planarising_heights(self, additive_file: Path, planarising_index: PlanarisingIndex):
+        '''Raise an error listing every layer removal height without a planarising toolpath'''
+        placeholders = GcodeMerger.find_placeholders(additive_file)
+        missing_layer_removals = planarising_index.missing_heights(
+            p.height for p in placeholders if p.kind == 'LAYER_REMOVAL')
+        missing_overextrusion_removals = planarising_index.missing_heights(
+            p.height for p in placeholders if p.kind == 'OVEREXTRUSION_REMOVAL')
+        if missing_overextrusion_removals:
+            futil.log(f"No over-extrusion removal toolpath at Z {', '.join(format(h, '.2f') for h in missing_overextrusion_removals)}")
+        if missing_layer_removals:
+            raise RuntimeError(f"Layer removal gcode not found at Z {', '.join(format(h, '.2f') for h in missing_layer_removals)}")
@@ -1,3 +1,4 @@
+from decimal import Decimal
 from pathlib import Path
 import time
 import adsk.core
@@ -8,8 +9,11 @@ from . import fusion_utils
 from . import hybrid_utils
 from .lib import fusion360utils as futil
 from . import cam_setup_utils
-from .MaskingExtrusion import MaskingExtrusion
+from . import gcode_utils
+from .PlanarisingIndex import group_by_section, to_microns
 from .PostProcessorConnector import PostProcessorConnector
+from .SetupPool import SetupPool
+from .SliceComponent import Section, SliceComponent
 
 
 class InDeisgnSlicer:
@@ -23,75 +27,175 @@ class InDeisgnSlicer:
         self.cam = cam
         self.post_processor_connector = post_processor_connector
 
-    def slice(self, temp_files: hybrid_utils.TempFilePaths, increment_mm: float = 2):
-        """Slice the part by creating a temporary extrusion in the Design workspace, and export toolpaths for planarising/defect correction operations"""
+    def slice(self, temp_files: hybrid_utils.TempFilePaths, slicing_heights: list[float]) -> int:
+        """Slice the part in a dedicated component in the Design workspace, and export toolpaths for planarising/defect correction operations.
+        The part is sliced once at each of the passed in heights, from top to bottom. Heights with the same cross-section
+        as a height that was already sliced get its toolpaths shifted in Z instead. Returns the number of heights that
+        toolpaths were generated at.
+        The part is sliced at a batch of config.SLICING_BATCH_SIZE heights at a time, and the toolpaths of the batch are
+        generated in parallel and posted together, so the post engine starts once per batch rather than once per height.
+        The setups are kept in a pool for the whole slicing loop, one for each section sliced at the same time, and are
+        reset in place after a defective toolpath."""
         assert temp_files.planarising is not None
         planrising_generation_start_time = time.time()
 
-        setup = cam_setup_utils.create_face_milling_setup(self.cam,
-                                                          self.rootComp,
-                                                          f"Defect corr.")
-        if setup is None:
-            raise Exception("Defect correction setup could not be created")
-        futil.log(f"setup: {setup.name}, ops: {setup.operations[0].name}")
-        operation = setup.operations[0]
-        component = adsk.fusion.Occurrence.cast(setup.models.item(0)).component
+        occurrence = cam_setup_utils.get_milling_model_occurrence(self.cam)
+        component = occurrence.component
+        slice_component = SliceComponent(occurrence, max(1, config.SLICING_BATCH_SIZE))
+        setup_pool = SetupPool(self.cam, slice_component)
         max_Z = component.boundingBox.maxPoint.z*10
+        section_bands = group_by_section(slicing_heights, self._get_section_changes(component),
+                                         config.PLANARISING_HEIGHT_TOLERANCE)
+        tool_diameter = cam_setup_utils.get_template_tool_diameter()
 
-        slicing_extrusion = MaskingExtrusion(self.ui, component)
         futil.log(f"COMP: {component.name}")
         progress_bar = self.ui.createProgressDialog()
         progress_bar.show("Generating toolpaths", "Generating defect correction toolpaths",
-                          0, round((max_Z - config.RAFT_HEIGHT) / increment_mm))
-
-        for milling_height in self._generate_slicing_heights(max_Z, config.RAFT_HEIGHT, increment_mm):
-            if setup is None:
-                setup = cam_setup_utils.create_face_milling_setup(self.cam,
-                                                          self.rootComp,
-                                                          f"Defect corr.")
-                if setup is None:
-                    raise Exception("Defect correction setup could not be created")
-                futil.log(f"setup: {setup.name}, ops: {setup.operations[0].name}")
-                operation = setup.operations[0]
-            progress_bar.progressValue += 1
+                          0, len(slicing_heights))
+
+        folder = temp_files.planarising.parent
+        try:
+            sliced_heights = self._slice_in_batches(slice_component, setup_pool, slicing_heights, section_bands,
+                                                    max_Z, tool_diameter, folder, progress_bar)
+        finally:
+            setup_pool.deleteMe()
+            slice_component.deleteMe()
+
+        # the other heights of each cross-section get the toolpaths of the height it was sliced at
+        for milling_height in slicing_heights:
+            band = section_bands[milling_height]
+            if band in sliced_heights and sliced_heights[band] != milling_height:
+                self._write_shifted_toolpaths(folder, sliced_heights[band], milling_height)
+        progress_bar.progressValue = progress_bar.maximumValue
+        futil.log(
+            f"Generated {len(slicing_heights)} toolpaths from {len(sliced_heights)} cross-sections in {round(time.time()-planrising_generation_start_time, 2)} seconds", force_console=True)
+        return len(sliced_heights)
+
+    def _slice_in_batches(self,
+                          slice_component: SliceComponent,
+                          setup_pool: SetupPool,
+                          slicing_heights: list[float],
+                          section_bands: dict[float, int],
+                          max_Z: float,
+                          tool_diameter: float,
+                          folder: Path,
+                          progress_bar: adsk.core.ProgressDialog) -> dict[int, float]:
+        '''Add a section of the part at each height of a batch, each in its own slot of the slice component with its setup
+        from the pool, and generate the toolpaths of the batch with a single call, which Fusion runs in parallel. Returns
+        the height each band was sliced at.'''
+        sliced_heights: dict[int, float] = {}
+        bands_without_pocket: set[int] = set()
+        remaining_heights = sorted(slicing_heights, reverse=True)
+
+        while True:
+            # one height of each band that has not been sliced yet, from the top
+            batch: dict[int, float] = {}
+            for milling_height in remaining_heights:
+                band = section_bands[milling_height]
+                if band not in sliced_heights and band not in bands_without_pocket and band not in batch:
+                    batch[band] = milling_height
+                    if len(batch) == config.SLICING_BATCH_SIZE:
+                        break
+            if not batch:
+                break
+            remaining_heights = [h for h in remaining_heights if h not in batch.values()]
             if progress_bar.wasCancelled:
                 raise Exception("Cancelled by user")
-            futil.log(f"milling height: {milling_height}", force_console=True)
-
-            if milling_height == config.RAFT_HEIGHT:
-                # a hack for machining the first layer. Otherwise no intersection exists between the part and the slicing extrusion. TODO: select the bottom face instead.
-                milling_height_offset = 0.01
-            elif milling_height == max_Z:
-                milling_height_offset = -0.01  # a hack for machining the top layer. Otherwise no top face might exist
-            else:
-                milling_height_offset = 0
-            slicing_extrusion.set_height(milling_height + milling_height_offset)
-
-            cam_setup_utils._try_update_adaptive2d_face(self.cam, component, setup, operation)
-
-            if not self.cam.checkToolpath(setup.allOperations):
-                futil.log("defective toolpath", force_console=True)
-                setup.deleteMe()
-                setup = None
-                futil.log("Setup deleted")
-
-                continue
-
-            temp_files.planarising = Path.joinpath(temp_files.planarising.parent,
-                                                   f"Planarising at {format(milling_height, '.2f')}.tap")
-            self.post_processor_connector.post_process_to_temp_files(hybrid_utils.HybridPostConfig(defectCorrection=True),
-                                                                     temp_files, planarisingSetup=setup)
-        if setup is not None:
-            setup.deleteMe()
-        slicing_extrusion.deleteMe()
-        futil.log(
-            f"Generated {round(max_Z / increment_mm)} toolpaths in {round(time.time()-planrising_generation_start_time, 2)} seconds", force_console=True)
-
-    def _generate_slicing_heights(self, full_height: float, min_height: float, layer_height: float):
-        '''Generate slicing heights from top to bottom'''
-        assert (full_height >= min_height and layer_height > 0)
-        top_layer_height = layer_height * round(full_height / layer_height)
-        height = top_layer_height
-        while round(height, 2) >= round(min_height, 2):
-            yield round(height, 2)
-            height -= layer_height
+            futil.log(f"milling heights: {', '.join(str(h) for h in batch.values())}", force_console=True)
+
+            sections: list[Section] = []
+            setups: dict[int, adsk.cam.Setup] = {}
+            slots: dict[int, int] = {}
+            defective_slots: list[int] = []
+            try:
+                for slot, (band, milling_height) in enumerate(batch.items()):
+                    progress_bar.progressValue += 1
+                    slicing_height = self._get_slicing_height(milling_height, max_Z)
+                    sections.append(slice_component.add_section(slicing_height, slot))
+                    section_bodies = sections[-1].bodies
+                    if not cam_setup_utils.has_pocket(section_bodies, min(slicing_height, max_Z), tool_diameter):
+                        futil.log(f"no pocket at {milling_height}", force_console=True)
+                        bands_without_pocket.add(band)
+                        continue
+                    setups[band], slots[band] = setup_pool.get(slot), slot
+                    cam_setup_utils._select_top_face(section_bodies, setups[band], setups[band].operations[0])
+
+                operations = adsk.core.ObjectCollection.create()
+                for setup in setups.values():
+                    for operation in setup.operations:
+                        operations.add(operation)
+                if operations.count > 0:
+                    future = self.cam.generateToolpath(operations)
+                    while not future.isGenerationCompleted:
+                        adsk.doEvents()
+
+                slice_operations = []
+                for band, setup in setups.items():
+                    operations_of_height = self._get_slice_operations(setup, batch[band])
+                    if operations_of_height:
+                        slice_operations += operations_of_height
+                        sliced_heights[band] = batch[band]
+                    else:
+                        defective_slots.append(slots[band])
+                if slice_operations:
+                    self.post_processor_connector.post_process_slices(slice_operations, folder)
+            finally:
+                # the setups stay in the pool for the next batch, only the sections are replaced, and the setups of
+                # defective toolpaths are reset
+                for slot in defective_slots:
+                    setup_pool.reset(slot)
+                for section in sections:
+                    section.deleteMe()
+        return sliced_heights
+
+    def _get_slicing_height(self, milling_height: float, max_Z: float) -> float:
+        '''Height to slice the part at for the milling height'''
+        if milling_height <= config.RAFT_HEIGHT + config.PLANARISING_HEIGHT_TOLERANCE:
+            # a hack for machining the first layer. Otherwise no intersection exists between the part and the slicing extrusion. TODO: select the bottom face instead.
+            return milling_height + 0.01
+        elif milling_height >= max_Z - config.PLANARISING_HEIGHT_TOLERANCE:
+            return milling_height - 0.01  # a hack for machining the top layer. Otherwise no top face might exist
+        return milling_height
+
+    def _get_slice_operations(self, setup: adsk.cam.Setup, milling_height: float) -> list[adsk.cam.Operation]:
+        '''The generated operations of the setup, renamed after the files they are posted to, or none if the
+        planarising toolpath is defective'''
+        operation = setup.operations[0]
+        if not self.cam.checkToolpath(operation):
+            futil.log("defective toolpath", force_console=True)
+            return []
+        operation.name = f"Planarising at {format(milling_height, '.2f')}"
+        slice_operations = [operation]
+        # the skim is optional, over-extrusion removals fall back to the planarising toolpath without it
+        skim_operation = cam_setup_utils.get_skim_operation(setup)
+        if skim_operation is not None and self.cam.checkToolpath(skim_operation):
+            skim_operation.name = f"Skim at {format(milling_height, '.2f')}"
+            slice_operations.append(skim_operation)
+        else:
+            futil.log("defective skim toolpath", force_console=True)
+        return slice_operations
+
+    def _get_section_changes(self, component: adsk.fusion.Component) -> list[tuple[float, float]]:
+        '''Z ranges (mm) of the faces of the part that are not vertical, where its cross-section changes'''
+        return [(face.boundingBox.minPoint.z*10, face.boundingBox.maxPoint.z*10)
+                for body in component.bRepBodies for face in body.faces if not _is_vertical(face)]
+
+    def _write_shifted_toolpaths(self, folder: Path, sliced_height: float, milling_height: float):
+        '''Write the toolpaths of the sliced height at the milling height, which has the same cross-section'''
+        offset = Decimal(to_microns(milling_height) - to_microns(sliced_height)) / 1000
+        for prefix in ("Planarising at", "Skim at"):
+            sliced_file = folder.joinpath(f"{prefix} {format(sliced_height, '.2f')}.tap")
+            if sliced_file.exists():
+                folder.joinpath(f"{prefix} {format(milling_height, '.2f')}.tap").write_bytes(
+                    gcode_utils.shift_z(sliced_file.read_bytes(), offset))
+
+
+def _is_vertical(face: adsk.fusion.BRepFace) -> bool:
+    '''Vertical planes and cylinders do not change the cross-section, other faces are assumed to'''
+    plane = adsk.core.Plane.cast(face.geometry)
+    if plane is not None:
+        return abs(plane.normal.z) < 1e-9
+    cylinder = adsk.core.Cylinder.cast(face.geometry)
+    if cylinder is not None:
+        return abs(cylinder.axis.x) < 1e-9 and abs(cylinder.axis.y) < 1e-9
+    return False
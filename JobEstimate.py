@@ -0,0 +1,124 @@
+from dataclasses import asdict, dataclass, field, fields
+import json
+import math
+from pathlib import Path
+from typing import Optional
+from . import hybrid_utils
+
+
+@dataclass
+class RunStatistics:
+    '''Measured on the last post of a document and saved in the cache folder, so that the Hybrid Post Process dialog
+    can estimate the cost of the selected options without computing anything.
+    Values of features that were off in the last run are kept from the run before, and so are the sizes of the output
+    variants (with or without subprograms, and each combination of output transforms) that were not posted.
+    Sizes are measured before the output transforms, which scale the output by the ratio measured for them.'''
+    layer_count: int = 0
+    additive_size: int = 0  # bytes
+    # bytes of the defect correction inserts and subprograms, by merge variant (see merge_variant)
+    defect_correction_sizes: dict[str, int] = field(default_factory=dict)
+    finishing_size: Optional[int] = None  # bytes
+    # size of the output over its size before the transforms, by transform variant (see transform_variant)
+    transform_ratios: dict[str, float] = field(default_factory=dict)
+    slicing_time: Optional[float] = None  # s, to slice the part and generate and post the defect correction toolpaths
+    toolpath_count: Optional[int] = None  # defect correction toolpaths generated, once per cross-section
+    print_time: Optional[float] = None  # s, None when the output was not analysed
+    layer_print_times: list[float] = field(default_factory=list)
+    finishing_time: Optional[float] = None  # s
+    other_time: Optional[float] = None  # s, moves outside the layers, e.g. the header
+
+    @staticmethod
+    def merge_variant(hybrid_config: hybrid_utils.HybridPostConfig) -> str:
+        return "subprograms" if hybrid_config.useSubprograms else "inline"
+
+    @staticmethod
+    def transform_variant(hybrid_config: hybrid_utils.HybridPostConfig) -> str:
+        '''The output transforms selected, empty for none'''
+        return "+".join(name for name, is_selected in (("fitArcs", hybrid_config.fitArcs),
+                                                       ("minify", hybrid_config.minifyOutput)) if is_selected)
+
+    @staticmethod
+    def path(document_name: str) -> Path:
+        return hybrid_utils.get_cache_path(document_name, "last run.json")
+
+    @classmethod
+    def load(cls, document_name: str) -> Optional['RunStatistics']:
+        '''Returns the statistics of the last run of the document, or None if it has not been posted yet'''
+        try:
+            data = json.loads(cls.path(document_name).read_text())
+            return cls(**{statistic.name: data[statistic.name] for statistic in fields(cls) if statistic.name in data})
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def save(self, document_name: str):
+        previous = RunStatistics.load(document_name)
+        if previous is not None:
+            for statistic in fields(self):
+                value = getattr(self, statistic.name)
+                if value is None:
+                    setattr(self, statistic.name, getattr(previous, statistic.name))
+                elif isinstance(value, dict):
+                    setattr(self, statistic.name, {**getattr(previous, statistic.name), **value})
+        self.path(document_name).parent.mkdir(parents=True, exist_ok=True)
+        self.path(document_name).write_text(json.dumps(asdict(self)))
+
+
+@dataclass
+class JobEstimate:
+    '''Cost of the options selected in the Hybrid Post Process dialog, None where it has not been measured yet'''
+    slicing_time: Optional[float]  # s
+    toolpath_count: Optional[int]
+    output_size: Optional[int]  # bytes
+    machine_time: Optional[float]  # s, without corrections
+
+    @classmethod
+    def estimate(cls, statistics: RunStatistics, hybrid_config: hybrid_utils.HybridPostConfig) -> 'JobEstimate':
+        '''Only adds up the statistics, so that it can run every time an input of the dialog changes'''
+        slicing_time, toolpath_count = (statistics.slicing_time, statistics.toolpath_count) \
+            if hybrid_config.defectCorrection else (0, 0)
+        output_size = _add(statistics.additive_size,
+                           statistics.defect_correction_sizes.get(RunStatistics.merge_variant(hybrid_config))
+                           if hybrid_config.defectCorrection else 0,
+                           statistics.finishing_size if hybrid_config.finishingMilling else 0)
+        transform_variant = RunStatistics.transform_variant(hybrid_config)
+        transform_ratio = statistics.transform_ratios.get(transform_variant) if transform_variant else 1
+        output_size = None if output_size is None or transform_ratio is None else round(output_size * transform_ratio)
+        machine_time = _add(statistics.print_time, statistics.other_time,
+                            cls._drying_time(statistics, hybrid_config),
+                            statistics.finishing_time if hybrid_config.finishingMilling else 0)
+        return cls(slicing_time, toolpath_count, output_size, machine_time)
+
+    @staticmethod
+    def _drying_time(statistics: RunStatistics, hybrid_config: hybrid_utils.HybridPostConfig) -> Optional[float]:
+        '''See AdditiveTemplate for adaptive drying'''
+        if hybrid_config.dryingTime <= 0:
+            return 0
+        if not hybrid_config.adaptiveDrying:
+            return hybrid_config.dryingTime * statistics.layer_count
+        if len(statistics.layer_print_times) != statistics.layer_count:
+            return None
+        return sum(max(0, math.ceil(hybrid_config.dryingTime - layer_time)) for layer_time in statistics.layer_print_times)
+
+    def __str__(self) -> str:
+        slicing = "none" if self.toolpath_count == 0 else \
+            f"{_format_duration(self.slicing_time)} ({_format(self.toolpath_count)} toolpaths)"
+        size = "unknown" if self.output_size is None else f"{self.output_size / 1024 / 1024:.1f} MB"
+        return "\n".join([f"Slicing: {slicing}",
+                          f"Output size: {size}",
+                          f"Machine time: {_format_duration(self.machine_time)} without corrections"])
+
+
+def _add(*values: Optional[float]) -> Optional[float]:
+    return None if any(value is None for value in values) else sum(values)  # type: ignore
+
+
+def _format(value) -> str:
+    return "unknown" if value is None else str(value)
+
+
+def _format_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "unknown"
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
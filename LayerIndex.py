@@ -0,0 +1,146 @@
+from bisect import bisect_left
+from dataclasses import asdict, dataclass, field
+import json
+import mmap
+from pathlib import Path
+import re
+from typing import Optional, Union
+from .GcodeMerger import map_file
+
+SIDECAR_SUFFIX = ".index.json"
+
+
+@dataclass
+class MillingInsert:
+    kind: str  # LAYER_REMOVAL, OVEREXTRUSION_REMOVAL, FINISHING or SUBPROGRAM
+    z: Optional[float]
+    start: int  # byte offset of the start marker
+    end: int  # byte offset after the end marker
+
+
+@dataclass
+class Layer:
+    number: int
+    start: int  # byte offset of the layer comment
+    end: int  # byte offset of the next layer comment, or the end of the file
+    z: Optional[float]
+    last_a: Optional[float]  # ceramic extrusion (absolute) at the end of the layer
+    labels: list[int] = field(default_factory=list)  # N labels used as GOTO targets by the defect correction blocks
+    inserts: list[MillingInsert] = field(default_factory=list)
+
+
+@dataclass
+class LayerIndex:
+    '''Byte offsets and state of each layer of a combined program, saved in a sidecar file next to the program,
+    so that other tools (camera software, resuming, validation) can seek straight to a layer without parsing the G-code.
+    Layers start at their ";Layer n of m" comment, so a layer also contains the end of layer block of the layer before
+    it (drying, photos, defect correction), which is where the Z of the previous layer is written as #622.'''
+
+    file_size: int
+    layer_count: int
+    layers: list[Layer]
+    subprograms: list[MillingInsert]  # milling inserts that are subprograms after the end of the main program
+
+    LAYER_PATTERN = re.compile(rb"^;\s*Layer (?P<number>\d+) of (?P<count>\d+)", re.MULTILINE)
+    SCAN_PATTERN = re.compile(rb"#622=(?P<z>[-+]?[\d.]+)"
+                              rb"|^N(?P<label>\d+)\s*$"
+                              rb"|^;MILLING_INSERT_(?P<marker>START|END)(?P<marker_words>[^\r\n]*)", re.MULTILINE)
+    A_WORD_PATTERN = re.compile(rb"A\s*(?P<value>[-+]?(?:\d+\.?\d*|\.\d+))")
+    # lines that set A without extruding, e.g. the pressure increase and A reset of the defect correction blocks
+    A_RESET_PATTERN = re.compile(rb"G0*9[12](?![.\d])")
+
+    @classmethod
+    def build(cls, gcode_file: Path) -> 'LayerIndex':
+        with open(gcode_file, 'rb') as gcode, map_file(gcode) as source:
+            return cls._build(source)
+
+    @classmethod
+    def _build(cls, source: Union[mmap.mmap, bytes]) -> 'LayerIndex':
+        layer_matches = list(cls.LAYER_PATTERN.finditer(source))
+        layer_count = int(layer_matches[-1].group('count')) if layer_matches else 0
+        layers = [Layer(int(match.group('number')), match.start(),
+                        layer_matches[i + 1].start() if i + 1 < len(layer_matches) else len(source), None, None)
+                  for i, match in enumerate(layer_matches)]
+
+        z_values: list[tuple[int, float]] = []
+        subprograms: list[MillingInsert] = []
+        insert: Optional[MillingInsert] = None
+        layer_number = -1  # position in layers, -1 while in the header
+        for match in cls.SCAN_PATTERN.finditer(source):
+            while layer_number + 1 < len(layers) and layers[layer_number + 1].start <= match.start():
+                layer_number += 1
+            if match.group('z') is not None:
+                z_values.append((match.start(), float(match.group('z'))))
+            elif match.group('label') is not None and layer_number >= 0:
+                layers[layer_number].labels.append(int(match.group('label')))
+            elif match.group('marker') == b"START":
+                insert = _parse_insert(match)
+                if insert.kind == 'SUBPROGRAM':
+                    subprograms.append(insert)
+                elif layer_number >= 0:
+                    layers[layer_number].inserts.append(insert)
+            elif insert is not None:
+                insert.end = match.end()
+                insert = None
+
+        # the Z of a layer is written at the end of the layer, i.e. the first #622 of the next layer
+        z_offsets = [offset for offset, _ in z_values]
+        for layer_number, layer in enumerate(layers):
+            if layer_number + 1 < len(layers):
+                next_layer = layers[layer_number + 1]
+                position = bisect_left(z_offsets, next_layer.start)
+                if position < len(z_values) and z_offsets[position] < next_layer.end:
+                    layer.z = z_values[position][1]
+            elif z_values and z_offsets[-1] >= layer.start:
+                layer.z = z_values[-1][1]  # written by the end of the program
+            layer.last_a = cls._find_last_a(source, layer.start, layer.end)
+        return cls(len(source), layer_count, layers, subprograms)
+
+    @classmethod
+    def _find_last_a(cls, source: Union[mmap.mmap, bytes], start: int, end: int) -> Optional[float]:
+        '''Search the layer backwards for the last move with an A word'''
+        position = end
+        while True:
+            position = source.rfind(b"A", start, position)
+            if position == -1:
+                return None
+            line_start = source.rfind(b"\n", start, position) + 1 or start
+            line_end = source.find(b"\n", position, end)
+            line = source[line_start:line_end if line_end != -1 else end]
+            code = re.split(rb"[;(]", line, maxsplit=1)[0]
+            a_words = list(cls.A_WORD_PATTERN.finditer(code))
+            if a_words and cls.A_RESET_PATTERN.search(code) is None:
+                return float(a_words[-1].group('value'))
+            position = line_start
+
+    def layer(self, number: int) -> Optional[Layer]:
+        '''Returns the layer with the passed in number (1-based), or None if it is not in the program'''
+        if 1 <= number <= len(self.layers) and self.layers[number - 1].number == number:
+            return self.layers[number - 1]
+        return next((layer for layer in self.layers if layer.number == number), None)
+
+    @staticmethod
+    def sidecar_path(gcode_file: Path) -> Path:
+        '''e.g. part.tap -> part.tap.index.json'''
+        return gcode_file.with_name(gcode_file.name + SIDECAR_SUFFIX)
+
+    def save(self, path: Path):
+        with open(path, 'w') as file:
+            json.dump(asdict(self), file, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, path: Path) -> 'LayerIndex':
+        with open(path) as file:
+            data = json.load(file)
+        return cls(data['file_size'], data['layer_count'],
+                   [Layer(**{**layer, 'inserts': [MillingInsert(**insert) for insert in layer['inserts']]})
+                    for layer in data['layers']],
+                   [MillingInsert(**insert) for insert in data['subprograms']])
+
+
+def _parse_insert(match: re.Match) -> MillingInsert:
+    '''e.g. ";MILLING_INSERT_START LAYER_REMOVAL at Z 1.20" or ";MILLING_INSERT_START SUBPROGRAM"'''
+    words = match.group('marker_words').decode().split()
+    kind = words[0] if words else ""
+    z = float(words[-1]) if len(words) >= 4 and words[-2] == "Z" else None
+    return MillingInsert(kind, z, match.start(), match.end())
@@ -0,0 +1,101 @@
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+import os
+from pathlib import Path
+import re
+from typing import Iterable, Optional
+
+
+class PlanarisingIndex:
+    '''Index of the planarising toolpaths exported by the slicer, keyed by height in integer microns.
+    The folder is scanned once, and lookups find the nearest height within a tolerance, so that rounding differences
+    between the slicer and the additive post processor do not cause missing toolpaths.
+    The same file is referenced by the over-extrusion removal of one layer and the layer removal of the next one,
+    so the contents of the most recently used files are kept in memory and each file is read only once.
+    The skim toolpaths for over-extrusion removal are exported alongside, and indexed with SKIM_FILENAME_PATTERN.'''
+
+    FILENAME_PATTERN = re.compile(r"Planarising at (?P<height>-?[\d.]+)\.tap")
+    SKIM_FILENAME_PATTERN = re.compile(r"Skim at (?P<height>-?[\d.]+)\.tap")
+
+    def __init__(self, planarising_files_folder: Path, tolerance_mm: float = 0.01, cache_size: int = 4,
+                 filename_pattern: re.Pattern = FILENAME_PATTERN) -> None:
+        self.folder = planarising_files_folder
+        self.filename_pattern = filename_pattern
+        self.tolerance_um = to_microns(tolerance_mm)
+        self.cache_size = cache_size
+        self._paths: dict[int, Path] = {}
+        self._contents: OrderedDict[int, bytes] = OrderedDict()
+
+        with os.scandir(planarising_files_folder) as entries:
+            for entry in entries:
+                match = self.filename_pattern.fullmatch(entry.name)
+                if match is not None and entry.is_file():
+                    self._paths[to_microns(float(match.group('height')))] = Path(entry.path)
+        self._heights = sorted(self._paths)
+
+    def __len__(self):
+        return len(self._heights)
+
+    def find(self, height_mm: float) -> Optional[int]:
+        '''Returns the indexed height (in microns) closest to the passed in height, or None if none is within tolerance'''
+        height = to_microns(height_mm)
+        position = bisect_left(self._heights, height)
+        candidates = self._heights[max(position - 1, 0):position + 1]
+        nearest = min(candidates, key=lambda h: abs(h - height), default=None)
+        if nearest is None or abs(nearest - height) > self.tolerance_um:
+            return None
+        return nearest
+
+    def path(self, height_mm: float) -> Optional[Path]:
+        '''Returns the path of the planarising G-code at the passed in height, or None if it does not exist'''
+        height = self.find(height_mm)
+        return self._paths[height] if height is not None else None
+
+    def read(self, height_mm: float) -> Optional[bytes]:
+        '''Returns the planarising G-code at the passed in height, or None if it does not exist'''
+        height = self.find(height_mm)
+        if height is None:
+            return None
+        if height in self._contents:
+            self._contents.move_to_end(height)
+            return self._contents[height]
+
+        with open(self._paths[height], 'rb') as planarising_gcode:
+            gcode = planarising_gcode.read()
+        self._contents[height] = gcode
+        if len(self._contents) > self.cache_size:
+            self._contents.popitem(last=False)
+        return gcode
+
+    def missing_heights(self, heights_mm: Iterable[float]) -> list[float]:
+        '''Returns the heights that have no planarising toolpath, in ascending order'''
+        return sorted({h for h in heights_mm if self.find(h) is None})
+
+
+def to_microns(height_mm: float) -> int:
+    return round(height_mm * 1000)
+
+
+def group_by_section(heights: list[float], section_changes: list[tuple[float, float]], tolerance_mm: float) -> dict[float, int]:
+    '''Number the bands of consecutive heights that no section change lies between, from top to bottom'''
+    changes: list[list[float]] = []
+    for low, high in sorted(section_changes):
+        if changes and low - tolerance_mm <= changes[-1][1]:
+            changes[-1][1] = max(changes[-1][1], high + tolerance_mm)
+        else:
+            changes.append([low - tolerance_mm, high + tolerance_mm])
+    change_starts = [low for low, _ in changes]
+
+    bands: dict[float, int] = {}
+    band, previous_height = -1, None
+    for height in sorted(set(heights), reverse=True):
+        if previous_height is None:
+            band += 1
+        else:
+            # the last change starting below the previous height is the only one that can reach down to this height
+            last_change = bisect_right(change_starts, previous_height) - 1
+            if last_change >= 0 and changes[last_change][1] >= height:
+                band += 1
+        bands[height] = band
+        previous_height = height
+    return bands
@@ -9,6 +9,7 @@ from . import fusion_utils
 from . import hybrid_utils
 from .lib import fusion360utils as futil
 from . import config
+from .SliceSplitter import SliceSplitter
 
 
 class PostProcessorConnector:
@@ -25,8 +26,10 @@ class PostProcessorConnector:
                                    output_file_paths: hybrid_utils.TempFilePaths,
                                    additiveSetup: Optional[adsk.cam.Setup] = None,
                                    finishingMillingSetup: Optional[adsk.cam.Setup] = None,
-                                   planarisingSetup: Optional[adsk.cam.Setup] = None):
-        '''Export (post-process) the passed in setups to the provided file paths using the provided config'''
+                                   additive_template: bool = False):
+        '''Export (post-process) the passed in setups to the provided file paths using the provided config.
+        With additive_template, the additive G-code is written with every variant of the option-dependent blocks between
+        template markers, for AdditiveTemplate to select from.'''
         if additiveSetup is not None and additiveSetup.operationType != adsk.cam.OperationTypes.AdditiveOperation:
             fusion_utils.messageBox(self.ui, f'"{additiveSetup.name}" is not an additive setup',
                                     "Error", icon=adsk.core.MessageBoxIconTypes.CriticalIconType)
@@ -37,15 +40,10 @@ class PostProcessorConnector:
                                     "Error", icon=adsk.core.MessageBoxIconTypes.CriticalIconType)
             raise RuntimeError(f'"{finishingMillingSetup.name}" is not a milling setup')
 
-        if planarisingSetup is not None and planarisingSetup.operationType != adsk.cam.OperationTypes.MillingOperation:
-            fusion_utils.messageBox(self.ui, f'"{planarisingSetup.name}" is not a milling setup',
-                                    "Error", icon=adsk.core.MessageBoxIconTypes.CriticalIconType)
-            raise RuntimeError(f'"{planarisingSetup.name}" is not a milling setup')
-
         # specify the NC file output units
         units = adsk.cam.PostOutputUnitOptions.DocumentUnitsOutput
 
-        setups = [s for s in (additiveSetup, finishingMillingSetup, planarisingSetup) if s is not None]
+        setups = [s for s in (additiveSetup, finishingMillingSetup) if s is not None]
         for setup in setups:
             # verify there are operations in setup
             if setup.operations.count == 0:
@@ -68,25 +66,6 @@ class PostProcessorConnector:
 
             self.cam.postProcess(finishingMillingSetup, finishingMillingPostInput)
 
-        if planarisingSetup is not None and output_file_paths.planarising is not None:
-            planarisingPostInput = adsk.cam.PostProcessInput.create(
-                output_file_paths.planarising.stem,
-                millingPostProcessorPath,
-                str(output_file_paths.planarising.parent),
-                units)  # type: ignore (Pylance)
-            planarisingPostInput.isOpenInEditor = False
-
-            planarisingPostInput.postProperties.add(
-                "standalone", adsk.core.ValueInput.createByBoolean(False))
-            if planarisingSetup.operations[0].hasWarning:
-                futil.log(f"Planarising setups warning: '{planarisingSetup.operations[0].warning}'")
-                if re.match(r'Empty toolpath[\W]*', planarisingSetup.operations[0].warning) is not None:
-                    futil.log(f"Empty toolpath, exporting empty file")
-                    with open(output_file_paths.planarising, 'w+') as file:
-                        pass
-            else:
-                self.cam.postProcess(planarisingSetup, planarisingPostInput)
-
         if additiveSetup is not None and output_file_paths.additive is not None:
             futil.log(f"additive path: {output_file_paths.additive.parent}   {output_file_paths.additive.stem}")
             additivePostInput = adsk.cam.PostProcessInput.create(
@@ -112,5 +91,43 @@ class PostProcessorConnector:
                 "defectCorrection", adsk.core.ValueInput.createByBoolean(combined_post_config.defectCorrection))
             additivePostInput.postProperties.add(
                 "firstCorrectionLayer", adsk.core.ValueInput.createByReal(combined_post_config.firstCorrectionLayer))
+            additivePostInput.postProperties.add(
+                "templateMarkers", adsk.core.ValueInput.createByBoolean(additive_template))
 
             self.cam.postProcess(additiveSetup, additivePostInput)
+
+    def post_process_slices(self, operations: list[adsk.cam.Operation], output_folder: Path) -> list[Path]:
+        '''Export the planarising/defect correction operations to one file each, named after the operation.
+        The operations are posted in a single program with slice markers, which is then split into the files, so that the
+        post processor only starts once.'''
+        slice_files = []
+        operations_to_post = adsk.core.ObjectCollection.create()
+        for operation in operations:
+            if operation.hasWarning:
+                futil.log(f"Planarising operation {operation.name} warning: '{operation.warning}'")
+                if re.match(r'Empty toolpath[\W]*', operation.warning) is not None:
+                    futil.log(f"Empty toolpath, exporting empty file")
+                    slice_files.append(output_folder.joinpath(f"{operation.name}.tap"))
+                    with open(slice_files[-1], 'w+') as file:
+                        pass
+            else:
+                operations_to_post.add(operation)
+        if operations_to_post.count == 0:
+            return slice_files
+
+        batch_file = output_folder.joinpath("Slices.tap")
+        planarisingPostInput = adsk.cam.PostProcessInput.create(
+            batch_file.stem,
+            str(config.MILLING_POST_PROCESSOR_PATH),
+            str(output_folder),
+            adsk.cam.PostOutputUnitOptions.DocumentUnitsOutput)  # type: ignore (Pylance)
+        planarisingPostInput.isOpenInEditor = False
+
+        planarisingPostInput.postProperties.add(
+            "standalone", adsk.core.ValueInput.createByBoolean(False))
+        planarisingPostInput.postProperties.add(
+            "sliceMarkers", adsk.core.ValueInput.createByBoolean(True))
+        self.cam.postProcess(operations_to_post, planarisingPostInput)
+        slice_files += SliceSplitter().split(batch_file, output_folder)
+        batch_file.unlink()
+        return slice_files
@@ -0,0 +1,193 @@
+from dataclasses import dataclass
+from pathlib import Path
+import re
+import numpy as np
+from .Toolpath import Toolpath
+from .gcode_transforms import format_number
+from .gcode_utils import detect_line_ending, split_comment
+
+# words a region may contain to be moved, other words may change the modal state of the regions after them
+_WORD_PATTERN = re.compile(rb"(?P<letter>[A-Z])\s*(?P<value>[-+]?(?:\d+\.?\d*|\.\d+))")
+_MOVABLE_LETTERS = set(b"GXYZFIJK")
+_MOVABLE_G_CODES = {0, 1, 2, 3}
+
+
+@dataclass
+class RapidOrderResult:
+    region_count: int
+    original_distance: float  # mm of rapids between the regions
+    optimised_distance: float  # mm
+
+    @property
+    def saved_distance(self) -> float:
+        return self.original_distance - self.optimised_distance
+
+
+class RapidOptimizer:
+    '''Reorders the cutting regions of a milling toolpath to shorten the rapids between them, e.g. between the
+    islands of a planarising toolpath, which Fusion does not always link in the shortest order.
+    A region starts with a G0 XY move above the highest cut of the toolpath (or the first G0 XY move, which follows the
+    retract of the header) and runs to the next one. Any region may be cut first, from the position at the end of the
+    header, where the XY of the tool is not known after the retract to the machine home. The order is found with nearest
+    neighbour, then improved with 2-opt; regions are always cut in their own direction, as their entry and exit differ.
+    The rapids between reordered regions are made at the highest height Fusion already uses between regions, and the
+    tool then goes down to the height the region was entered at, so no rapid is lower than in the original toolpath.
+    Toolpaths with other words between the regions (e.g. M codes, planes, G91) are left as they are. The other words of
+    the first rapid (e.g. G90, which the post writes with it) come before every region, and are kept on the first link.'''
+
+    MAX_PASSES = 20
+
+    def optimise_file(self, toolpath_file: Path) -> RapidOrderResult:
+        '''Reorder the toolpath in place if it shortens the rapids'''
+        gcode = toolpath_file.read_bytes()
+        optimised_gcode, result = self.optimise(gcode)
+        if optimised_gcode != gcode:
+            toolpath_file.write_bytes(optimised_gcode)
+        return result
+
+    def optimise(self, gcode: bytes) -> tuple[bytes, RapidOrderResult]:
+        '''Returns the reordered G-code, or the G-code unchanged if it cannot be shortened'''
+        toolpath = Toolpath(gcode)
+        line_count = len(toolpath.motion)
+        positions = toolpath.positions()
+        previous_z = np.concatenate(([np.nan], positions[2, :-1]))
+        motion = _forward_fill(toolpath.motion.astype(float), toolpath.motion >= 0, -1)
+        feed = _forward_fill(toolpath.feed, ~np.isnan(toolpath.feed), np.nan)
+        has_xy = ~np.isnan(toolpath.x) | ~np.isnan(toolpath.y)
+        is_cut = (motion >= 1) & (has_xy | ~np.isnan(toolpath.z))
+        if not is_cut.any():
+            return gcode, RapidOrderResult(0, 0, 0)
+
+        # rapids in XY above the highest cut are where the toolpath moves from one region to the next, and the first
+        # rapid in XY is made before any Z is known, from the retract of the header
+        highest_cut = np.nanmax(positions[2, is_cut])
+        is_xy_rapid = (motion == 0) & has_xy & np.isnan(toolpath.z)
+        is_first_xy_rapid = np.zeros(line_count, dtype=bool)
+        is_first_xy_rapid[np.flatnonzero(is_xy_rapid)[:1]] = True
+        transits = np.flatnonzero(is_xy_rapid & ((previous_z > highest_cut) | (np.isnan(previous_z) & is_first_xy_rapid)))
+        if (len(transits) < 2 or np.isnan(previous_z[transits]).all()
+                or not self._is_movable(toolpath, transits[0] + 1)):
+            return gcode, RapidOrderResult(len(transits), 0, 0)
+
+        region_ends = np.append(transits[1:], line_count)  # exclusive
+        entries = positions[:2, transits].T
+        safe_height = float(np.nanmax(previous_z[transits]))
+        # a region entered from the retract of the header is entered from above the others, and goes down itself
+        entry_heights = np.nan_to_num(previous_z[transits], nan=safe_height)
+        exits = positions[:, region_ends - 1].T
+        start = positions[:, transits[0] - 1] if transits[0] > 0 else np.full(3, np.nan)
+        if np.isnan(start[2]):
+            start[2] = safe_height
+
+        # the cost of each link from the exit of a region (or the start, in the last row) to the entry of another.
+        # The approach from a start without XY costs the same to every region, and is left out.
+        exits_and_start = np.vstack((exits, start))
+        travel_heights = np.maximum(exits_and_start[:, 2], safe_height)
+        costs = (np.nan_to_num(np.hypot(*(exits_and_start[:, None, :2] - entries[None, :, :]).transpose(2, 0, 1)))
+                 + (travel_heights - exits_and_start[:, 2])[:, None]
+                 + (travel_heights[:, None] - entry_heights[None, :]))
+        original_order = np.arange(len(transits))
+        original_distance = path_cost(costs, original_order)
+        order = find_order(costs, is_first_fixed=False, max_passes=self.MAX_PASSES)
+        optimised_distance = path_cost(costs, order)
+        result = RapidOrderResult(len(transits), original_distance, optimised_distance)
+        if optimised_distance >= original_distance - 1e-6 or np.array_equal(order, original_order):
+            result.optimised_distance = original_distance
+            return gcode, result
+
+        line_ending = detect_line_ending(gcode[:4096])
+        parts = [gcode[:toolpath.line_starts[transits[0]]]]
+        first_words = self._get_modal_words(toolpath, transits[0])
+        current_z, current_feed = start[2], feed[transits[0] - 1] if transits[0] > 0 else np.nan
+        for region in order:
+            link = []
+            if current_z < safe_height:
+                link.append(f"G0 Z{format_number(safe_height)}")
+            link.append(f"G0 X{format_number(entries[region][0])} Y{format_number(entries[region][1])}")
+            if entry_heights[region] < max(current_z, safe_height):
+                link.append(f"G0 Z{format_number(entry_heights[region])}")
+            region_feed = feed[transits[region]]
+            if not np.isnan(region_feed) and region_feed != current_feed:
+                link.append(f"F{format_number(region_feed)}")
+            if first_words:
+                link[0], first_words = f"{first_words} {link[0]}", ""
+            parts.append(line_ending.join(line.encode() for line in link) + line_ending)
+            parts.append(gcode[toolpath.line_starts[transits[region] + 1]:toolpath.line_starts[region_ends[region]]])
+            current_z, current_feed = exits[region][2], feed[region_ends[region] - 1]
+        parts.append(gcode[toolpath.line_starts[-1]:])
+        return b"".join(parts), result
+
+    def _is_movable(self, toolpath: Toolpath, first_line: int) -> bool:
+        '''The regions only contain moves, so that they can be cut in any order'''
+        for line in toolpath.gcode[toolpath.line_starts[first_line]:toolpath.line_starts[-1]].splitlines():
+            code, _ = split_comment(line)
+            for match in _WORD_PATTERN.finditer(code.upper()):
+                letter = match.group('letter')[0]
+                if letter not in _MOVABLE_LETTERS or (letter == ord("G") and
+                                                      float(match.group('value')) not in _MOVABLE_G_CODES):
+                    return False
+        return True
+
+    def _get_modal_words(self, toolpath: Toolpath, line_number: int) -> str:
+        '''The words of a rapid other than the move, e.g. "G90" of "G90 G0 X10. Y5."'''
+        code, _ = split_comment(toolpath.gcode[toolpath.line_starts[line_number]:toolpath.line_starts[line_number + 1]])
+        return " ".join(match.group().decode() for match in _WORD_PATTERN.finditer(code.upper().strip())
+                        if match.group('letter') not in (b"X", b"Y")
+                        and not (match.group('letter') == b"G" and float(match.group('value')) == 0))
+
+
+def find_order(costs: np.ndarray, is_first_fixed: bool, max_passes: int = 20) -> np.ndarray:
+    '''Short order of regions that are linked by travels, from nearest neighbour improved with 2-opt.
+    costs[i, j] is the cost of the link from the exit of region i (or the start, in the last row) to the entry of j.'''
+    return _two_opt(costs, _nearest_neighbour(costs, is_first_fixed), int(is_first_fixed), max_passes)
+
+
+def _nearest_neighbour(costs: np.ndarray, is_first_fixed: bool) -> np.ndarray:
+    '''The nearest region to the end of the last one is next'''
+    region_count = costs.shape[1]
+    order = [0 if is_first_fixed else int(np.argmin(costs[-1]))]
+    is_visited = np.zeros(region_count, dtype=bool)
+    is_visited[order[0]] = True
+    for _ in range(region_count - 1):
+        next_region = int(np.argmin(np.where(is_visited, np.inf, costs[order[-1]])))
+        order.append(next_region)
+        is_visited[next_region] = True
+    return np.array(order)
+
+
+def _two_opt(costs: np.ndarray, order: np.ndarray, first_movable: int, max_passes: int) -> np.ndarray:
+    '''Reverse the order of runs of regions while it shortens the path. The links are directed, so the cost of the
+    links inside a reversed run changes too, which is found for every run end at once from cumulative sums.'''
+    region_count = len(order)
+    start = costs.shape[0] - 1
+    for _ in range(max_passes):
+        is_improved = False
+        for first in range(first_movable, region_count - 1):
+            forward = np.concatenate(([0], np.cumsum(costs[order[:-1], order[1:]])))
+            backward = np.concatenate(([0], np.cumsum(costs[order[1:], order[:-1]])))
+            lasts = np.arange(first + 1, region_count)
+            previous = order[first - 1] if first > 0 else start
+            next_regions = order[np.minimum(lasts + 1, region_count - 1)]
+            has_next = lasts + 1 < region_count
+            delta = (costs[previous, order[lasts]] - costs[previous, order[first]]
+                     + (backward[lasts] - backward[first]) - (forward[lasts] - forward[first])
+                     + np.where(has_next, costs[order[first], next_regions] - costs[order[lasts], next_regions], 0))
+            best = int(np.argmin(delta))
+            if delta[best] < -1e-9:
+                last = lasts[best]
+                order[first:last + 1] = order[first:last + 1][::-1].copy()
+                is_improved = True
+        if not is_improved:
+            break
+    return order
+
+
+def path_cost(costs: np.ndarray, order: np.ndarray) -> float:
+    start = costs.shape[0] - 1
+    return float(costs[start, order[0]] + costs[order[:-1], order[1:]].sum())
+
+
+def _forward_fill(values: np.ndarray, is_set: np.ndarray, initial: float) -> np.ndarray:
+    last_set = np.where(is_set, np.arange(len(values)), -1)
+    np.maximum.accumulate(last_set, out=last_set)
+    return np.where(last_set >= 0, values[np.maximum(last_set, 0)], initial)
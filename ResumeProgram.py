@@ -0,0 +1,104 @@
+from decimal import Decimal
+import mmap
+from pathlib import Path
+import re
+from typing import Optional, Union
+from .GcodeMerger import SpliceSegment, map_file, write_splice_plan
+from .LayerIndex import Layer, LayerIndex
+from . import gcode_utils
+
+
+class ResumeProgram:
+    '''Writes a program that resumes a combined program at the start of a layer, e.g. after a nozzle clog or power cut.
+    The resume program is the header of the program, followed by the modal state at the start of the layer and an
+    A axis reset to the extrusion at the end of the previous layer, then everything from the layer on.
+    The header is raised by the height already printed, so that its moves to the start position clear the part.
+    The end of layer block of the previous layer (drying, photo and defect correction) is skipped, as the previous
+    layer has already been finished. The program is spliced from byte ranges like GcodeMerger, in a single pass.'''
+
+    WCS_PATTERN = re.compile(rb"(?<![\w.])G0*5[4-9](?![.\d])")
+    DISTANCE_MODE_PATTERN = re.compile(rb"(?<![\w.])G0*9[01](?![.\d])")
+    AUGER_PATTERN = re.compile(rb"(?<![\w.])M0*1[56](?!\d)")
+    # the last line of the drying, photo and laser scan part of the end of layer block, kept when minifying
+    END_OF_LAYER_LOG_PATTERN = re.compile(rb"^M0*111\s*#622=[^\r\n]*(?:\r?\n)?", re.MULTILINE)
+    SEARCH_WINDOW_SIZE = 1024 * 1024
+
+    def __init__(self, program_file: Path) -> None:
+        self.program_file = program_file
+        self.layer_index = self._load_layer_index(program_file)
+
+    @staticmethod
+    def default_output_path(program_file: Path, layer_number: int) -> Path:
+        return program_file.with_name(f"{program_file.stem} from layer {layer_number}{program_file.suffix}")
+
+    def write(self, layer_number: int, output_file: Path):
+        '''Write the program resuming at the start of the layer to the output file'''
+        layer = self.layer_index.layer(layer_number)
+        if layer is None:
+            raise ValueError(f"Layer {layer_number} is not in {self.program_file.name}")
+        previous_layer = self.layer_index.layer(layer_number - 1)
+
+        with open(self.program_file, 'rb') as program, open(output_file, 'wb', buffering=0) as outfile:
+            with map_file(program) as source:
+                splice_plan = self._create_splice_plan(source, layer, previous_layer)
+                write_splice_plan(program, source, splice_plan, outfile)
+
+    def _create_splice_plan(self, source: Union[mmap.mmap, bytes], layer: Layer,
+                            previous_layer: Optional[Layer]) -> list[SpliceSegment]:
+        line_ending = gcode_utils.detect_line_ending(source[:4096])
+        header_end = self.layer_index.layers[0].start
+        printed_height = Decimal(str(previous_layer.z)) if previous_layer is not None and previous_layer.z else Decimal(0)
+        layer_comment_end = source.find(b"\n", layer.start, layer.end) + 1 or layer.end
+        resume_start = self._find_resume_start(source, layer) or layer_comment_end
+
+        state = [f";Resuming at layer {layer.number} of {self.layer_index.layer_count}".encode()]
+        modal_words = [self._find_last(source, pattern, resume_start) for pattern in (self.WCS_PATTERN,
+                                                                                     self.DISTANCE_MODE_PATTERN)]
+        if any(modal_words):
+            state.append(b" ".join(word for word in modal_words if word))
+        auger_word = self._find_last(source, self.AUGER_PATTERN, resume_start)
+        if auger_word:
+            state.append(auger_word)
+        extrusion = previous_layer.last_a if previous_layer is not None and previous_layer.last_a is not None else 0
+        state.append(f"G92 A{extrusion:g}".encode())
+
+        return [gcode_utils.shift_z(source[:header_end], printed_height),
+                line_ending.join(state) + line_ending,
+                range(layer.start, layer_comment_end),
+                range(resume_start, len(source))]
+
+    def _find_resume_start(self, source: Union[mmap.mmap, bytes], layer: Layer) -> Optional[int]:
+        '''Returns the offset of the label after the defect correction block of the previous layer, or if the program
+        has no labels (defect correction off), of the line after the end of layer data of the previous layer is logged'''
+        if layer.number * 2 in layer.labels:
+            label = re.compile(rb"^N" + str(layer.number * 2).encode() + rb"\s*$", re.MULTILINE)
+            match = label.search(source, layer.start, layer.end)
+            if match is not None:
+                return match.start()
+        match = self.END_OF_LAYER_LOG_PATTERN.search(source, layer.start, layer.end)
+        return match.end() if match is not None else None
+
+    def _find_last(self, source: Union[mmap.mmap, bytes], pattern: re.Pattern, end: int) -> Optional[bytes]:
+        '''Returns the last word matching the pattern before the offset, searching backwards window by window.
+        Words in comments are ignored.'''
+        window_end = end
+        while window_end > 0:
+            window_start = max(window_end - self.SEARCH_WINDOW_SIZE, 0)
+            if window_start > 0:
+                window_start = source.rfind(b"\n", 0, window_start) + 1  # start at a line
+            for match in reversed(list(pattern.finditer(source, window_start, window_end))):
+                line_start = source.rfind(b"\n", 0, match.start()) + 1
+                if not re.search(rb"[;(]", source[line_start:match.start()]):
+                    return match.group()
+            window_end = window_start
+        return None
+
+    @staticmethod
+    def _load_layer_index(program_file: Path) -> LayerIndex:
+        '''Use the sidecar written with the program if it is up to date'''
+        sidecar = LayerIndex.sidecar_path(program_file)
+        if sidecar.exists():
+            layer_index = LayerIndex.load(sidecar)
+            if layer_index.file_size == program_file.stat().st_size:
+                return layer_index
+        return LayerIndex.build(program_file)
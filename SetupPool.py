@@ -0,0 +1,36 @@
+import adsk.cam
+from . import cam_setup_utils
+from .lib import fusion360utils as futil
+from .SliceComponent import SliceComponent
+
+
+class SetupPool:
+    '''A face milling setup for each slot of the slice component, built the first time the slot is sliced and kept for
+    the following slices. A setup whose toolpath was defective is reset in place, which only costs clearing its pocket
+    selections, rather than being deleted and built again from the template.'''
+    def __init__(self, cam: adsk.cam.CAM, slice_component: SliceComponent, name: str = "Defect corr."):
+        self.cam = cam
+        self.slice_component = slice_component
+        self.name = name
+        self._setups: dict[int, adsk.cam.Setup] = {}
+
+    def get(self, slot: int = 0) -> adsk.cam.Setup:
+        '''The setup modelling the slot, built if it does not exist yet (or was deleted in Fusion)'''
+        setup = self._setups.get(slot)
+        if setup is None or not setup.isValid:
+            setup = cam_setup_utils.create_slice_setup(self.cam, [self.slice_component.slot_models[slot]],
+                                                       f"{self.name} {slot + 1}")
+            futil.log(f"setup: {setup.name}, ops: {setup.operations[0].name}")
+            self._setups[slot] = setup
+        return setup
+
+    def reset(self, slot: int = 0):
+        '''Prepare the setup of the slot for the next slice after a defective toolpath'''
+        if slot in self._setups:
+            cam_setup_utils.reset_slice_setup(self._setups[slot])
+
+    def deleteMe(self):
+        for setup in self._setups.values():
+            if setup.isValid:
+                setup.deleteMe()
+        self._setups.clear()
@@ -0,0 +1,80 @@
+import adsk.core
+import adsk.fusion
+from .lib import fusion360utils as futil
+
+
+class Section:
+    '''The bodies of the part below a slicing height, added to a slot of the slice component by a base feature.'''
+    def __init__(self, base_feature: adsk.fusion.BaseFeature):
+        self.base_feature = base_feature
+
+    @property
+    def bodies(self) -> list[adsk.fusion.BRepBody]:
+        return list(self.base_feature.bodies)
+
+    def deleteMe(self):
+        self.base_feature.deleteMe()
+
+
+class SliceComponent:
+    '''A dedicated component that the part is sliced in. Each section is built from transient copies of the bodies of the
+    part, intersected with a box below the slicing height by the temporary B-rep manager, and added as a base feature.
+    The timeline of the design is never rolled back, so the time to slice does not depend on the length of its history.
+    The component has a child component (slot) for each section that exists at the same time, so that a setup can keep
+    modelling a slot while its sections are replaced.'''
+    MARGIN = 1.0  # cm, around the part in X, Y and below it, for the box the part is intersected with
+
+    def __init__(self, part_occurrence: adsk.fusion.Occurrence, slot_count: int = 1, name: str = "Slices"):
+        component = part_occurrence.component
+        self.temporary_brep_manager = adsk.fusion.TemporaryBRepManager.get()
+        self.part_bodies = [self.temporary_brep_manager.copy(body) for body in component.bRepBodies]
+        self.part_box = component.boundingBox
+        self.occurrence = component.occurrences.addNewComponent(adsk.core.Matrix3D.create())
+        self.occurrence.component.name = name
+        self.slots: list[adsk.fusion.Occurrence] = []
+        for slot in range(slot_count):
+            slot_occurrence = self.occurrence.component.occurrences.addNewComponent(adsk.core.Matrix3D.create())
+            slot_occurrence.component.name = f"{name} {slot + 1}"
+            self.slots.append(slot_occurrence)
+        # the occurrences as seen from the manufacturing model, for setups to model them
+        occurrence_in_part = self.occurrence.createForAssemblyContext(part_occurrence)
+        self.slot_models = [slot_occurrence.createForAssemblyContext(occurrence_in_part) for slot_occurrence in self.slots]
+        futil.log(f"Slice component created in {component.name}")
+
+    def add_section(self, height_mm: float, slot: int = 0) -> Section:
+        '''Add the part below the height to the slot'''
+        slot_component = self.slots[slot].component
+        base_feature = slot_component.features.baseFeatures.add()
+        base_feature.startEdit()
+        for section_body in self._get_section_bodies(height_mm):
+            slot_component.bRepBodies.add(section_body, base_feature)
+        base_feature.finishEdit()
+        return Section(base_feature)
+
+    def _get_section_bodies(self, height_mm: float) -> list[adsk.fusion.BRepBody]:
+        '''Transient bodies of the part below the height, without the bodies that lie above it'''
+        bottom = self.part_box.minPoint.z - self.MARGIN
+        top = height_mm/10
+        if top <= bottom:
+            return []
+        center = adsk.core.Point3D.create((self.part_box.minPoint.x + self.part_box.maxPoint.x)/2,
+                                          (self.part_box.minPoint.y + self.part_box.maxPoint.y)/2,
+                                          (bottom + top)/2)
+        box = adsk.core.OrientedBoundingBox3D.create(center,
+                                                     adsk.core.Vector3D.create(1, 0, 0),
+                                                     adsk.core.Vector3D.create(0, 1, 0),
+                                                     self.part_box.maxPoint.x - self.part_box.minPoint.x + 2*self.MARGIN,
+                                                     self.part_box.maxPoint.y - self.part_box.minPoint.y + 2*self.MARGIN,
+                                                     top - bottom)
+        section_bodies = []
+        for part_body in self.part_bodies:
+            section_body = self.temporary_brep_manager.copy(part_body)
+            self.temporary_brep_manager.booleanOperation(section_body,
+                                                         self.temporary_brep_manager.createBox(box),
+                                                         adsk.fusion.BooleanTypes.IntersectionBooleanType)  # type: ignore
+            if section_body.faces.count > 0:
+                section_bodies.append(section_body)
+        return section_bodies
+
+    def deleteMe(self):
+        self.occurrence.deleteMe()
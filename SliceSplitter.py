@@ -0,0 +1,52 @@
+from pathlib import Path
+from typing import BinaryIO, Optional
+
+SLICE_START_MARKER = b";SLICE_START "
+SLICE_END_MARKER = b";SLICE_END"
+
+
+class SliceSplitter:
+    '''Splits the G-code of several operations posted in one program with slice markers (the sliceMarkers property of
+    mach4mill.cps) into one file per operation, named after the operation.
+    The program header before the first slice and the footer after the last one are written around every slice, so each
+    file is the same as if its operation had been posted on its own. The program is read once, line by line, and the
+    footer, which is only known at the end, is appended to the files afterwards.'''
+
+    def split(self, batch_file: Path, output_folder: Path) -> list[Path]:
+        '''Write each slice of the batch file to the output folder, and return the paths in order of the slices'''
+        header: list[bytes] = []
+        footer: list[bytes] = []
+        slice_files: list[Path] = []
+        slice_file: Optional[BinaryIO] = None
+        try:
+            with open(batch_file, 'rb') as batch_gcode:
+                for line in batch_gcode:
+                    if line.startswith(SLICE_START_MARKER):
+                        if slice_file is not None:
+                            raise ValueError(f"Slice {slice_files[-1].stem} has no end marker in {batch_file}")
+                        slice_files.append(output_folder.joinpath(
+                            line[len(SLICE_START_MARKER):].strip().decode() + batch_file.suffix))
+                        slice_file = open(slice_files[-1], 'wb')
+                        slice_file.writelines(header)
+                        footer.clear()
+                    elif line.rstrip() == SLICE_END_MARKER:
+                        if slice_file is None:
+                            raise ValueError(f"Slice end marker without a start marker in {batch_file}")
+                        slice_file.close()
+                        slice_file = None
+                    elif slice_file is not None:
+                        slice_file.write(line)
+                    elif slice_files:
+                        footer.append(line)
+                    else:
+                        header.append(line)
+                if slice_file is not None:
+                    raise ValueError(f"Slice {slice_files[-1].stem} has no end marker in {batch_file}")
+        finally:
+            if slice_file is not None:
+                slice_file.close()
+
+        for path in slice_files:
+            with open(path, 'ab') as slice_gcode:
+                slice_gcode.writelines(footer)
+        return slice_files
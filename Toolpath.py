@@ -0,0 +1,134 @@
+import hashlib
+from pathlib import Path
+import re
+import numpy as np
+from .GcodeAnalyzer import parse_chunk
+from .gcode_transforms import format_number
+from .gcode_utils import split_comment
+
+WORD_LETTERS = b"XYZFIJK"
+_WORD_PATTERNS = {letter: re.compile(rb"(?P<space> ?)(?<![A-Z])" + bytes((letter,)) + rb"[-+]?(?:\d+\.?\d*|\.\d+)")
+                  for letter in WORD_LETTERS}
+
+
+class Toolpath:
+    '''A milling toolpath posted with mach4mill.cps, as NumPy arrays rather than text.
+    The lines from the first move to the last move are the body, with the motion (G0 to G3) and the X, Y, Z, F, I, J
+    and K words of each line in contiguous arrays, NaN (or -1 for the motion) where a line does not have the word.
+    The header and footer around the body, and all other words and lines, are kept verbatim.
+    Only the lines whose values were changed are formatted again when the toolpath is written, so a toolpath that was
+    loaded and saved is byte-identical, and a transform that changes a few words only pays for those lines.
+    mach4mill.cps writes absolute coordinates (G90) and incremental arc centres (G91.1).
+    The toolpath is for reordering and analysing moves (e.g. RapidOptimizer). Heights are shifted on the text by
+    gcode_utils.shift_z, whose Decimal arithmetic keeps the shifted values exact.'''
+
+    TOKEN_WIDTH = 16
+
+    def __init__(self, gcode: bytes) -> None:
+        self.gcode = gcode
+        parsed = parse_chunk(gcode, 0, self.TOKEN_WIDTH)
+        has_coordinates = np.zeros(len(parsed.offsets), dtype=bool)
+        for letter in b"XYZ":
+            has_coordinates |= ~np.isnan(parsed.columns[bytes((letter,))])
+        has_coordinates &= ~parsed.is_non_work_move  # e.g. the G28 retracts of the header and footer
+        moves = np.flatnonzero(has_coordinates)
+        first_move = moves[0] if len(moves) else len(parsed.offsets)
+        last_move = moves[-1] if len(moves) else len(parsed.offsets) - 1
+        first_motion = np.flatnonzero(~np.isnan(parsed.motion[:first_move + 1]))
+        body_first_line = min(first_move, first_motion[-1]) if len(first_motion) else first_move
+
+        line_starts = np.append(parsed.offsets, len(gcode))
+        body_lines = slice(body_first_line, last_move + 1)
+        self.line_starts = line_starts[body_first_line:last_move + 2]  # the end of each line is the start of the next
+        self.motion = np.nan_to_num(parsed.motion[body_lines], nan=-1).astype(np.int8)
+        self.words = np.array([parsed.columns[bytes((letter,))][body_lines] for letter in WORD_LETTERS])
+        # coordinates that are not absolute work coordinates are kept verbatim, e.g. G28 G91 Z0.
+        distance_mode = parsed.distance_mode[:last_move + 1]
+        last_set = np.where(~np.isnan(distance_mode), np.arange(len(distance_mode)), 0)
+        np.maximum.accumulate(last_set, out=last_set)
+        is_incremental = distance_mode[last_set][body_lines] == 91
+        self.words[:3, is_incremental | parsed.is_non_work_move[body_lines]] = np.nan
+        self._original_words = self.words.copy()
+
+    @classmethod
+    def load(cls, toolpath_file: Path) -> 'Toolpath':
+        return cls(toolpath_file.read_bytes())
+
+    @property
+    def header(self) -> bytes:
+        return self.gcode[:self.line_starts[0]]
+
+    @property
+    def footer(self) -> bytes:
+        return self.gcode[self.line_starts[-1]:]
+
+    @property
+    def x(self) -> np.ndarray:
+        return self.words[0]
+
+    @property
+    def y(self) -> np.ndarray:
+        return self.words[1]
+
+    @property
+    def z(self) -> np.ndarray:
+        return self.words[2]
+
+    @property
+    def feed(self) -> np.ndarray:
+        return self.words[3]
+
+    @property
+    def arc_centres(self) -> np.ndarray:
+        '''I, J and K of each line'''
+        return self.words[4:7]
+
+    def positions(self) -> np.ndarray:
+        '''X, Y and Z after each line of the body, NaN until the axis is first set'''
+        positions = self.words[:3].copy()
+        for axis in positions:
+            last_set = np.where(~np.isnan(axis), np.arange(len(axis)), 0)
+            np.maximum.accumulate(last_set, out=last_set)
+            axis[:] = axis[last_set]
+        return positions
+
+    def bounding_box(self) -> tuple[np.ndarray, np.ndarray]:
+        '''Minimum and maximum X, Y and Z of the moves'''
+        positions = self.positions()
+        return np.nanmin(positions, axis=1), np.nanmax(positions, axis=1)
+
+    def digest(self) -> str:
+        '''Hash of the motion and words, e.g. to find toolpaths that are the same'''
+        return hashlib.sha1(self.motion.tobytes() + np.nan_to_num(self.words, nan=np.inf).tobytes()).hexdigest()
+
+    def to_gcode(self) -> bytes:
+        is_unchanged = (self.words == self._original_words) | (np.isnan(self.words) & np.isnan(self._original_words))
+        changed_lines = np.flatnonzero(~is_unchanged.all(axis=0))
+        if not len(changed_lines):
+            return self.gcode
+        parts = []
+        position = 0
+        for line in changed_lines:
+            start, end = self.line_starts[line], self.line_starts[line + 1]
+            parts.append(self.gcode[position:start])
+            parts.append(self._format_line(line))
+            position = end
+        parts.append(self.gcode[position:])
+        return b"".join(parts)
+
+    def save(self, toolpath_file: Path):
+        toolpath_file.write_bytes(self.to_gcode())
+
+    def _format_line(self, line: int) -> bytes:
+        '''Replace the changed words of the original line'''
+        code, comment = split_comment(self.gcode[self.line_starts[line]:self.line_starts[line + 1]])
+        for letter, value, original_value in zip(WORD_LETTERS, self.words[:, line], self._original_words[:, line]):
+            if value == original_value or (np.isnan(value) and np.isnan(original_value)):
+                continue
+            if np.isnan(original_value):
+                raise ValueError(f"{chr(letter)} cannot be added to line {line} of the toolpath: {code.decode()}")
+            word = b"" if np.isnan(value) else bytes((letter,)) + format_number(float(value)).encode()
+            code = _WORD_PATTERNS[letter].sub(lambda match: match.group('space') + word if word else b"", code, count=1)
+            if not word:
+                code = code.lstrip(b" ")
+        return code + comment
@@ -0,0 +1,317 @@
+from bisect import bisect_right
+from dataclasses import dataclass
+from pathlib import Path
+import re
+from itertools import accumulate
+from typing import Iterable, Optional
+import numpy as np
+from .RapidOptimizer import find_order, path_cost
+from .gcode_utils import split_comment
+
+# lines written by onRapid, onLinearExtrude and onCircularExtrude of the ceramic post processor, and the auger
+_LINE_PATTERN = re.compile(rb"(?:(?P<travel>G0(?: [XYZF][-+]?(?:\d+\.?\d*|\.\d+))+)"
+                           rb"|(?P<extrusion>G[123](?: [XYZFIJAB][-+]?(?:\d+\.?\d*|\.\d+))+)"
+                           rb"|(?P<auger>M1[56]))\s*")
+_AUGER_ON = b"M15"
+# comments of the layer changes, extruder changes, placeholders and markers end a run, other comments (e.g. Fusion's
+# ;rapid-dry before a travel, or the feature of the moves after it) go with the island after them
+_RUN_END_COMMENT_PATTERN = re.compile(rb";(?:Layer |PLACEHOLDER_|TEMPLATE_|MILLING_INSERT_|CERAMIC_LAYER_END"
+                                      rb"|End of layer change|.*[Ee]xtruder [Cc]hange)")
+_WORD_LETTERS = (b"X", b"Y", b"Z", b"F", b"A", b"B")
+_WORD_PATTERNS = {letter: re.compile(rb" " + letter + rb"(?P<value>[-+]?(?:\d+\.?\d*|\.\d+))")
+                  for letter in _WORD_LETTERS}
+_EXTRUSION_WORD_PATTERN = re.compile(rb"( [AB])([-+]?(?:\d+\.?\d*|\.\d+))")
+_EXTRUSION_LETTERS = (b"A", b"B")
+
+_OTHER, _TRAVEL, _EXTRUSION, _AUGER, _COMMENT = range(5)
+_KINDS = {'travel': _TRAVEL, 'extrusion': _EXTRUSION, 'auger': _AUGER}
+
+
+@dataclass
+class TravelStatistics:
+    layer_count: int = 0
+    reordered_layer_count: int = 0
+    island_count: int = 0  # islands of the reordered layers
+    original_distance: float = 0  # mm of travel between the islands of the reordered layers
+    optimised_distance: float = 0  # mm
+
+    @property
+    def saved_distance(self) -> float:
+        return self.original_distance - self.optimised_distance
+
+
+@dataclass
+class _Island:
+    start: int  # first line of the comments and travel before the island
+    travel: list[bytes]  # the comments and the travel to the first point of the island, from anywhere
+    travel_end: int  # first line after the travel
+    end: int  # exclusive
+    entry: tuple[float, float]
+    exit: tuple[float, float]
+    extrusion_before: dict[bytes, Optional[float]]  # A and B at the start of the island
+    extrusion_after: dict[bytes, Optional[float]]
+
+
+class TravelOptimizer:
+    '''Reorders the islands of each layer of an additive program from the ceramic post processor to shorten the travels
+    between them, as Fusion prints the islands in the order of its toolpath rather than the nearest one next.
+    An island is a travel (G0) with the extrusion moves and auger on and off after it, up to the next travel, and the
+    comments just before the travel, which Fusion writes for each feature of the toolpath.
+    Only runs of islands that are not interrupted by any other line are reordered, so the layer change blocks, extruder
+    changes and markers stay where they are, and an island is only moved if the auger is off before and after it.
+    The travel to a moved island is written again as one G0 to its first point, and the absolute A and B values of its
+    moves are offset by the extrusion of the islands now before it, so the A and B values at the end of every run of
+    islands, and the G92 resets of the defect correction blocks that depend on them, do not change.
+    The file is read and written one layer at a time.'''
+
+    def __init__(self) -> None:
+        self._last_extrusion: dict[bytes, Optional[float]] = {letter: None for letter in _EXTRUSION_LETTERS}
+
+    def optimise_file(self, additive_file: Path) -> TravelStatistics:
+        '''Reorder the islands of the file in place'''
+        self._last_extrusion = {letter: None for letter in _EXTRUSION_LETTERS}
+        statistics = TravelStatistics()
+        optimised_file = additive_file.with_name(additive_file.name + ".optimised")
+        with open(additive_file, 'rb') as source, open(optimised_file, 'wb') as output:
+            for layer in self._read_layers(source):
+                output.writelines(self.optimise_layer(layer, statistics))
+        optimised_file.replace(additive_file)
+        return statistics
+
+    @staticmethod
+    def _read_layers(source: Iterable[bytes]) -> Iterable[list[bytes]]:
+        '''The lines before the first layer, then the lines of each layer from its ";Layer n of m" comment'''
+        layer: list[bytes] = []
+        for line in source:
+            if line.startswith(b";Layer ") and layer:
+                yield layer
+                layer = []
+            layer.append(line)
+        if layer:
+            yield layer
+
+    def optimise_layer(self, lines: list[bytes], statistics: TravelStatistics) -> list[bytes]:
+        '''Returns the lines of the layer with each run of islands reordered.
+        The layers must be passed in order, as the A and B values before the first island may be in an earlier
+        layer.'''
+        if lines and lines[0].startswith(b";Layer "):
+            statistics.layer_count += 1
+        layer = _Layer(lines)
+        optimised_lines = self._optimise_runs(layer, statistics) if _TRAVEL in layer.kinds else lines
+        # the reordered islands end on the same A and B values
+        self._last_extrusion = {letter: self._find_extrusion(layer, letter, len(lines) - 1)
+                                for letter in _EXTRUSION_LETTERS}
+        return optimised_lines
+
+    def _optimise_runs(self, layer: '_Layer', statistics: TravelStatistics) -> list[bytes]:
+        optimised_lines: list[bytes] = []
+        position = 0
+        for start, end in layer.runs():
+            islands = self._find_islands(layer, start, end)
+            if islands is None:
+                continue
+            entries = np.array([island.entry for island in islands])
+            exits = np.array([island.exit for island in islands])
+            start_position = layer.find_position(islands[0].start - 1, start) or islands[0].entry
+            exits_and_start = np.vstack((exits, start_position))
+            costs = np.hypot(*(exits_and_start[:, None, :] - entries[None, :, :]).transpose(2, 0, 1))
+            order = find_order(costs, is_first_fixed=False)
+            original_distance = path_cost(costs, np.arange(len(islands)))
+            optimised_distance = path_cost(costs, order)
+            if optimised_distance >= original_distance - 1e-6:
+                continue
+
+            optimised_lines.extend(layer.lines[position:islands[0].start])
+            optimised_lines.extend(self._reorder(layer, islands, order))
+            position = islands[-1].end
+            statistics.island_count += len(islands)
+            statistics.original_distance += original_distance
+            statistics.optimised_distance += optimised_distance
+        if not optimised_lines:
+            return layer.lines
+        statistics.reordered_layer_count += 1
+        optimised_lines.extend(layer.lines[position:])
+        return optimised_lines
+
+    def _find_islands(self, layer: '_Layer', start: int, end: int) -> Optional[list[_Island]]:
+        '''The islands of a run of moves and auger lines, or None if there are not several that can be reordered.
+        Lines before the first travel to an XY position stay in front of the islands.'''
+        island_starts = [comments_start for line, comments_start in
+                         ((line, layer.comments_start(line, start)) for line in range(start, end))
+                         if layer.kinds[line] == _TRAVEL and
+                         (comments_start == start or layer.kinds[comments_start - 1] != _TRAVEL) and
+                         layer.has_xy_travel(line, layer.travel_end(line, end))]
+        if len(island_starts) < 2:
+            return None
+        if layer.is_auger_on(island_starts[0] - 1) or any(
+                layer.is_auger_on(island_end - 1) for island_end in island_starts[1:] + [end]):
+            return None
+
+        # only the positions inside the run are used, as other lines may be in another WCS or incremental
+        has_z = layer.find_word(b"Z", end - 1, start) is not None
+        islands = []
+        for island_start, island_end in zip(island_starts, island_starts[1:] + [end]):
+            travel_end = layer.travel_end(island_start, island_end)
+            entry = layer.find_position(travel_end - 1, start)
+            exit_position = layer.find_position(island_end - 1, start)
+            if entry is None or exit_position is None or (
+                    has_z and layer.find_word(b"Z", travel_end - 1, start) is None):
+                return None
+            island = _Island(island_start, layer.travel(island_start, travel_end, start), travel_end, island_end,
+                             entry, exit_position,
+                             {letter: self._find_extrusion(layer, letter, island_start - 1)
+                              for letter in _EXTRUSION_LETTERS},
+                             {letter: self._find_extrusion(layer, letter, island_end - 1)
+                              for letter in _EXTRUSION_LETTERS})
+            for letter in _EXTRUSION_LETTERS:
+                if island.extrusion_before[letter] is None and island.extrusion_after[letter] is not None:
+                    return None  # cannot offset the extrusion without its value before the island
+            islands.append(island)
+        return islands
+
+    def _reorder(self, layer: '_Layer', islands: list[_Island], order: np.ndarray) -> list[bytes]:
+        reordered_lines = []
+        extrusion = dict(islands[0].extrusion_before)
+        # the sums of the values of the run and the value before it have no more decimals than them
+        words = [word for _, word in _EXTRUSION_WORD_PATTERN.findall(
+            b"".join(layer.lines[islands[0].start:islands[-1].end]))]
+        words += [str(value).removesuffix(".0").encode() for value in extrusion.values() if value is not None]
+        decimals = max(map(_count_decimals, words), default=0)
+        is_trimmed = not any(word.endswith(b"0") and b"." in word for word in words)
+        for island in (islands[index] for index in order):
+            reordered_lines.extend(island.travel)
+            offsets = {}
+            for letter in _EXTRUSION_LETTERS:
+                before, after = island.extrusion_before[letter], island.extrusion_after[letter]
+                if before is not None and after is not None and extrusion[letter] is not None:
+                    offsets[letter] = extrusion[letter] - before  # type: ignore
+                    extrusion[letter] += after - before  # type: ignore
+            island_lines = layer.lines[island.travel_end:island.end]
+            if any(offsets.values()):
+                reordered_lines.append(_offset_extrusion(b"".join(island_lines), offsets, decimals, is_trimmed))
+            else:
+                reordered_lines.extend(island_lines)
+        return reordered_lines
+
+    def _find_extrusion(self, layer: '_Layer', letter: bytes, last_line: int) -> Optional[float]:
+        '''The A or B value after the line, from an earlier layer if the layer does not set it before'''
+        value = layer.find_word(letter, last_line, 0)
+        return float(value) if value is not None else self._last_extrusion[letter]
+
+
+class _Layer:
+    '''The lines of a layer, with the kind of each line. Words are found in the text of the whole layer, as looking
+    back for the last A or B may go through most of the layer.'''
+
+    def __init__(self, lines: list[bytes]) -> None:
+        self.lines = lines
+        self.kinds = list(map(_get_kind, lines))
+        self._text = b"".join(lines)
+        self._line_starts = list(accumulate(map(len, lines), initial=0))
+        self._has_word = {letter: b" " + letter in self._text for letter in _WORD_LETTERS}  # e.g. no B without polymer
+
+    def runs(self) -> Iterable[tuple[int, int]]:
+        '''Start and end (exclusive) of each run of travels, extrusions, auger lines and comments, without the comments
+        at its end'''
+        start = None
+        for line, kind in enumerate(self.kinds + [_OTHER]):
+            if kind != _OTHER and start is None:
+                start = line
+            elif kind == _OTHER and start is not None:
+                end = line
+                while end > start and self.kinds[end - 1] == _COMMENT:
+                    end -= 1
+                if end > start:
+                    yield start, end
+                start = None
+
+    def travel_end(self, start: int, end: int) -> int:
+        '''First line after the travels from the start, and the comments between them'''
+        line = travel_end = start
+        while line < end and self.kinds[line] in (_TRAVEL, _COMMENT):
+            line += 1
+            if self.kinds[line - 1] == _TRAVEL:
+                travel_end = line
+        return travel_end
+
+    def comments_start(self, line: int, run_start: int) -> int:
+        '''First of the comments just before the line'''
+        while line > run_start and self.kinds[line - 1] == _COMMENT:
+            line -= 1
+        return line
+
+    def has_xy_travel(self, start: int, end: int) -> bool:
+        return any(self.kinds[line] == _TRAVEL and _has_xy(self.lines[line]) for line in range(start, end))
+
+    def is_auger_on(self, last_line: int) -> bool:
+        for line in range(last_line, -1, -1):
+            if self.kinds[line] == _AUGER:
+                return self.lines[line].rstrip() == _AUGER_ON
+        return False
+
+    def find_word(self, letter: bytes, last_line: int, first_line: int) -> Optional[bytes]:
+        '''The value of the last word with the letter from the last line back to the first line, as written'''
+        if last_line < first_line or not self._has_word[letter]:
+            return None
+        start, end = self._line_starts[first_line], self._line_starts[last_line + 1]
+        while (position := self._text.rfind(b" " + letter, start, end)) >= 0:
+            line = bisect_right(self._line_starts, position) - 1
+            code, _ = split_comment(self.lines[line])
+            match = _WORD_PATTERNS[letter].search(code)
+            if match is not None:
+                return match.group('value')
+            end = self._line_starts[line]
+        return None
+
+    def find_position(self, last_line: int, first_line: int) -> Optional[tuple[float, float]]:
+        x, y = self.find_word(b"X", last_line, first_line), self.find_word(b"Y", last_line, first_line)
+        return (float(x), float(y)) if x is not None and y is not None else None
+
+    def travel(self, start: int, end: int, run_start: int) -> list[bytes]:
+        '''One G0 to the first point of the island, after the Z moves (e.g. lifts) of its travel.
+        The Z of the island is only written if the run sets it, as Z words before the run may be incremental.'''
+        last_xy = max(line for line in range(start, end) if self.kinds[line] == _TRAVEL and _has_xy(self.lines[line]))
+        words = [b"G0"]
+        for letter, first_line in ((b"X", run_start), (b"Y", run_start), (b"Z", run_start), (b"F", last_xy)):
+            value = self.find_word(letter, last_xy, first_line)
+            if value is not None:
+                words.append(letter + value)
+        line_ending = self.lines[last_xy][len(self.lines[last_xy].rstrip()):]
+        return ([line for kind, line in zip(self.kinds[start:last_xy], self.lines[start:last_xy])
+                 if kind != _TRAVEL or not _has_xy(line)]
+                + [b" ".join(words) + line_ending]
+                + self.lines[last_xy + 1:end])
+
+
+def _get_kind(line: bytes) -> int:
+    if line.startswith(b";"):
+        return _OTHER if _RUN_END_COMMENT_PATTERN.match(line) else _COMMENT
+    match = _LINE_PATTERN.fullmatch(line)
+    return _OTHER if match is None else _KINDS[match.lastgroup]  # type: ignore
+
+
+def _has_xy(line: bytes) -> bool:
+    return b" X" in line or b" Y" in line
+
+
+def _offset_extrusion(gcode: bytes, offsets: dict[bytes, float], decimals: int, is_trimmed: bool) -> bytes:
+    '''Add the offsets to the A and B words, without trailing zeros if the words do not have them (like xyzFormat of
+    the ceramic post processor)'''
+    parts = _EXTRUSION_WORD_PATTERN.split(gcode)  # text, letter, value, text, ...
+    letters = np.array(parts[1::3])
+    values = (np.array(parts[2::3]).astype(float)
+              + np.select([letters == b" " + letter for letter in offsets], list(offsets.values())))
+    parts[2::3] = [_format_extrusion(value, decimals, is_trimmed) for value in values.tolist()]
+    return b"".join(parts)
+
+
+def _format_extrusion(value: float, decimals: int, is_trimmed: bool) -> bytes:
+    text = f"{value:.{decimals}f}"
+    if is_trimmed and "." in text:
+        text = text.rstrip("0").rstrip(".")
+    return text.encode()
+
+
+def _count_decimals(word: bytes) -> int:
+    point = word.find(b".")
+    return len(word) - point - 1 if point >= 0 else 0
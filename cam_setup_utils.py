@@ -1,5 +1,6 @@
 import os
 from pathlib import Path
+import re
 import adsk.core
 import adsk.cam
 import adsk.fusion
@@ -80,26 +81,17 @@ def create_finishing_setup(cam: adsk.cam.CAM, name="Finishing") -> adsk.cam.Setu
     return setup
 
 
-def create_face_milling_setup(cam: adsk.cam.CAM, rootComp: adsk.fusion.Component, new_setup_name) -> adsk.cam.Setup | None:
-    """Creates a setup with a single Adaptive2D operation to be used for planarisation/defect correction"""
-    # create milling setup
-    setupInput = cam.setups.createInput(adsk.cam.OperationTypes.MillingOperation)  # type: ignore
+SKIM_OPERATION_NAME = "Skim"
+
 
+def create_face_milling_setup(cam: adsk.cam.CAM, rootComp: adsk.fusion.Component, new_setup_name) -> adsk.cam.Setup | None:
+    """Creates a setup with an Adaptive2D operation to be used for planarisation/defect correction, and a skim operation
+    to be used for over-extrusion removal"""
     # create Milling manufacturing model
     manufacturing_model_occs = _try_create_manufacturing_model(cam, "Milling", raft_offset=True)
     if manufacturing_model_occs is None:
         raise RuntimeError("Could not create manufacturing model")
-    setupInput.models = manufacturing_model_occs  # type: ignore
-
-    # add setup
-    setup = cam.setups.add(setupInput)
-    setup.parameters.itemByName("wcs_origin_mode").expression = "'modelOrigin'"
-
-    # create Adaptive2D operation from template
-    operation_template = adsk.cam.CAMTemplate.createFromFile(str(config.DEFECT_CORRECTION_TEMPLATE_PATH))
-    template_input = adsk.cam.CreateFromCAMTemplateInput.create()
-    template_input.camTemplate = operation_template
-    setup.createFromCAMTemplate2(template_input)
+    setup = _add_face_milling_setup(cam, manufacturing_model_occs)
     adaptive2D = setup.operations[0]
 
     # select top face and ensure the same setup does not exist already
@@ -115,6 +107,67 @@ def create_face_milling_setup(cam: adsk.cam.CAM, rootComp: adsk.fusion.Component
     return setup
 
 
+def create_slice_setup(cam: adsk.cam.CAM, models: list, new_setup_name) -> adsk.cam.Setup:
+    """Creates a face milling setup for slices of the part (the slice component, or the bodies of one section) without
+    generating a toolpath, so that the toolpaths of several slices can be generated together"""
+    setup = _add_face_milling_setup(cam, models)
+    setup.name = new_setup_name
+    return setup
+
+
+def reset_slice_setup(setup: adsk.cam.Setup):
+    """Clears the pocket selections of the operations of a slice setup in place, so that the setup can be reused for the
+    next slice instead of being deleted and created again. The faces of the previous section are deleted with it, and
+    the warnings of the operations are cleared when their toolpaths are next generated."""
+    for operation in setup.operations:
+        pockets_parameter = adsk.cam.CadContours2dParameterValue.cast(operation.parameters.itemByName("pockets").value)
+        pocket_selections = pockets_parameter.getCurveSelections()
+        pocket_selections.clear()
+        pockets_parameter.applyCurveSelections(pocket_selections)
+
+
+def get_milling_model_occurrence(cam: adsk.cam.CAM) -> adsk.fusion.Occurrence:
+    """The occurrence of the part in the Milling manufacturing model, which is offset for the raft"""
+    manufacturing_model_occs = _try_create_manufacturing_model(cam, "Milling", raft_offset=True)
+    if manufacturing_model_occs is None:
+        raise RuntimeError("Could not create manufacturing model")
+    return manufacturing_model_occs[0]
+
+
+def _add_face_milling_setup(cam: adsk.cam.CAM, models: list) -> adsk.cam.Setup:
+    # create milling setup
+    setupInput = cam.setups.createInput(adsk.cam.OperationTypes.MillingOperation)  # type: ignore
+    setupInput.models = models  # type: ignore
+
+    # add setup
+    setup = cam.setups.add(setupInput)
+    setup.parameters.itemByName("wcs_origin_mode").expression = "'modelOrigin'"
+
+    # create Adaptive2D operation from template
+    operation_template = adsk.cam.CAMTemplate.createFromFile(str(config.DEFECT_CORRECTION_TEMPLATE_PATH))
+    template_input = adsk.cam.CreateFromCAMTemplateInput.create()
+    template_input.camTemplate = operation_template
+    setup.createFromCAMTemplate2(template_input)
+    _add_skim_operation(setup, setup.operations[0])
+    return setup
+
+
+def _add_skim_operation(setup: adsk.cam.Setup, adaptive2D: adsk.cam.Operation) -> adsk.cam.Operation:
+    """Adds a 2D pocket with the tool of the Adaptive2D operation, cutting the top face in a single depth with a large
+    stepover. Over-extrusions only stand proud of the top of the layer, so they do not need the full Adaptive2D clearing."""
+    operation_input = setup.operations.createInput('pocket2d')
+    operation_input.tool = adaptive2D.tool
+    operation_input.displayName = SKIM_OPERATION_NAME
+    operation_input.parameters.itemByName("maximumStepover").expression = f"tool_diameter * {config.SKIM_STEPOVER}"
+    operation_input.parameters.itemByName("doMultipleDepths").expression = "false"
+    return setup.operations.add(operation_input)
+
+
+def get_skim_operation(setup: adsk.cam.Setup) -> adsk.cam.Operation | None:
+    # found by strategy, as the operations are renamed after the slice they are posted for
+    return next(filter(lambda o: o.strategy == 'pocket2d', setup.operations), None)
+
+
 def _get_printsetting_through_library(printsetting_path: Path, libraryManager: adsk.cam.CAMLibraryManager):
     printsetting_name = "Ceramic and Polymer"
     printsetting_xml = ET.parse(printsetting_path)
@@ -197,11 +250,22 @@ def _offset_for_raft(occs:list[adsk.fusion.Occurrence]):
 
 
 def _try_update_adaptive2d_face(cam: adsk.cam.CAM, comp: adsk.fusion.Component, setup: adsk.cam.Setup, operation: adsk.cam.Operation) -> float | None:
-    """Sets the pocket parameter on an Adaptive2D operation to the top face and returns the height of the face or None if the face was not found.
+    """Sets the pocket parameter on an Adaptive2D operation (and the skim operation of the setup) to the top face and returns the height of the face or None if the face was not found.
     Necessary to run at each height for planarisation/defect correction G-code generation, otherwise not all faces may be machined if the 
     part splits, e.g. if it has legs, only one leg may get machined otherwise."""
+    top_face_z = _select_top_face(list(comp.bRepBodies), setup, operation)
+    if top_face_z is None:
+        return None
+    future = cam.generateToolpath(setup)
+    while not future.isGenerationCompleted:
+        adsk.doEvents()
+    return top_face_z
+
+
+def _select_top_face(bodies: list[adsk.fusion.BRepBody], setup: adsk.cam.Setup, operation: adsk.cam.Operation) -> float | None:
+    """Sets the pocket parameter on an Adaptive2D operation (and the skim operation of the setup) to the top face of the bodies and returns the height of the face or None if the face was not found."""
     # find the top face for each body
-    top_faces = [_get_top_face(body) for body in comp.bRepBodies]
+    top_faces = [_get_top_face(body) for body in bodies]
 
     # select the top face of one of the bodies
     if all(map(lambda f: f is None, top_faces)):
@@ -211,23 +275,48 @@ def _try_update_adaptive2d_face(cam: adsk.cam.CAM, comp: adsk.fusion.Component,
     if top_face is None:
         futil.log("no top face 2")
         return None
-    futil.log(f"number of bods: {comp.bRepBodies.count}")
-    futil.log(f"model name: {comp.name}")
+    futil.log(f"number of bods: {len(bodies)}")
     futil.log(f"top face: {top_face.boundingBox.minPoint.z*10}")
-    # set this face as the pocket for the clearing operation
-    pockets_parameter = adsk.cam.CadContours2dParameterValue.cast(operation.parameters.itemByName("pockets").value)
-    pocket_selections = pockets_parameter.getCurveSelections()
-    pocket_selections.clear()
-    new_selection = pocket_selections.createNewPocketSelection()
-    new_selection.inputGeometry = [top_face]
-    new_selection.isSelectingSamePlaneFaces = True
-    pockets_parameter.applyCurveSelections(pocket_selections)
-    future = cam.generateToolpath(setup)
-    while not future.isGenerationCompleted:
-        adsk.doEvents()
+    # set this face as the pocket for the clearing and skim operations
+    skim_operation = get_skim_operation(setup)
+    for pocket_operation in filter(None, (operation, skim_operation)):
+        pockets_parameter = adsk.cam.CadContours2dParameterValue.cast(pocket_operation.parameters.itemByName("pockets").value)
+        pocket_selections = pockets_parameter.getCurveSelections()
+        pocket_selections.clear()
+        new_selection = pocket_selections.createNewPocketSelection()
+        new_selection.inputGeometry = [top_face]
+        new_selection.isSelectingSamePlaneFaces = True
+        pockets_parameter.applyCurveSelections(pocket_selections)
     return top_face.boundingBox.minPoint.z*10
 
 
+def has_pocket(bodies: list[adsk.fusion.BRepBody], slicing_height_mm: float, tool_diameter_mm: float) -> bool:
+    """Checks from the B-rep of the sliced part whether a pocket can be machined at the height, without generating a
+    toolpath: a body must have a flat top face at the height, and the face must be at least as wide as the tool."""
+    for body in bodies:
+        if abs(body.boundingBox.maxPoint.z*10 - slicing_height_mm) > config.PLANARISING_HEIGHT_TOLERANCE:
+            continue
+        top_face = _get_top_face(body)
+        if top_face is None or adsk.core.Plane.cast(top_face.geometry) is None:
+            continue
+        face_box = top_face.boundingBox
+        face_width = min(face_box.maxPoint.x - face_box.minPoint.x, face_box.maxPoint.y - face_box.minPoint.y)*10
+        if face_width >= tool_diameter_mm:
+            return True
+    return False
+
+
+def get_template_tool_diameter(template_path: Path = config.DEFECT_CORRECTION_TEMPLATE_PATH) -> float:
+    """Diameter in mm of the tool of an operation template, read from the template without creating the operation"""
+    template_xml = ET.parse(template_path)
+    tool_diameter = template_xml.getroot().find(".//{*}tool/{*}expressions/{*}expression[@parameterKey='tool_diameter']")
+    match = re.fullmatch(r"\s*(?P<value>[\d.]+)\s*(?P<unit>mm|in)\s*", tool_diameter.get("value", "")) \
+        if tool_diameter is not None else None
+    if match is None:
+        raise RuntimeError(f"No tool diameter in {template_path.name}")
+    return float(match.group('value')) * (25.4 if match.group('unit') == "in" else 1)
+
+
 def _get_top_face(body: adsk.fusion.BRepBody) -> adsk.fusion.BRepFace | None:
     for face in body.faces:
         if (face.boundingBox.minPoint.z == body.boundingBox.maxPoint.z):
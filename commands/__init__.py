@@ -2,11 +2,13 @@
 from .hybridPostButton import HybridPostButton
 from .clonedCommands import ClonedCommands
 from .autoSetupButton import AutoSetupButton
+from .resumeButton import ResumeButton
 
 commands = [
     ClonedCommands(),
     AutoSetupButton(),
-    HybridPostButton()
+    HybridPostButton(),
+    ResumeButton()
 ]
 
 
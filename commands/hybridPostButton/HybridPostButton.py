@@ -7,6 +7,7 @@ from ... import config
 from ... import fusion_utils
 from ... import hybrid_utils
 from ...HybridPostProcessor import HybridPostProcessor
+from ...JobEstimate import JobEstimate, RunStatistics
 
 app = adsk.core.Application.get()
 ui: adsk.core.UserInterface = app.userInterface
@@ -34,11 +35,20 @@ class HybridPostButton:
         self.load_cell_data_tickbox: adsk.core.BoolValueCommandInput
         self.drying_tickbox: adsk.core.BoolValueCommandInput
         self.drying_time_input: adsk.core.IntegerSpinnerCommandInput
+        self.adaptive_drying_tickbox: adsk.core.BoolValueCommandInput
         self.defect_correction_tickbox: adsk.core.BoolValueCommandInput
         self.first_correction_layer_input: adsk.core.IntegerSpinnerCommandInput
+        self.subprograms_tickbox: adsk.core.BoolValueCommandInput
+        self.rapid_ordering_tickbox: adsk.core.BoolValueCommandInput
         self.finishing_milling_tickbox: adsk.core.BoolValueCommandInput
         self.finishing_milling_selector: adsk.core.DropDownCommandInput
+        self.reuse_additive_post_tickbox: adsk.core.BoolValueCommandInput
+        self.travel_ordering_tickbox: adsk.core.BoolValueCommandInput
+        self.arc_fitting_tickbox: adsk.core.BoolValueCommandInput
+        self.minify_tickbox: adsk.core.BoolValueCommandInput
         self.output_filename_input: adsk.core.StringValueCommandInput
+        self.estimate_text: adsk.core.TextBoxCommandInput
+        self.run_statistics: RunStatistics | None = None
 
         self.hybrid_config: hybrid_utils.HybridPostConfig
         self.last_doc: adsk.core.Document | None = None
@@ -104,6 +114,11 @@ class HybridPostButton:
         self.drying_time_input = inputs.addIntegerSpinnerCommandInput("dryingTime", "Drying Time", 1, 600, 1, 30)
         self.drying_time_input.tooltip = "Drying Time (s)"
         self.drying_time_input.tooltipDescription = "Drying Time in seconds"
+        self.adaptive_drying_tickbox = inputs.addBoolValueInput("adaptiveDrying", "Adaptive Drying", True)
+        self.adaptive_drying_tickbox.tooltip = "Only dry each layer as long as needed"
+        self.adaptive_drying_tickbox.tooltipDescription = "The drying time becomes the minimum time of a layer, \n \
+            including printing it. Each layer dries for the rest of that time, estimated from its moves, \n \
+            and layers that take longer to print than the minimum are not dried."
 
         # Defect correction
         self.defect_correction_tickbox = inputs.addBoolValueInput("defectCorrection", "Defect Correction", True)
@@ -117,6 +132,14 @@ class HybridPostButton:
         self.first_correction_layer_input.tooltip = "First correction layer"
         self.first_correction_layer_input.tooltipDescription = "Including raft. e.g. if you have 3 layers of raft,\n \
             the first layer you should be correcting is 4."
+        self.subprograms_tickbox = inputs.addBoolValueInput("useSubprograms", "Subprograms", True)
+        self.subprograms_tickbox.tooltip = "Output repeated defect correction toolpaths as subprograms"
+        self.subprograms_tickbox.tooltipDescription = "Toolpaths that only differ in height are output once as an M98/M99 \n \
+            subprogram and called with a G52 Z offset. This makes the file much smaller for prismatic parts."
+        self.rapid_ordering_tickbox = inputs.addBoolValueInput("optimiseRapids", "Rapid ordering", True)
+        self.rapid_ordering_tickbox.tooltip = "Reorder the regions of the defect correction toolpaths to shorten the rapids"
+        self.rapid_ordering_tickbox.tooltipDescription = "Regions that are cut separately, e.g. islands, are reordered \n \
+            so that the tool travels less between them. The rapids between regions stay at the highest retract height."
 
         # Finishing
         self.finishing_milling_tickbox = inputs.addBoolValueInput("contourMilling", "Finishing", True)
@@ -133,6 +156,36 @@ class HybridPostButton:
             Do not use together with polymer supports or rafts."
         self._update_finishing_milling_setup_selector(app.activeDocument)
 
+        # Reuse additive post
+        self.reuse_additive_post_tickbox = inputs.addBoolValueInput("reuseAdditivePost", "Reuse additive post", True)
+        self.reuse_additive_post_tickbox.tooltip = "Render the options above from the last additive post of this document"
+        self.reuse_additive_post_tickbox.tooltipDescription = "Skips post processing the additive setup, which makes \n \
+            trying several variants of imaging, drying, laser scanning, load cell and defect correction options fast. \n \
+            The setup is posted again if the document has unsaved changes, or its version or toolpath parameters changed."
+
+        # Travel ordering
+        self.travel_ordering_tickbox = inputs.addBoolValueInput("optimiseTravels", "Travel ordering", True)
+        self.travel_ordering_tickbox.tooltip = "Reorder the islands of each layer to shorten the travels between them"
+        self.travel_ordering_tickbox.tooltipDescription = "Islands are printed nearest first instead of in Fusion's order, \n \
+            so the nozzle travels less. Layer change blocks and extruder changes stay in place."
+
+        # Arc fitting
+        self.arc_fitting_tickbox = inputs.addBoolValueInput("fitArcs", "Arc fitting", True)
+        self.arc_fitting_tickbox.tooltip = "Replace linear moves on a circle with arcs in the milling G-code"
+        self.arc_fitting_tickbox.tooltipDescription = "Runs of short G1 moves in the milling inserts are replaced \n \
+            with G2/G3 arcs where they are within tolerance, for smoother and faster milling."
+
+        # Minify
+        self.minify_tickbox = inputs.addBoolValueInput("minifyOutput", "Minify G-code", True)
+        self.minify_tickbox.tooltip = "Minify the output G-code"
+        self.minify_tickbox.tooltipDescription = "Removes comments, repeated modal words, unchanged coordinates \n \
+            and trailing zeros. The program does the same, but is smaller and faster to transfer."
+
+        # Estimate
+        self.estimate_text = inputs.addTextBoxCommandInput("jobEstimate", "Estimate", "", 3, True)
+        self.estimate_text.tooltip = "Estimated from the last post of this document"
+        self.run_statistics = RunStatistics.load(app.activeDocument.name)
+
         # Output
         output_group = inputs.addGroupCommandInput("outputPathSelectorGroup", "Output")
         self.output_folder_browser_button = output_group.children.addBoolValueInput(
@@ -161,6 +214,7 @@ class HybridPostButton:
             self._restore_selections()
         else:
             self._update_config()
+        self._update_estimate()
 
         self.last_doc = app.activeDocument
 
@@ -207,7 +261,10 @@ class HybridPostButton:
         """Enable/disable (grey out) inputs"""
         self.defect_correction_tickbox.isEnabled = self.imaging_tickbox.value
         self.drying_time_input.isEnabled = self.drying_tickbox.value
+        self.adaptive_drying_tickbox.isEnabled = self.drying_tickbox.value
         self.first_correction_layer_input.isEnabled = self.defect_correction_tickbox.value
+        self.subprograms_tickbox.isEnabled = self.defect_correction_tickbox.value
+        self.rapid_ordering_tickbox.isEnabled = self.defect_correction_tickbox.value
         self.finishing_milling_selector.isEnabled = self.finishing_milling_tickbox.value
 
     def command_input_changed(self, args: adsk.core.InputChangedEventArgs):
@@ -238,6 +295,15 @@ class HybridPostButton:
                                     "Defect Correction")
 
         self._update_config()
+        self._update_estimate()
+
+    def _update_estimate(self):
+        '''Show the cost of the selected options. Only cached statistics are added up, so that it is instant.'''
+        if self.run_statistics is None:
+            self.estimate_text.formattedText = "Post once to estimate the cost of the options"
+            return
+        estimate = JobEstimate.estimate(self.run_statistics, self.hybrid_config)
+        self.estimate_text.formattedText = str(estimate).replace("\n", "<br>")
 
     def _update_finishing_milling_setup_selector(self, doc):
         """Update the list of dropdown items in the Finishing Milling selector"""
@@ -258,11 +324,18 @@ class HybridPostButton:
             laserScanning=self.laser_scanning_tickbox.value,
             collectLoadCellData=self.load_cell_data_tickbox.value,
             dryingTime=0 if self.drying_tickbox.value == False else self.drying_time_input.value,
+            adaptiveDrying=self.adaptive_drying_tickbox.value,
             finishingMilling=self.finishing_milling_tickbox.value,
             finishingMillingSetup=self.finishing_milling_selector.selectedItem.name if (
                 self.finishing_milling_tickbox.value == True and self.finishing_milling_selector.selectedItem is not None) else "",
             defectCorrection=self.defect_correction_tickbox.value,
             firstCorrectionLayer=self.first_correction_layer_input.value,
+            useSubprograms=self.subprograms_tickbox.value,
+            optimiseRapids=self.rapid_ordering_tickbox.value,
+            reuseAdditivePost=self.reuse_additive_post_tickbox.value,
+            optimiseTravels=self.travel_ordering_tickbox.value,
+            fitArcs=self.arc_fitting_tickbox.value,
+            minifyOutput=self.minify_tickbox.value,
             outputFilePath=Path(self.output_folder_input.value) / self.output_filename_input.value
         )
 
@@ -274,6 +347,7 @@ class HybridPostButton:
         self.load_cell_data_tickbox.value = hybrid_config.collectLoadCellData
         self.drying_tickbox.value = hybrid_config.dryingTime != 0
         self.drying_time_input.value = hybrid_config.dryingTime
+        self.adaptive_drying_tickbox.value = hybrid_config.adaptiveDrying
         self.finishing_milling_tickbox.value = hybrid_config.finishingMilling
         finishing_setup_list_item = next(
             filter(lambda item: item.name == hybrid_config.finishingMillingSetup, self.finishing_milling_selector.listItems), None)
@@ -281,6 +355,12 @@ class HybridPostButton:
             finishing_setup_list_item.isSelected = True
         self.defect_correction_tickbox.value = hybrid_config.defectCorrection
         self.first_correction_layer_input.value = hybrid_config.firstCorrectionLayer
+        self.subprograms_tickbox.value = hybrid_config.useSubprograms
+        self.rapid_ordering_tickbox.value = hybrid_config.optimiseRapids
+        self.reuse_additive_post_tickbox.value = hybrid_config.reuseAdditivePost
+        self.travel_ordering_tickbox.value = hybrid_config.optimiseTravels
+        self.arc_fitting_tickbox.value = hybrid_config.fitArcs
+        self.minify_tickbox.value = hybrid_config.minifyOutput
         self.output_folder_input.value = str(hybrid_config.outputFilePath.parent)
         self.output_filename_input.value = hybrid_config.outputFilePath.name
 
@@ -0,0 +1,115 @@
+from pathlib import Path
+import traceback
+import adsk.core
+from ...lib import fusion360utils as futil
+from ... import config
+from ... import fusion_utils
+from ...ResumeProgram import ResumeProgram
+
+app = adsk.core.Application.get()
+ui: adsk.core.UserInterface = app.userInterface
+
+# Local list of event handlers used to maintain a reference so
+# they are not released and garbage collected.
+local_handlers = []
+
+
+class ResumeButton:
+    CMD_ID = f'{config.COMPANY_NAME}_{config.ADDIN_NAME}_resumeDialog'
+    CMD_NAME = 'Resume From Layer'
+    CMD_Description = 'Creates a program that resumes a hybrid program from the start of a layer, e.g. after a nozzle clog. \
+        Fusion is not needed for this, the program is created from the G-code.'
+
+    IS_PROMOTED = False
+
+    BUTTON_ID = 'ResumeFromLayerCommand'
+
+    ICON_FOLDER = Path(__file__).parents[1].joinpath('hybridPostButton', 'resources', 'HybridPostButton')
+
+    def __init__(self):
+        self.program_file_input: adsk.core.StringValueCommandInput
+        self.program_file_browser_button: adsk.core.BoolValueCommandInput
+        self.layer_input: adsk.core.IntegerSpinnerCommandInput
+        self.registered_command_definitions: list[adsk.core.CommandDefinition] = []
+
+    def start(self):
+        '''Executed when add-in is started. Creates a button in the ribbon.'''
+        workspace = ui.workspaces.itemById('CAMEnvironment')
+        hybrid_tab = fusion_utils.try_create_tab(workspace, "Hybrid", config.HYBRID_TAB_ID)
+        post_panel = fusion_utils.try_create_panel(workspace, hybrid_tab, "Post", config.POST_PANEL_ID)
+
+        resume_cmd_def = ui.commandDefinitions.addButtonDefinition(
+            ResumeButton.CMD_ID, ResumeButton.CMD_NAME, ResumeButton.CMD_Description, str(ResumeButton.ICON_FOLDER))
+        futil.add_handler(resume_cmd_def.commandCreated, self.command_created)
+
+        resume_button = post_panel.controls.addCommand(resume_cmd_def, ResumeButton.BUTTON_ID, False)
+        resume_button.isPromoted = ResumeButton.IS_PROMOTED
+        self.registered_command_definitions.append(resume_cmd_def)
+
+    def stop(self):
+        '''Executed when add-in is stopped. Removes button from the ribbon.'''
+        manufacturing_workspace = ui.workspaces.itemById('CAMEnvironment')
+        hybridTab = manufacturing_workspace.toolbarTabs.itemById(config.HYBRID_TAB_ID)
+        fusion_utils.try_remove_panel(hybridTab, config.POST_PANEL_ID)
+
+        for command_definition in self.registered_command_definitions:
+            command_definition.deleteMe()
+
+    def command_created(self, args: adsk.core.CommandCreatedEventArgs):
+        '''Function that is called when a user clicks the command's button in the UI.
+        It defines the contents of the command dialog and connects to the command related events.'''
+        futil.log(f'{ResumeButton.CMD_NAME} Command Created Event, args: {args}')
+        inputs = args.command.commandInputs
+
+        self.program_file_input = inputs.addStringValueInput(
+            "programFile", "Program", str(config.OUTPUT_FOLDER.joinpath(f"{app.activeDocument.name}.tap")))
+        self.program_file_input.tooltip = "The hybrid program to resume"
+        self.program_file_browser_button = inputs.addBoolValueInput(
+            "programFileBrowser", "Browse", False, str(Path(__file__).parents[1].joinpath('hybridPostButton', 'resources', 'FolderButton')))
+        self.layer_input = inputs.addIntegerSpinnerCommandInput("layer", "Resume at layer", 1, 100000, 1, 1)
+        self.layer_input.tooltip = "The first layer to print"
+        self.layer_input.tooltipDescription = "The layers before it are assumed to be finished (including their \n \
+            drying and defect correction). The program is written next to the original one."
+
+        args.command.isExecutedWhenPreEmpted = False
+        args.command.okButtonText = "Create"
+
+        futil.add_handler(args.command.execute, self.command_execute, local_handlers=local_handlers)
+        futil.add_handler(args.command.inputChanged, self.command_input_changed, local_handlers=local_handlers)
+        futil.add_handler(args.command.validateInputs, self.command_validate_input, local_handlers=local_handlers)
+        futil.add_handler(args.command.destroy, self.command_destroy, local_handlers=local_handlers)
+
+    def command_execute(self, args: adsk.core.CommandEventArgs):
+        '''This event handler is called when the user clicks the OK button in the command dialog'''
+        futil.log(f'{ResumeButton.CMD_NAME} Command Execute Event')
+        program_file = Path(self.program_file_input.value)
+        output_file = ResumeProgram.default_output_path(program_file, self.layer_input.value)
+        try:
+            ResumeProgram(program_file).write(self.layer_input.value, output_file)
+        except Exception as e:
+            fusion_utils.messageBox(ui, str(e) + traceback.format_exc(), title="Error while creating the resume program",
+                                    icon=adsk.core.MessageBoxIconTypes.CriticalIconType)
+            args.executeFailed = True
+            args.executeFailedMessage = str(e)
+            return
+        fusion_utils.show_folder(output_file.parent)
+
+    def command_input_changed(self, args: adsk.core.InputChangedEventArgs):
+        '''This event handler is called when the user changes anything in the command dialog'''
+        if args.input == self.program_file_browser_button:
+            file_browser = ui.createFileDialog()
+            file_browser.title = "Hybrid program"
+            file_browser.filter = "G-code (*.tap);;All files (*.*)"
+            file_browser.initialDirectory = str(Path(self.program_file_input.value).parent)
+            if file_browser.showOpen() == adsk.core.DialogResults.DialogOK:
+                self.program_file_input.value = file_browser.filename
+
+    def command_validate_input(self, args: adsk.core.ValidateInputsEventArgs):
+        '''This event handler is called when the user interacts with any of the inputs in the dialog'''
+        args.areInputsValid = Path(self.program_file_input.value).is_file()
+
+    def command_destroy(self, args: adsk.core.CommandEventArgs):
+        '''This event handler is called when the command terminates.'''
+        futil.log(f'{ResumeButton.CMD_NAME} Command Destroy Event')
+        global local_handlers
+        local_handlers = []
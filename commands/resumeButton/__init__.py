@@ -0,0 +1 @@
+from .ResumeButton import ResumeButton
\ No newline at end of file
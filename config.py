@@ -21,9 +21,20 @@ COMPANY_NAME = 'UniOfLeeds'
 DEFECT_CORRECTION_SETUP_NAME = "Defect Correction (with operation template)"
 LAYER_HEIGHT = 0.6
 RAFT_HEIGHT = 1.8
+SKIM_STEPOVER = 0.9  # fraction of the tool diameter, between the passes of the over-extrusion removal skim
+SLICING_BATCH_SIZE = 8  # heights sliced as copies of the part, generated in parallel and posted together
+PLANARISING_HEIGHT_TOLERANCE = 0.01  # mm, maximum difference between a placeholder and a planarising toolpath height
+ARC_FITTING_TOLERANCE = 0.01  # mm, maximum deviation of a fitted arc from the linear moves, no less than the toolpath tolerance
+PRINTING_Z_MIN = 0  # mm, lowest Z the output may print at
+MILLING_Z_MIN = RAFT_HEIGHT - PLANARISING_HEIGHT_TOLERANCE  # mm, lowest Z the output may mill at, above the raft
+PRINTING_FEED_MAX = 6000  # mm/min
+MILLING_FEED_MAX = 5000  # mm/min
+RAPID_FEED = 3000  # mm/min, to estimate machine times, e.g. for adaptive drying
+TRANSFORM_WORKERS = None  # number of processes transforming the output G-code, None for one per CPU core
 CENTER_BODY_IN_MANUFACTURING_MODEL = True
 
 OUTPUT_FOLDER = Path(__file__).parent.joinpath('outputs')
+CACHE_FOLDER = OUTPUT_FOLDER.joinpath('cache')  # kept between runs, unlike the temp folder
 
 ADDITIVE_POST_PROCESSOR_PATH = Path(__file__).parent.joinpath('post processors', 'Ceramic polymer post processor.cps')
 MILLING_POST_PROCESSOR_PATH = Path(__file__).parent.joinpath('post processors', 'mach4mill.cps')
@@ -0,0 +1,114 @@
+'''Runs G-code transforms over layer-bounded chunks of a file in a pool of worker processes.
+Fusion runs add-ins on its UI thread in a single interpreter, so CPU-bound passes over large programs are run in
+separate Python processes instead. Chunks only end at layer comments and the transforms forget their state at the
+start of every chunk, so the output only depends on the chunk size, not on the number of workers or their timing.
+This module is imported by the worker processes, so it must not import adsk.'''
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import multiprocessing
+import os
+from pathlib import Path
+import re
+import sys
+from typing import Callable, Iterable, Iterator, Optional
+from .gcode_transforms import Transform
+
+LAYER_PATTERN = re.compile(r";\s*Layer \d+ of \d+")
+CHUNK_LINES = 100_000  # minimum number of lines per chunk, the chunk is extended to the next layer comment
+MIN_PARALLEL_FILE_SIZE = 8 * 1024 * 1024  # smaller files are transformed in process, starting workers takes longer
+
+
+class TransformPipeline:
+    '''An ordered list of transforms applied to the combined G-code.
+    Chunks are submitted in order and at most a few per worker are in flight, so memory use does not grow with the
+    file size, and the results are written in the order of the chunks.'''
+
+    def __init__(self, transforms: list[Transform], max_workers: Optional[int] = None, chunk_lines: int = CHUNK_LINES) -> None:
+        self.transforms = transforms
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.chunk_lines = chunk_lines
+
+    def run(self, source: Path, destination: Path, progress: Optional[Callable[[float], None]] = None):
+        '''Stream the source file through the transforms into the destination file.
+        The progress callback is called from the calling thread with the fraction of the source done after each chunk,
+        e.g. to keep the UI responsive.'''
+        source_size = max(os.path.getsize(source), 1)
+        python_executable = find_python_executable()
+        is_parallel = self.max_workers > 1 and source_size >= MIN_PARALLEL_FILE_SIZE and python_executable is not None
+
+        with open(source, newline='') as infile, open(destination, 'w', newline='') as outfile:
+            chunks = read_chunks(infile, self.chunk_lines)
+            if is_parallel:
+                context = multiprocessing.get_context('spawn')
+                context.set_executable(str(python_executable))
+                _add_package_root_to_path()
+                with ProcessPoolExecutor(self.max_workers, mp_context=context) as executor:
+                    self._write_results(self._map_in_order(executor, chunks), outfile, source_size, progress)
+            else:
+                results = ((transform_chunk(self.transforms, chunk), _count_characters(chunk)) for chunk in chunks)
+                self._write_results(results, outfile, source_size, progress)
+
+    def _map_in_order(self, executor: ProcessPoolExecutor, chunks: Iterable[list[str]]) -> Iterator[tuple[str, int]]:
+        in_flight: deque[tuple[Future, int]] = deque()
+        for chunk in chunks:
+            in_flight.append((executor.submit(transform_chunk, self.transforms, chunk), _count_characters(chunk)))
+            if len(in_flight) >= 2 * self.max_workers:
+                future, size = in_flight.popleft()
+                yield future.result(), size
+        while in_flight:
+            future, size = in_flight.popleft()
+            yield future.result(), size
+
+    @staticmethod
+    def _write_results(results: Iterable[tuple[str, int]], outfile, source_size: int,
+                       progress: Optional[Callable[[float], None]]):
+        done = 0
+        for text, size in results:
+            outfile.write(text)
+            done += size
+            if progress is not None:
+                progress(min(done / source_size, 1.0))
+
+
+def transform_chunk(transforms: list[Transform], lines: list[str]) -> str:
+    '''Runs in the worker processes'''
+    transformed_lines: Iterable[str] = lines
+    for transform in transforms:
+        transformed_lines = transform(transformed_lines)
+    return "".join(transformed_lines)
+
+
+def read_chunks(lines: Iterable[str], chunk_lines: int) -> Iterator[list[str]]:
+    '''Group the lines into chunks of at least chunk_lines lines, each ending just before a layer comment'''
+    chunk: list[str] = []
+    for line in lines:
+        if len(chunk) >= chunk_lines and LAYER_PATTERN.match(line):
+            yield chunk
+            chunk = []
+        chunk.append(line)
+    if chunk:
+        yield chunk
+
+
+def find_python_executable() -> Optional[Path]:
+    '''Returns the Python interpreter to start the workers with, or None if there is none.
+    Inside Fusion, sys.executable is Fusion itself, and its Python interpreter is installed next to it.'''
+    executable = Path(sys.executable)
+    if executable.stem.lower().startswith('python'):
+        return executable
+    for candidate in (executable.parent / 'Python' / 'python.exe', executable.parent / 'Python' / 'bin' / 'python3'):
+        if candidate.exists():
+            return candidate
+    return None
+
+
+def _add_package_root_to_path():
+    '''The workers import the transforms by module name, which includes the add-in folder as package.
+    Spawned processes start with the sys.path of the parent.'''
+    package_root = str(Path(__file__).resolve().parents[__name__.count('.')])
+    if package_root not in sys.path:
+        sys.path.append(package_root)
+
+
+def _count_characters(lines: list[str]) -> int:
+    return sum(map(len, lines))
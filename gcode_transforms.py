@@ -0,0 +1,363 @@
+'''Transforms applied to the combined G-code after the additive and milling G-code have been merged.
+A transform is a callable that takes an iterable of lines (with line endings) and yields the transformed lines.
+Transforms are run over chunks of the G-code in worker processes (see gcode_pipeline), so they must be picklable
+and start from an unknown state at every call.'''
+import math
+import re
+from typing import Callable, Iterable, Iterator, Optional
+from .gcode_utils import split_comment
+
+Transform = Callable[[Iterable[str]], Iterator[str]]
+
+# comments that other tools rely on to find their way around the combined G-code
+STRUCTURAL_COMMENT_PATTERN = re.compile(r";\s*(?:PLACEHOLDER_|MILLING_INSERT_|Layer \d+ of \d+)|\(\s*MSG", re.IGNORECASE)
+INSERT_START_PATTERN = re.compile(r";MILLING_INSERT_START")
+INSERT_END_PATTERN = re.compile(r";MILLING_INSERT_END")
+WORD_PATTERN = re.compile(r"\s*(?P<letter>[A-Z])\s*(?P<value>[-+]?(?:\d+\.?\d*|\.\d+))")
+CONTROL_FLOW_PATTERN = re.compile(r"IF|GOTO|WHILE|#|\[")
+
+AXES = "XYZABC"
+TRIMMED_WORDS = "XYZABCIJKRF"
+# G codes that do not interact with the modal state tracked by the minifier
+PASSIVE_G_CODES = {"17", "18", "19", "20", "21", "40", "49", "64", "80", "90.1", "91.1", "94"}
+WORK_OFFSET_G_CODES = {"54", "55", "56", "57", "58", "59"}
+# G codes after which the position in the current work offset is not known (axis words are not moves in it)
+POSITION_RESET_G_CODES = {"28", "30", "52", "53", "92"}
+
+
+def normalise_g_code(value: str) -> str:
+    '''e.g. G00 -> 0, G90.0 -> 90'''
+    integer_part, _, fraction = trim_number(value).partition(".")
+    integer_part = integer_part.lstrip("0") or "0"
+    return f"{integer_part}.{fraction}" if fraction else integer_part
+
+
+def line_ending(line: str) -> str:
+    return line[len(line.rstrip("\r\n")):]
+
+
+def parse_words(code: str) -> Optional[list[tuple[str, str]]]:
+    '''Returns the letter and value of each word, or None if the code is not made up of simple words only'''
+    words = []
+    position = 0
+    code = code.rstrip()
+    while position < len(code):
+        match = WORD_PATTERN.match(code, position)
+        if match is None:
+            return None
+        words.append((match.group('letter'), match.group('value')))
+        position = match.end()
+    return words
+
+
+def trim_number(value: str) -> str:
+    '''Remove the plus sign, trailing zeros and trailing decimal point from a number'''
+    value = value.lstrip("+")
+    if "." in value:
+        value = value.rstrip("0").rstrip(".")
+    if value in ("", "-", "-0"):
+        return "0"
+    return value
+
+
+class Minifier:
+    '''Removes comments, repeated modal words, unchanged axis words and redundant number formatting.
+    The modal state is forgotten wherever the machine may arrive from elsewhere or do something the minifier
+    does not track (N labels, control flow, M codes, tool changes, work offset changes...),
+    so the result is semantically identical to the input.'''
+
+    def __init__(self) -> None:
+        self._reset()
+
+    def _reset(self):
+        self.motion: Optional[str] = None
+        self.is_absolute: Optional[bool] = None
+        self.feed: Optional[float] = None
+        self.positions: dict[str, Optional[float]] = dict.fromkeys(AXES)
+
+    def __call__(self, lines: Iterable[str]) -> Iterator[str]:
+        self._reset()
+        for line in lines:
+            minified_line = self.minify_line(line)
+            if minified_line is not None:
+                yield minified_line
+
+    def minify_line(self, line: str) -> Optional[str]:
+        '''Returns the minified line, or None if the line can be removed'''
+        if STRUCTURAL_COMMENT_PATTERN.search(line):
+            return line
+        if line.startswith("%"):
+            self._reset()
+            return line
+
+        code, comment = split_comment(line)
+        code = code.strip()
+        if code == "":
+            return None
+        words = parse_words(code.upper())
+        if words is None or CONTROL_FLOW_PATTERN.search(code.upper()):
+            self._reset()
+            return code + line_ending(comment)
+
+        letters = [letter for letter, _ in words]
+        if "N" in letters or "O" in letters:
+            self._reset()  # a GOTO target or subprogram start can be reached with any modal state
+
+        g_codes = [normalise_g_code(value) for letter, value in words if letter == "G"]
+        motion_codes = [g for g in g_codes if g in ("0", "1", "2", "3")]
+        distance_codes = [g for g in g_codes if g in ("90", "91")]
+        other_g_codes = [g for g in g_codes if g not in ("0", "1", "2", "3", "90", "91") and g not in PASSIVE_G_CODES]
+        if any(g in POSITION_RESET_G_CODES for g in other_g_codes):
+            self.positions = dict.fromkeys(AXES)
+            if motion_codes or distance_codes or "F" in letters:
+                self._reset()  # the axis words are not moves, but the modal words still apply (e.g. G28 G91 Z0)
+            return code + line_ending(comment)
+        if any(g not in WORK_OFFSET_G_CODES for g in other_g_codes) or len(motion_codes) > 1 or len(distance_codes) > 1:
+            self._reset()
+            return code + line_ending(comment)
+        if other_g_codes:
+            self.positions = dict.fromkeys(AXES)
+
+        is_absolute = self.is_absolute if not distance_codes else distance_codes[0] == "90"
+        motion = self.motion if not motion_codes else motion_codes[0]
+        minified_words = []
+        for letter, value in words:
+            if letter == "G":
+                g = normalise_g_code(value)
+                if (g in motion_codes and g == self.motion) or (g in distance_codes and is_absolute == self.is_absolute):
+                    continue
+                minified_words.append("G" + g)
+            elif letter in AXES:
+                number = float(value)
+                if is_absolute and motion in ("0", "1") and self.positions[letter] == number:
+                    continue
+                minified_words.append(letter + trim_number(value))
+            elif letter == "F":
+                number = float(value)
+                if number == self.feed:
+                    continue
+                self.feed = number
+                minified_words.append(letter + trim_number(value))
+            elif letter in TRIMMED_WORDS:
+                minified_words.append(letter + trim_number(value))
+            else:
+                minified_words.append(letter + value)
+
+        # update the modal state
+        self.motion = motion
+        self.is_absolute = is_absolute
+        for letter, value in words:
+            if letter in AXES:
+                self.positions[letter] = float(value) if is_absolute else None
+        if "M" in letters or "T" in letters:
+            self._reset()  # macros may move the machine or change modes
+
+        if not minified_words:
+            return None
+        return " ".join(minified_words) + line_ending(comment)
+
+
+class ModalState:
+    '''Tracks the modal state and position of the machine through simple G-code words.
+    Anything that is not known for certain is set to None.'''
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self):
+        self.motion: Optional[str] = None
+        self.is_absolute: Optional[bool] = None
+        self.plane: Optional[str] = None
+        self.feed: Optional[float] = None
+        self.positions: dict[str, Optional[float]] = dict.fromkeys(AXES)
+
+    def update(self, line: str):
+        code, _ = split_comment(line)
+        code = code.strip().upper()
+        if code == "":
+            return
+        words = parse_words(code)
+        if words is None or CONTROL_FLOW_PATTERN.search(code):
+            self.reset()
+            return
+        g_codes = [normalise_g_code(value) for letter, value in words if letter == "G"]
+        for g in g_codes:
+            if g in ("0", "1", "2", "3"):
+                self.motion = g
+            elif g in ("90", "91"):
+                self.is_absolute = g == "90"
+            elif g in ("17", "18", "19"):
+                self.plane = g
+            elif g in WORK_OFFSET_G_CODES or g in POSITION_RESET_G_CODES:
+                self.positions = dict.fromkeys(AXES)
+            elif g not in PASSIVE_G_CODES:
+                self.reset()
+                return
+        if any(g in POSITION_RESET_G_CODES for g in g_codes):
+            return  # axis words are not moves
+        for letter, value in words:
+            if letter in AXES:
+                current = self.positions[letter]
+                if self.is_absolute:
+                    self.positions[letter] = float(value)
+                elif self.is_absolute is False and current is not None:
+                    self.positions[letter] = current + float(value)
+                else:
+                    self.positions[letter] = None
+            elif letter == "F":
+                self.feed = float(value)
+            elif letter in ("M", "T", "N", "O"):
+                # tool changes and macros may move the machine, labels may be reached from anywhere
+                self.positions = dict.fromkeys(AXES)
+                self.motion = None
+
+
+def format_number(value: float) -> str:
+    '''Format a coordinate like mach4mill.cps (e.g. 1.5, 2., -0.125)'''
+    text = f"{value:.4f}".rstrip("0")
+    return "0." if text in ("-0.", "0.") else text
+
+
+class ArcFitter:
+    '''Replaces runs of G1 moves in the XY plane that lie on a circle with G2/G3 arcs.
+    Only applies to milling inserts, so additive moves (with A/B extrusion) are never changed.
+    Arc centres are output as incremental I/J words (G91.1, as set by mach4mill.cps).'''
+
+    MIN_SEGMENTS = 3
+    MAX_SEGMENTS = 500
+
+    def __init__(self, tolerance_mm: float = 0.01, max_radius_mm: float = 1000) -> None:
+        self.tolerance = tolerance_mm
+        self.max_radius = max_radius_mm
+        self.state = ModalState()
+
+    def __call__(self, lines: Iterable[str]) -> Iterator[str]:
+        self.state.reset()
+        in_insert = False
+        run: list[tuple[str, float, float, bool]] = []  # line, end X, end Y, whether the line sets the feed
+        run_start = (0.0, 0.0)
+        for line in lines:
+            if INSERT_START_PATTERN.match(line) or INSERT_END_PATTERN.match(line):
+                yield from self._fit_arcs(run_start, run)
+                run = []
+                in_insert = INSERT_START_PATTERN.match(line) is not None
+                self.state.reset()
+                yield line
+                continue
+            if not in_insert:
+                yield line
+                continue
+
+            move = self._get_planar_move(line)
+            if move is None or (move[2] and run and self.state.feed != self._get_feed(line)):
+                yield from self._fit_arcs(run_start, run)
+                run = []
+            if move is not None:
+                if not run:
+                    run_start = (self.state.positions["X"], self.state.positions["Y"])  # type: ignore
+                run.append((line, *move))
+            self.state.update(line)
+            if move is None:
+                yield line
+        yield from self._fit_arcs(run_start, run)
+
+    def _get_feed(self, line: str) -> Optional[float]:
+        words = parse_words(split_comment(line)[0].strip().upper()) or []
+        return next((float(value) for letter, value in words if letter == "F"), None)
+
+    def _get_planar_move(self, line: str) -> Optional[tuple[float, float, bool]]:
+        '''Returns the end point of a G1 move in the XY plane, or None if the line is anything else'''
+        state = self.state
+        code, comment = split_comment(line)
+        if comment.strip() or not state.is_absolute or state.plane != "17" or None in (
+                state.positions["X"], state.positions["Y"], state.positions["Z"]):
+            return None
+        words = parse_words(code.strip().upper())
+        if not words:
+            return None
+        x, y = state.positions["X"], state.positions["Y"]
+        motion = state.motion
+        sets_feed = False
+        for letter, value in words:
+            if letter == "G":
+                motion = normalise_g_code(value)
+            elif letter == "X":
+                x = float(value)
+            elif letter == "Y":
+                y = float(value)
+            elif letter == "Z":
+                if float(value) != state.positions["Z"]:
+                    return None
+            elif letter == "F":
+                sets_feed = True
+            else:
+                return None
+        if motion != "1" or (x, y) == (state.positions["X"], state.positions["Y"]):
+            return None
+        return x, y, sets_feed  # type: ignore
+
+    def _fit_arcs(self, start: tuple[float, float], run: list[tuple[str, float, float, bool]]) -> Iterator[str]:
+        points = [start] + [(x, y) for _, x, y, _ in run]
+        is_arc_modal = False
+        i = 0
+        while i < len(run):
+            arc = None
+            j = i + self.MIN_SEGMENTS
+            while j <= min(len(run), i + self.MAX_SEGMENTS):
+                fitted_arc = self._fit_arc(points[i:j + 1])
+                if fitted_arc is None:
+                    break
+                arc = (j, *fitted_arc)
+                j += 1
+
+            if arc is None:
+                line = run[i][0]
+                if is_arc_modal and not re.match(r"\s*G0*1(?![.\d])", line, re.IGNORECASE):
+                    line = "G1 " + line.lstrip()
+                is_arc_modal = False
+                yield line
+                i += 1
+                continue
+
+            end, center, is_clockwise = arc
+            x0, y0 = points[i]
+            x1, y1 = points[end]
+            words = ["G2" if is_clockwise else "G3", "X" + format_number(x1), "Y" + format_number(y1),
+                     "I" + format_number(center[0] - x0), "J" + format_number(center[1] - y0)]
+            if any(sets_feed for _, _, _, sets_feed in run[i:end]):
+                words.append("F" + trim_number(f"{self.state.feed:.4f}"))
+            yield " ".join(words) + line_ending(run[end - 1][0])
+            is_arc_modal = True
+            i = end
+        if is_arc_modal:
+            yield "G1" + line_ending(run[-1][0])
+
+    def _fit_arc(self, points: list[tuple[float, float]]) -> Optional[tuple[tuple[float, float], bool]]:
+        '''Returns the centre and direction of the arc through the points, or None if they are not on an arc within tolerance'''
+        (ax, ay), (bx, by), (cx, cy) = points[0], points[len(points) // 2], points[-1]
+        determinant = 2 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+        if abs(determinant) < 1e-12:
+            return None
+        ux = ((ax**2 + ay**2) * (by - cy) + (bx**2 + by**2) * (cy - ay) + (cx**2 + cy**2) * (ay - by)) / determinant
+        uy = ((ax**2 + ay**2) * (cx - bx) + (bx**2 + by**2) * (ax - cx) + (cx**2 + cy**2) * (bx - ax)) / determinant
+        radius = math.hypot(ax - ux, ay - uy)
+        if radius > self.max_radius or radius < self.tolerance:
+            return None
+
+        sweep = 0.0
+        for (px, py), (qx, qy) in zip(points, points[1:]):
+            if abs(math.hypot(qx - ux, qy - uy) - radius) > self.tolerance:
+                return None
+            # the chord must not deviate from the arc by more than the tolerance either
+            half_chord = math.hypot(qx - px, qy - py) / 2
+            if radius - math.sqrt(max(radius**2 - half_chord**2, 0)) > self.tolerance:
+                return None
+            cross = (px - ux) * (qy - uy) - (py - uy) * (qx - ux)
+            dot = (px - ux) * (qx - ux) + (py - uy) * (qy - uy)
+            angle = math.atan2(cross, dot)
+            if angle == 0 or (sweep != 0 and (angle > 0) != (sweep > 0)):
+                return None
+            sweep += angle
+        if abs(sweep) >= math.pi:
+            return None
+        return (ux, uy), sweep < 0
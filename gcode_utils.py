@@ -0,0 +1,55 @@
+from decimal import Decimal
+import re
+from typing import AnyStr
+
+_DISTANCE_MODE_PATTERN = re.compile(rb"G0*9(?P<mode>[01])(?![.\d])")
+_NON_MODAL_MOVE_PATTERN = re.compile(rb"G0*(?:53|28|30)(?![.\d])")
+_Z_WORD_PATTERN = re.compile(rb"Z(?P<value>[-+]?(?:\d+\.?\d*|\.\d+))")
+
+
+def split_comment(line: AnyStr) -> tuple[AnyStr, AnyStr]:
+    '''Split a line of G-code into the code and the comment (including the line ending), as bytes or as text'''
+    is_text = isinstance(line, str)
+    comment_start = len(line.rstrip("\r\n" if is_text else b"\r\n"))  # type: ignore
+    for comment_char in (("(", ";") if is_text else (b"(", b";")):
+        position = line.find(comment_char, 0, comment_start)  # type: ignore
+        if position != -1:
+            comment_start = position
+    return line[:comment_start], line[comment_start:]
+
+
+def detect_line_ending(gcode: bytes) -> bytes:
+    return b"\r\n" if b"\r\n" in gcode else b"\n"
+
+
+def shift_z(gcode: bytes, offset_mm: Decimal) -> bytes:
+    '''Returns the G-code with the offset added to every absolute Z coordinate.
+    Comments, incremental (G91) moves and moves in machine coordinates (G53, G28, G30) are left unchanged.
+    Decimal arithmetic keeps the shifted values exact.'''
+    if offset_mm == 0:
+        return gcode
+    offset_decimals = max(-offset_mm.as_tuple().exponent, 0)
+
+    def shift_word(match: re.Match) -> bytes:
+        text = match.group('value').decode()
+        value = Decimal(text) + offset_mm
+        text_decimals = len(text) - text.index('.') - 1 if '.' in text else 0
+        shifted = f"{value + 0:.{max(text_decimals, offset_decimals)}f}"
+        # drop the extra decimals of the offset where they are zero
+        while '.' in shifted and len(shifted) - shifted.index('.') - 1 > text_decimals and shifted.endswith('0'):
+            shifted = shifted[:-1]
+        shifted = shifted.rstrip('.')
+        if '.' in text and '.' not in shifted:
+            shifted += '.'
+        return b"Z" + shifted.encode()
+
+    shifted_lines = []
+    is_absolute = True
+    for line in gcode.splitlines(keepends=True):
+        code, comment = split_comment(line)
+        for distance_mode in _DISTANCE_MODE_PATTERN.finditer(code):
+            is_absolute = distance_mode.group('mode') == b"0"
+        if is_absolute and b"Z" in code and _NON_MODAL_MOVE_PATTERN.search(code) is None:
+            code = _Z_WORD_PATTERN.sub(shift_word, code)
+        shifted_lines.append(code + comment)
+    return b"".join(shifted_lines)
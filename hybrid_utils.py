@@ -1,7 +1,9 @@
 from dataclasses import dataclass
 from pathlib import Path
+import re
 from typing import Optional
 import adsk.fusion
+from . import config
 
 
 @dataclass
@@ -18,8 +20,21 @@ class HybridPostConfig:
     laserScanning: bool = False
     collectLoadCellData: bool = False
     dryingTime: int = 0
+    adaptiveDrying: bool = False
     finishingMilling: bool = False
     finishingMillingSetup: str = ""
     defectCorrection: bool = False
     firstCorrectionLayer: int = 2
-    outputFilePath:Path = Path()
\ No newline at end of file
+    reuseAdditivePost: bool = False
+    useSubprograms: bool = False
+    optimiseRapids: bool = False
+    optimiseTravels: bool = False
+    fitArcs: bool = False
+    minifyOutput: bool = False
+    outputFilePath:Path = Path()
+
+
+def get_cache_path(document_name: str, name: str) -> Path:
+    """A file kept between runs for the document, named after it"""
+    file_name_safe_document_name = re.sub(r'[^\w\- ]', '_', document_name)
+    return config.CACHE_FOLDER.joinpath(f"{file_name_safe_document_name} {name}")
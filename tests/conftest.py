@@ -0,0 +1,8 @@
+import sys
+import types
+from pathlib import Path
+
+# the add-in folder is a package named after the add-in in Fusion, its modules use relative imports
+_package = types.ModuleType("Hybrid762")
+_package.__path__ = [str(Path(__file__).resolve().parents[1])]
+sys.modules.setdefault("Hybrid762", _package)
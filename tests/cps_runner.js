@@ -0,0 +1,109 @@
+// Runs a post processor (.cps) outside Fusion with the parts of the post kernel it uses, and writes the output
+// to stdout. Usage: node cps_runner.js <post processor> <program.json>
+// The program is {"properties": {...}, "layerCount": n, "records": [["onOpen"], ["onLayer", 1], ...]}, where each
+// record is a call of an entry function of the post processor with its arguments.
+const fs = require("fs");
+const vm = require("vm");
+
+const [postProcessorFile, programFile] = process.argv.slice(2);
+const program = JSON.parse(fs.readFileSync(programFile, "utf8"));
+const EXTRUSION_RECORD_TYPES = {onLinearExtrude: 10, onCircularExtrude: 28};
+const CONTROL_FORCE = 1;
+const TYPE_INCREMENTAL = 1;
+let output = "";
+let recordIndex = 0;
+
+function createFormat(specifiers) {
+  const decimals = specifiers.decimals === undefined ? 6 : specifiers.decimals;
+  const format = function (value) {
+    let text = Number(value).toFixed(decimals);
+    if (text.includes(".")) {
+      text = text.replace(/0+$/, "").replace(/\.$/, "");
+    }
+    if (text == "-0") {
+      text = "0";
+    }
+    return (specifiers.prefix || "") + text + (specifiers.suffix || "");
+  };
+  return {format: format, areDifferent: (a, b) => format(a) != format(b)};
+}
+
+function createOutputVariable(specifiers, format) {
+  let current;
+  let isForced = true;
+  return {
+    format: function (value) {
+      const isIncremental = specifiers.type == TYPE_INCREMENTAL;
+      const outputValue = isIncremental ? value - (current === undefined ? 0 : current) : value;
+      if (!isForced && specifiers.control != CONTROL_FORCE && !format.areDifferent(current, value)) {
+        return "";
+      }
+      current = value;
+      isForced = false;
+      return (specifiers.prefix || "") + format.format(outputValue);
+    },
+    getCurrent: () => current,
+    reset: function () { isForced = true; }
+  };
+}
+
+function flattenWords(words) {
+  return Array.from(words).flatMap(word => typeof word == "object" && word !== null ? flattenWords(word) : [word]);
+}
+
+function writeWords() {
+  const words = flattenWords(arguments).filter(word => word !== undefined && word !== "");
+  if (words.length) {
+    writeln(words.join(" "));
+  }
+}
+
+function writeln(text) {
+  output += text + "\n";
+}
+
+const extruder = {extrusionLength: 100, materialName: "clay", filamentDiameter: 1.75, nozzleDiameter: 0.8,
+                  temperature: 0};
+const machineConfiguration = {
+  getNumberExtruders: () => 2,
+  getVendor: () => "CHAMP", getModel: () => "Hybrid",
+  getWidth: () => 300, getDepth: () => 300, getHeight: () => 200,
+  getCenterPositionX: () => 0, getCenterPositionY: () => 0, getCenterPositionZ: () => 0,
+  getExtruderOffsetX: () => 0, getExtruderOffsetY: () => 0, getExtruderOffsetZ: () => 0,
+  getParkPositionX: () => 0, getParkPositionY: () => 0, getParkPositionZ: () => 0
+};
+
+const context = vm.createContext({
+  MM: 1, IN: 0, unit: 1, PLANE_XY: 0, SP: " ", EOL: "\n",
+  CONTROL_CHANGED: 0, CONTROL_FORCE: CONTROL_FORCE, TYPE_ABSOLUTE: 0, TYPE_INCREMENTAL: TYPE_INCREMENTAL,
+  CAPABILITY_ADDITIVE: 1,
+  RECORD_OPERATION_END: 0, properties: {},
+  programName: "", programComment: "", printTime: 600, bedTemp: 0, partCount: 1,
+  numberOfExtruders: 1, layerCount: program.layerCount,
+  machineConfiguration: machineConfiguration,
+  currentSection: {getInitialPosition: () => ({x: 0, y: 0, z: 0})},
+  getFramePosition: position => position,
+  getExtruder: id => id == 1 ? extruder : Object.assign({}, extruder, {filamentDiameter: 0}),
+  getGlobalParameter: () => "0",
+  getNextRecord: () => {
+    const record = program.records[recordIndex + 1];
+    return {getType: () => (record && EXTRUSION_RECORD_TYPES[record[0]]) || 0};
+  },
+  getProperty: name => name in program.properties ? program.properties[name]
+                                                   : (context.properties[name] || {}).value,
+  createFormat: createFormat, createOutputVariable: createOutputVariable,
+  writeln: writeln, writeWords: writeWords,
+  filterText: (text, permitted) => Array.from(text).filter(c => permitted.includes(c)).join(""),
+  subst: (text, ...values) => text.replace(/%(\d)/g, (match, index) => values[index - 1]),
+  localize: text => text, spatial: value => value, toRad: degrees => degrees * Math.PI / 180,
+  toPreciseUnit: value => value, setCodePage: () => {},
+  validate: (condition, message) => { if (!condition) throw new Error(message); },
+  error: message => { throw new Error(message); }
+});
+
+vm.runInContext(fs.readFileSync(postProcessorFile, "utf8"), context, {filename: postProcessorFile});
+for (recordIndex = 0; recordIndex < program.records.length; ++recordIndex) {
+  const [entry, ...args] = program.records[recordIndex];
+  vm.runInContext(entry, context).apply(null, args);
+}
+process.stdout.write(output);
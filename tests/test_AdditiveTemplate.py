@@ -0,0 +1,103 @@
+from dataclasses import asdict
+import json
+from pathlib import Path
+import shutil
+import subprocess
+import pytest
+from Hybrid762.AdditiveTemplate import AdditiveOptions, AdditiveTemplate
+
+_POST_PROCESSOR = Path(__file__).parents[1] / "post processors" / "Ceramic polymer post processor.cps"
+_CPS_RUNNER = Path(__file__).parent / "cps_runner.js"
+
+
+def _dry_photo(z: str) -> str:
+    '''The variants of the drying and photo block, as the post processor writes them for a drying time of 1 s'''
+    return (f";TEMPLATE_BEGIN DRY_PHOTO dryingTime>0 useImaging=1\n;Dry and Photo\nM225 #620=1 #622={z}\n"
+            f";TEMPLATE_END DRY_PHOTO\n"
+            f";TEMPLATE_BEGIN DRY_PHOTO dryingTime>0 useImaging=0\n;Drying\nM20 #620=1\n;TEMPLATE_END DRY_PHOTO\n"
+            f";TEMPLATE_BEGIN DRY_PHOTO dryingTime=0 useImaging=1\n;Photo\nM25 #625={z}\n;TEMPLATE_END DRY_PHOTO\n")
+
+
+_TEMPLATE = (";TEMPLATE_BEGIN DRYING_TIME\n;DT: 1\n;TEMPLATE_END DRYING_TIME\n"
+             ";Layer 1 of 2\nG0 X0 Y0 Z0.2\nG1 X100 F600 A1\n"
+             f";Layer 2 of 2\n{_dry_photo('0.2')}G1 X50 A2\n"
+             f"{_dry_photo('0.4')}M30\n")
+
+
+def _render(tmp_path: Path, template: str, options: AdditiveOptions) -> list[str]:
+    template_file = tmp_path / "template.gcode"
+    template_file.write_text(template)
+    output_file = tmp_path / "additive.gcode"
+    AdditiveTemplate(template_file, rapid_feed=3000, max_workers=1).render(options, output_file)
+    return output_file.read_text().splitlines()
+
+
+def test_variants_of_the_options_are_kept(tmp_path: Path):
+    lines = _render(tmp_path, _TEMPLATE, AdditiveOptions(useImaging=False, dryingTime=30))
+
+    assert lines == [";DT: 30", ";Layer 1 of 2", "G0 X0 Y0 Z0.2", "G1 X100 F600 A1", ";Layer 2 of 2", ";Drying",
+                     "M20 #620=30", "G1 X50 A2", ";Drying", "M20 #620=30", "M30"]
+
+
+def test_block_without_a_variant_of_the_options_is_removed(tmp_path: Path):
+    lines = _render(tmp_path, _TEMPLATE, AdditiveOptions(useImaging=False, dryingTime=0))
+
+    assert lines == [";DT: 0", ";Layer 1 of 2", "G0 X0 Y0 Z0.2", "G1 X100 F600 A1", ";Layer 2 of 2", "G1 X50 A2",
+                     "M30"]
+
+
+@pytest.mark.parametrize("minimum_layer_time, expected_lines", [
+    (30, ["M225 #620=20 #622=0.2", "M225 #620=25 #622=0.4"]),
+    # layer 1 takes longer than the minimum layer time, so it is only photographed
+    (8, ["M25 #625=0.2", "M225 #620=3 #622=0.4"]),
+])
+def test_adaptive_drying_tops_up_the_layer_times(tmp_path: Path, minimum_layer_time: int, expected_lines: list[str]):
+    lines = _render(tmp_path, _TEMPLATE,
+                    AdditiveOptions(useImaging=True, dryingTime=minimum_layer_time, adaptiveDrying=True))
+
+    # layer 1 prints for 10 s and layer 2 for 5 s at F600
+    assert lines[0] == f";DT: {minimum_layer_time}"
+    assert [line for line in lines if line.startswith(("M225", "M25"))] == expected_lines
+
+
+@pytest.mark.parametrize("template", [
+    ";TEMPLATE_BEGIN FINISHING finishing=1\nT1 M6\nM30\n",
+    ";TEMPLATE_BEGIN FINISHING finishing=1\nT1 M6\n;TEMPLATE_END DRY_PHOTO\n",
+    ";TEMPLATE_BEGIN FINISHING finish=1\nT1 M6\n;TEMPLATE_END FINISHING\n",
+])
+def test_invalid_markers_are_rejected(tmp_path: Path, template: str):
+    with pytest.raises(ValueError):
+        _render(tmp_path, template, AdditiveOptions())
+
+
+def _post(tmp_path: Path, properties: dict) -> bytes:
+    '''Post a five layer toolpath with the additive post processor'''
+    records = [["onOpen"], ["onSection"], ["onExtruderChange", 0]]
+    for layer_number in range(1, 6):
+        z = 0.5*layer_number
+        records += [["onLayer", layer_number], ["onRapid", -layer_number, 0, z],
+                    ["onLinearExtrude", 10 + layer_number, 0, z, 600, layer_number],
+                    ["onLinearExtrude", 10 + layer_number, 10, z, 900, layer_number + 0.5], ["onRapid", 0, 0, z + 1]]
+    records.append(["onClose"])
+    program_file = tmp_path / "program.json"
+    program_file.write_text(json.dumps({"properties": properties, "layerCount": 5, "records": records}))
+    return subprocess.run(["node", str(_CPS_RUNNER), str(_POST_PROCESSOR), str(program_file)],
+                          capture_output=True, check=True).stdout
+
+
+@pytest.mark.skipif(shutil.which("node") is None, reason="Node.js is needed to run the post processor")
+@pytest.mark.parametrize("options", [
+    AdditiveOptions(),
+    AdditiveOptions(useImaging=True, laserScanning=True, collectLoadCellData=True, dryingTime=45, finishing=True,
+                    defectCorrection=True, firstCorrectionLayer=3),
+    AdditiveOptions(useImaging=False, dryingTime=20, defectCorrection=True, firstCorrectionLayer=5),
+    AdditiveOptions(useImaging=False, dryingTime=0, collectLoadCellData=True),
+])
+def test_rendering_matches_the_post_processor(tmp_path: Path, options: AdditiveOptions):
+    template_file = tmp_path / "template.gcode"
+    template_file.write_bytes(_post(tmp_path, {"templateMarkers": True, "dryingTime": 30}))
+    output_file = tmp_path / "additive.gcode"
+    AdditiveTemplate(template_file).render(options, output_file)
+
+    properties = {name: value for name, value in asdict(options).items() if name != "adaptiveDrying"}
+    assert output_file.read_bytes() == _post(tmp_path, properties)
@@ -0,0 +1,54 @@
+from pathlib import Path
+import pytest
+from Hybrid762.GcodeAnalyzer import GcodeAnalyzer, parse_chunk
+
+_PROGRAM = b""";Layer 1 of 2
+G90
+G0 X0 Y0 Z0 F6000
+G1 X60 F600 A1
+G92 A0
+G52 X100
+;Layer 2 of 2
+M20 #620=30
+G1 Y30 A0.5
+G1 X1.2.3 Y30
+;MILLING_INSERT_START LAYER_REMOVAL at Z 1.20
+G0 Z10
+G1 X0 F1200
+;MILLING_INSERT_END
+G28 G91 Z0
+M30
+"""
+
+
+def test_layers_and_inserts(tmp_path: Path):
+    gcode_file = tmp_path / "combined.tap"
+    gcode_file.write_bytes(_PROGRAM)
+    statistics = GcodeAnalyzer(rapid_feed=3000, max_workers=1).analyze(gcode_file)
+
+    assert statistics.line_count == 16
+    assert [layer.number for layer in statistics.layers] == [1, 2]
+    assert [layer.start for layer in statistics.layers] == [0, _PROGRAM.index(b";Layer 2")]
+    # 60 mm and 30 mm at F600, the G52 offset and the G92 reset are not moves
+    assert [layer.print_time for layer in statistics.layers] == pytest.approx([6, 3])
+    assert [layer.drying_time for layer in statistics.layers] == [30, 0]
+    assert [layer.extrusion_a for layer in statistics.layers] == pytest.approx([1, 0.5])
+    # 10 mm at the rapid feed and 60 mm at F1200, the G28 retract is not a move
+    [insert] = statistics.inserts
+    assert (insert.kind, insert.z, insert.layer) == ("LAYER_REMOVAL", 1.2, 2)
+    assert insert.time == pytest.approx(3.2)
+    assert statistics.layers[1].milling_time == pytest.approx(3.2)
+    assert statistics.total_time == pytest.approx(6 + 3 + 30 + 3.2)
+
+
+def test_parse_chunk():
+    chunk = b"G1 X1.5 Y-2 ;X9\nG92 A0\nG52 X5\nG53 Z0\nG1 X1.2.3 Y.5\n#620=30\n"
+    parsed = parse_chunk(chunk, 100, GcodeAnalyzer.TOKEN_WIDTH)
+
+    assert list(parsed.offsets) == [100, 116, 123, 130, 137, 151]
+    assert list(parsed.columns[b"X"]) == pytest.approx([1.5, float("nan"), 5, float("nan"), float("nan"),
+                                                        float("nan")], nan_ok=True)
+    assert list(parsed.columns[b"Y"]) == pytest.approx([-2, float("nan"), float("nan"), float("nan"), 0.5,
+                                                        float("nan")], nan_ok=True)
+    assert list(parsed.is_position_reset) == [False, True, False, False, False, False]
+    assert list(parsed.is_non_work_move) == [False, True, True, True, False, False]
@@ -0,0 +1,136 @@
+from pathlib import Path
+import pytest
+from Hybrid762 import GcodeMerger as gcode_merger_module
+from Hybrid762.GcodeMerger import GcodeMerger, map_file, write_splice_plan
+from Hybrid762.PlanarisingIndex import PlanarisingIndex
+
+_ADDITIVE = """;Layer 1 of 2
+G1 X1 A1
+;PLACEHOLDER_LAYER_REMOVAL at Z 1.00
+T1 M6
+;PLACEHOLDER_OVEREXTRUSION_REMOVAL at Z 1.50
+;PLACEHOLDER_FINISHING at Z2.50
+;PLACEHOLDER_FINISHING at Z3.00
+M30
+%
+"""
+
+
+def _write_files(folder: Path, files: dict[str, str]) -> Path:
+    folder.mkdir()
+    for name, gcode in files.items():
+        (folder / name).write_text(gcode)
+    return folder
+
+
+def _merge(tmp_path: Path, gcode_merger: GcodeMerger, additive: str = _ADDITIVE) -> list[str]:
+    additive_file = tmp_path / "additive.gcode"
+    additive_file.write_text(additive)
+    output_file = tmp_path / "combined.tap"
+    gcode_merger.merge(additive_file, output_file)
+    return output_file.read_text().splitlines()
+
+
+def test_find_placeholders(tmp_path: Path):
+    additive_file = tmp_path / "additive.gcode"
+    additive_file.write_text(_ADDITIVE)
+
+    placeholders = GcodeMerger.find_placeholders(additive_file)
+    assert [(p.kind, p.height) for p in placeholders] == [("LAYER_REMOVAL", 1.0), ("OVEREXTRUSION_REMOVAL", 1.5),
+                                                          ("FINISHING", 2.5), ("FINISHING", 3.0)]
+    assert _ADDITIVE[placeholders[0].start:placeholders[0].end] == ";PLACEHOLDER_LAYER_REMOVAL at Z 1.00"
+
+
+def test_placeholders_are_replaced(tmp_path: Path):
+    planarising_folder = _write_files(tmp_path / "planarising", {"Planarising at 1.00.tap": "G0 Z1\nG1 X5\n"})
+    finishing_file = tmp_path / "finishing.tap"
+    finishing_file.write_text("G0 Z10\nG1 X0")
+    gcode_merger = GcodeMerger(planarising_index=PlanarisingIndex(planarising_folder), finishing_file=finishing_file)
+
+    assert _merge(tmp_path, gcode_merger) == [
+        ";Layer 1 of 2", "G1 X1 A1",
+        ";MILLING_INSERT_START LAYER_REMOVAL at Z 1.00", "G0 Z1", "G1 X5", "", ";MILLING_INSERT_END",
+        "T1 M6",
+        "; Planarising toolpath does not exist at 1.50 for over-extrusion removal",
+        ";MILLING_INSERT_START FINISHING at Z 2.50", "G0 Z10", "G1 X0", ";MILLING_INSERT_END",
+        ";PLACEHOLDER_FINISHING at Z3.00",  # only the first finishing placeholder is replaced
+        "M30", "%"]
+
+
+def test_over_extrusion_removal_uses_the_skim_toolpath(tmp_path: Path):
+    planarising_folder = _write_files(tmp_path / "planarising", {"Planarising at 1.00.tap": "G1 X5\n",
+                                                                 "Planarising at 1.50.tap": "G1 X6\n",
+                                                                 "Skim at 1.50.tap": "G1 X7\n"})
+    gcode_merger = GcodeMerger(
+        planarising_index=PlanarisingIndex(planarising_folder),
+        skim_index=PlanarisingIndex(planarising_folder, filename_pattern=PlanarisingIndex.SKIM_FILENAME_PATTERN))
+
+    lines = _merge(tmp_path, gcode_merger)
+    assert lines[lines.index(";MILLING_INSERT_START OVEREXTRUSION_REMOVAL at Z 1.50") + 1] == "G1 X7"
+    assert ";PLACEHOLDER_FINISHING at Z2.50" in lines  # without a finishing file
+
+
+def test_missing_layer_removal_is_an_error(tmp_path: Path):
+    planarising_folder = _write_files(tmp_path / "planarising", {"Planarising at 1.50.tap": "G1 X6\n"})
+
+    with pytest.raises(RuntimeError):
+        _merge(tmp_path, GcodeMerger(planarising_index=PlanarisingIndex(planarising_folder)))
+
+
+def test_additive_gcode_is_copied_without_milling(tmp_path: Path):
+    assert _merge(tmp_path, GcodeMerger()) == _ADDITIVE.splitlines()
+    assert _merge(tmp_path, GcodeMerger(), additive="") == []
+
+
+@pytest.mark.parametrize("kernel_copy_limit", [None, 0, 3])
+def test_write_splice_plan(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, kernel_copy_limit):
+    if kernel_copy_limit is not None:
+        # the kernel copies at most this many bytes, the rest is copied from the map or the file
+        kernel_copy = gcode_merger_module._kernel_copy
+        monkeypatch.setattr(gcode_merger_module, "_kernel_copy", lambda source, outfile, offset, count:
+                            kernel_copy(source, outfile, offset, min(count, kernel_copy_limit)))
+    source_file = tmp_path / "source.gcode"
+    source_file.write_bytes(b"0123456789")
+    insert_file = tmp_path / "insert.tap"
+    insert_file.write_bytes(b"abcdef")
+    output_file = tmp_path / "output.gcode"
+
+    with open(source_file, 'rb') as source, map_file(source) as source_map, \
+            open(output_file, 'wb', buffering=0) as outfile:
+        write_splice_plan(source, source_map, [range(0, 4), insert_file, b"-", range(6, 10), range(10, 10)], outfile)
+    assert output_file.read_bytes() == b"0123abcdef-6789"
+
+
+def test_repeated_toolpaths_are_output_as_subprograms(tmp_path: Path):
+    planarising_folder = _write_files(tmp_path / "planarising", {
+        "Planarising at 1.00.tap": "G0 Z11.00\nG1 X5 Z1.00\n",
+        "Planarising at 1.50.tap": "G0 Z11.50\nG1 X5 Z1.50\n",
+        # toolpaths calling their own subprograms are inserted as they are
+        "Planarising at 2.00.tap": "G1 X9 Z2.00\nM98 P1\n",
+        "Planarising at 2.50.tap": "G1 X9 Z2.50\nM98 P1\n",
+        "Planarising at 3.00.tap": "G1 X7 Z3.00\n"})
+    additive = "".join(f";PLACEHOLDER_LAYER_REMOVAL at Z {z}\nM0\n" for z in ("1.00", "1.50", "2.00", "2.50", "3.00"))
+    gcode_merger = GcodeMerger(planarising_index=PlanarisingIndex(planarising_folder), use_subprograms=True)
+
+    lines = _merge(tmp_path, gcode_merger, additive=additive + "M30\n%\n")
+    assert lines == [
+        ";MILLING_INSERT_START LAYER_REMOVAL at Z 1.00", "G52 Z1.000", "M98 P1000", "G52 Z0", ";MILLING_INSERT_END", "M0",
+        ";MILLING_INSERT_START LAYER_REMOVAL at Z 1.50", "G52 Z1.500", "M98 P1000", "G52 Z0", ";MILLING_INSERT_END", "M0",
+        ";MILLING_INSERT_START LAYER_REMOVAL at Z 2.00", "G1 X9 Z2.00", "M98 P1", "", ";MILLING_INSERT_END", "M0",
+        ";MILLING_INSERT_START LAYER_REMOVAL at Z 2.50", "G1 X9 Z2.50", "M98 P1", "", ";MILLING_INSERT_END", "M0",
+        ";MILLING_INSERT_START LAYER_REMOVAL at Z 3.00", "G1 X7 Z3.00", "", ";MILLING_INSERT_END", "M0",
+        "M30",
+        # before the closing percent sign
+        "O1000", ";MILLING_INSERT_START SUBPROGRAM", "G0 Z10.00", "G1 X5 Z0.00", ";MILLING_INSERT_END", "M99",
+        "%"]
+
+
+def test_subprograms_without_a_closing_percent_sign(tmp_path: Path):
+    planarising_folder = _write_files(tmp_path / "planarising", {"Planarising at 1.00.tap": "G1 X5 Z1.00",
+                                                                 "Planarising at 1.50.tap": "G1 X5 Z1.50"})
+    additive = ";PLACEHOLDER_LAYER_REMOVAL at Z 1.00\n;PLACEHOLDER_LAYER_REMOVAL at Z 1.50\nM30\n"
+    gcode_merger = GcodeMerger(planarising_index=PlanarisingIndex(planarising_folder), use_subprograms=True)
+
+    lines = _merge(tmp_path, gcode_merger, additive=additive)
+    assert lines[-6:] == ["M30", "O1000", ";MILLING_INSERT_START SUBPROGRAM", "G1 X5 Z0.00", ";MILLING_INSERT_END",
+                          "M99"]
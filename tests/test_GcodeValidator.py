@@ -0,0 +1,90 @@
+import pytest
+from Hybrid762.GcodeValidator import GcodeValidator, _candidate_value_pattern
+
+_Z_VALUES = ["-12.5", "-0.001", "-.5", "0", "0.", "00.3", ".05", "0.5", "0.499", "1", "1.79", "1.8", "1.81", "2", "9.99",
+             "10", "10.5", "12", "100"]
+_F_VALUES = ["1", "599.9", "600", "600.5", "999", "1000", "5999", "6000", "6000.5", "06001", "7000", "60000"]
+
+
+def _is_candidate(letter: bytes, bound: float, is_min_check: bool, value: str) -> bool:
+    pattern = _candidate_value_pattern(letter, bound, is_min_check)
+    assert pattern is not None
+    match = pattern.search(letter + value.encode() + b" ")
+    return match is not None and match.group('value') == value.encode()
+
+
+@pytest.mark.parametrize("bound", [0, 0.5, 1.8, 2, 10, 10.5])
+def test_z_candidates_include_every_value_below_the_minimum(bound: float):
+    for value in _Z_VALUES:
+        if float(value) < bound:
+            assert _is_candidate(b"Z", bound, True, value), value
+    # and values far above it are not candidates
+    assert not _is_candidate(b"Z", bound, True, "100")
+    assert not _is_candidate(b"Z", bound, True, "12")
+
+
+@pytest.mark.parametrize("bound", [600, 999.5, 1000, 6000])
+def test_feed_candidates_include_every_value_above_the_maximum(bound: float):
+    for value in _F_VALUES:
+        if float(value) > bound:
+            assert _is_candidate(b"F", bound, False, value), value
+    assert not _is_candidate(b"F", bound, False, "1")
+    assert not _is_candidate(b"F", bound, False, "599.9")
+
+
+def test_infinite_bounds_are_not_checked():
+    assert _candidate_value_pattern(b"F", float("inf"), False) is None
+
+
+_PROGRAM = b"""%
+;Layer 1 of 2
+G1 X0 Y0 Z0.2 F600 A1
+;Layer 2 of 2
+;PLACEHOLDER_FINISHING at Z0.40
+IF [#1006 EQ 0] GOTO 3
+GOTO 4
+N3
+;MILLING_INSERT_START LAYER_REMOVAL at Z 0.20
+G0 Z1.5
+G1 X5 Z0.1 F1500 (Z-5 in a comment)
+G53 Z-10
+G52 Z0.2
+M98 P1000
+G52 Z0
+;MILLING_INSERT_END
+N3
+G1 X5 Z-0.1 F9000 A2
+M30
+O1000
+;MILLING_INSERT_START SUBPROGRAM
+G1 X1 Z-0.15 F1000
+;MILLING_INSERT_END
+M99
+%
+"""
+
+
+def test_validate():
+    issues = GcodeValidator(printing_z_min=0, milling_z_min=0.15, printing_feed_max=6000,
+                            milling_feed_max=1200)._validate(_PROGRAM)
+
+    assert [str(issue) for issue in issues] == [
+        "Error: line 5: Placeholder was not replaced: ;PLACEHOLDER_FINISHING at Z0.40",
+        "Error: GOTO without a label: N4",
+        "Error: Label used more than once: N3",
+        "Error: line 11: Z0.1 is below the minimum of 0.15 for milling",
+        "Error: line 18: Z-0.1 is below the minimum of 0 for printing",
+        "Error: line 22: Z-0.15 (Z0.05 where it is called) is below the minimum of 0.15 for milling",
+        "Error: line 11: F1500 is above the maximum of 1200 for milling",
+        "Error: line 18: F9000 is above the maximum of 6000 for printing"]
+
+
+@pytest.mark.parametrize("program, expected_issue_count", [
+    (b"G1 X1\nM30\n", 0),
+    (b"%\nG1 X1\nM30\n%\n", 0),
+    (b"%\r\nG1 X1\r\nM30\r\n%", 0),
+    (b"%\nG1 X1\nM30\n", 1),
+    (b"G1 X1\n%\nM30\n%\n", 1),
+])
+def test_percent_signs(program: bytes, expected_issue_count: int):
+    assert len(GcodeValidator()._check_percent_signs(program)) == expected_issue_count
@@ -0,0 +1,84 @@
+from pathlib import Path
+from Hybrid762.LayerIndex import LayerIndex
+
+_PROGRAM = b"""%
+;Hybrid
+G90 G58
+;Layer 1 of 3
+G0 X0 Y0 Z0.5
+G1 X10 A1.25
+;Layer 2 of 3
+M225 #620=30 #622=0.5
+M111 #622=0.5
+N3
+N4
+G0 Z1
+G1 X10 A2.5 ;A9
+;Layer 3 of 3
+M225 #620=30 #622=1
+IF [[#1005 EQ 0] AND [#1006 EQ 0]] GOTO 6
+;MILLING_INSERT_START LAYER_REMOVAL at Z 0.50
+G52 Z0.500
+M98 P1000
+G52 Z0
+;MILLING_INSERT_END
+G1 G91 A0.015 F1
+G90
+G92 A1.25
+N5
+N6
+G1 X10 A3
+M225 #620=30 #622=1.5
+M30
+O1000
+;MILLING_INSERT_START SUBPROGRAM
+G1 X5 Z0
+;MILLING_INSERT_END
+M99
+%
+"""
+
+
+def test_layers(tmp_path: Path):
+    gcode_file = tmp_path / "part.tap"
+    gcode_file.write_bytes(_PROGRAM)
+    layer_index = LayerIndex.build(gcode_file)
+
+    assert (layer_index.file_size, layer_index.layer_count) == (len(_PROGRAM), 3)
+    assert [layer.number for layer in layer_index.layers] == [1, 2, 3]
+    assert [layer.start for layer in layer_index.layers] == [_PROGRAM.index(b";Layer %d" % n) for n in (1, 2, 3)]
+    assert [layer.end for layer in layer_index.layers] == [layer.start for layer in layer_index.layers[1:]] + [
+        len(_PROGRAM)]
+    # the Z of a layer is logged in the next layer, or at the end of the program
+    assert [layer.z for layer in layer_index.layers] == [0.5, 1.0, 1.5]
+    # neither the pressure increase nor the A reset of the defect correction block are extrusions
+    assert [layer.last_a for layer in layer_index.layers] == [1.25, 2.5, 3.0]
+    assert [layer.labels for layer in layer_index.layers] == [[], [3, 4], [5, 6]]
+
+    [layer_removal] = layer_index.layers[2].inserts
+    assert (layer_removal.kind, layer_removal.z) == ("LAYER_REMOVAL", 0.5)
+    assert _PROGRAM[layer_removal.start:layer_removal.end].startswith(b";MILLING_INSERT_START LAYER_REMOVAL")
+    assert _PROGRAM[layer_removal.start:layer_removal.end].endswith(b";MILLING_INSERT_END")
+    [subprogram] = layer_index.subprograms
+    assert (subprogram.kind, subprogram.z) == ("SUBPROGRAM", None)
+    assert _PROGRAM[subprogram.start:subprogram.end].count(b"\n") == 2
+
+
+def test_layer_lookup():
+    layer_index = LayerIndex._build(b";Layer 2 of 4\nG1 X1 A1\n;Layer 4 of 4\nG1 X2 A2\n")
+
+    assert layer_index.layer(4).last_a == 2  # type: ignore
+    assert layer_index.layer(1) is None
+    assert layer_index.layer(5) is None
+    assert LayerIndex._build(b"").layers == []
+
+
+def test_sidecar_round_trip(tmp_path: Path):
+    gcode_file = tmp_path / "part.tap"
+    gcode_file.write_bytes(_PROGRAM)
+    layer_index = LayerIndex.build(gcode_file)
+    sidecar_path = LayerIndex.sidecar_path(gcode_file)
+    layer_index.save(sidecar_path)
+
+    assert sidecar_path.name == "part.tap.index.json"
+    assert LayerIndex.load(sidecar_path) == layer_index
@@ -0,0 +1,67 @@
+from pathlib import Path
+import pytest
+from Hybrid762.PlanarisingIndex import PlanarisingIndex, group_by_section
+
+
+@pytest.fixture
+def planarising_folder(tmp_path: Path) -> Path:
+    for name in ("Planarising at 1.00.tap", "Planarising at 1.50.tap", "Skim at 1.50.tap", "Planarising at 2.tap",
+                 "notes.txt"):
+        (tmp_path / name).write_text(f"; {name}\n")
+    return tmp_path
+
+
+@pytest.mark.parametrize("height, expected_height_um", [
+    (1.0, 1000),
+    (1.01, 1000),  # at the tolerance
+    (0.99, 1000),
+    (1.0104, 1000),  # rounded to 1.010 mm
+    (1.011, None),
+    (1.49, 1500),
+    (1.25, None),
+    (2.0, 2000),
+    (0.0, None),
+    (3.0, None),
+])
+def test_find_within_tolerance(planarising_folder: Path, height: float, expected_height_um):
+    assert PlanarisingIndex(planarising_folder, tolerance_mm=0.01).find(height) == expected_height_um
+
+
+@pytest.mark.parametrize("height, expected_height_um", [(1.24, 1000), (1.26, 1500), (1.74, 1500), (1.76, 2000)])
+def test_find_nearest_height(planarising_folder: Path, height: float, expected_height_um: int):
+    assert PlanarisingIndex(planarising_folder, tolerance_mm=0.3).find(height) == expected_height_um
+
+
+def test_index(planarising_folder: Path):
+    planarising_index = PlanarisingIndex(planarising_folder)
+    skim_index = PlanarisingIndex(planarising_folder, filename_pattern=PlanarisingIndex.SKIM_FILENAME_PATTERN)
+
+    assert len(planarising_index) == 3
+    assert planarising_index.path(1.505) == planarising_folder / "Planarising at 1.50.tap"
+    assert planarising_index.path(1.7) is None
+    assert len(skim_index) == 1
+    assert skim_index.path(1.5) == planarising_folder / "Skim at 1.50.tap"
+    assert planarising_index.missing_heights([2.5, 1.0, 1.7, 2.5]) == [1.7, 2.5]
+
+
+def test_read_keeps_the_recently_used_files(planarising_folder: Path):
+    planarising_index = PlanarisingIndex(planarising_folder, cache_size=1)
+    assert planarising_index.read(1.0) == b"; Planarising at 1.00.tap\n"
+    assert planarising_index.read(1.7) is None
+
+    (planarising_folder / "Planarising at 1.00.tap").write_text("G1 X1\n")
+    assert planarising_index.read(1.0) == b"; Planarising at 1.00.tap\n"
+    planarising_index.read(1.5)  # evicts 1.00
+    assert planarising_index.read(1.0) == b"G1 X1\n"
+
+
+@pytest.mark.parametrize("section_changes, expected_bands", [
+    ([], {3.0: 0, 2.0: 0, 1.0: 0}),
+    ([(1.5, 1.6)], {3.0: 0, 2.0: 0, 1.0: 1}),
+    ([(2.0, 2.0)], {3.0: 0, 2.0: 1, 1.0: 2}),  # a face at a height may change the section at that height
+    ([(1.99, 1.99)], {3.0: 0, 2.0: 1, 1.0: 2}),  # within the tolerance of the height
+    ([(4.0, 5.0), (0.0, 0.5)], {3.0: 0, 2.0: 0, 1.0: 0}),  # above and below every height
+    ([(0.5, 2.5), (0.6, 0.7)], {3.0: 0, 2.0: 1, 1.0: 2}),  # a small change starting inside a tall one
+])
+def test_group_by_section(section_changes: list[tuple[float, float]], expected_bands: dict[float, int]):
+    assert group_by_section([1.0, 3.0, 2.0, 2.0], section_changes, tolerance_mm=0.02) == expected_bands
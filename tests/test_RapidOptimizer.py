@@ -0,0 +1,67 @@
+from pathlib import Path
+import numpy as np
+from Hybrid762.RapidOptimizer import RapidOptimizer, find_order, path_cost
+
+# as written by mach4mill.cps, which writes G90 with the first rapid of a section
+_HEADER = b"%\r\n(Planarising at 1.00)\r\nG90 G94 G91.1 G40 G49 G17\r\nG21\r\nG28 G91 Z0.\r\nG90\r\nT1 M6\r\nS5000 M3\r\nG54\r\nG17\r\n"
+_FOOTER = b"M5\r\nG28 G91 Z0.\r\nG90\r\nM30\r\n%\r\n"
+
+
+def _region(x: int, is_first: bool = False) -> bytes:
+    '''A cut from X to X+5, entered from the retract of the header or from the height between the regions'''
+    entry = b"G90 G0 X%d. Y0.\r\nG0 Z15.\r\n" % x if is_first else b"G0 X%d. Y0.\r\n" % x
+    return entry + b"G0 Z5.\r\nG1 Z1. F300.\r\nX%d. F600.\r\nG0 Z15.\r\n" % (x + 5)
+
+
+def test_regions_are_reordered():
+    gcode = _HEADER + _region(0, is_first=True) + _region(100) + _region(10) + _region(110) + _FOOTER
+    optimised_gcode, result = RapidOptimizer().optimise(gcode)
+
+    assert optimised_gcode == _HEADER + _region(0, is_first=True) + _region(10) + _region(100) + _region(110) + _FOOTER
+    assert (result.region_count, result.original_distance, result.optimised_distance) == (4, 285, 95)
+    assert result.saved_distance == 190
+
+
+def test_the_first_rapid_keeps_its_modal_words():
+    gcode = _HEADER + _region(100, is_first=True) + _region(0) + _region(110) + _region(10) + _FOOTER
+    optimised_gcode, result = RapidOptimizer().optimise(gcode)
+
+    assert (result.original_distance, result.optimised_distance) == (315, 95)
+    lines = optimised_gcode[len(_HEADER):].split(b"\r\n")
+    # the region of the first rapid keeps its descent from the retract, the new first region inherits its feed
+    assert lines[:2] == [b"G90 G0 X0. Y0.", b"F600."]
+    assert [line for line in lines if line.startswith(b"G0 X")] == [b"G0 X10. Y0.", b"G0 X100. Y0.", b"G0 X110. Y0."]
+    assert optimised_gcode.count(b"G90 G0") == 1
+    assert optimised_gcode.endswith(_FOOTER)
+
+
+def test_toolpaths_with_other_words_between_the_regions_are_left():
+    for words in (b"M9\r\n", b"G91\r\nG0 Z1.\r\nG90\r\n", b"G18\r\n"):
+        gcode = _HEADER + _region(0, is_first=True) + _region(100) + words + _region(10) + _region(110) + _FOOTER
+        optimised_gcode, result = RapidOptimizer().optimise(gcode)
+        assert optimised_gcode == gcode
+        assert result.saved_distance == 0
+
+
+def test_toolpaths_in_the_shortest_order_are_left(tmp_path: Path):
+    toolpath_file = tmp_path / "planarising.tap"
+    toolpath_file.write_bytes(_HEADER + _region(0, is_first=True) + _FOOTER)
+    assert RapidOptimizer().optimise_file(toolpath_file).region_count == 1
+    toolpath_file.write_bytes(_HEADER + _region(0, is_first=True) + _region(10) + _region(100) + _FOOTER)
+    modified_time = toolpath_file.stat().st_mtime_ns
+
+    assert RapidOptimizer().optimise_file(toolpath_file).saved_distance == 0
+    assert toolpath_file.stat().st_mtime_ns == modified_time
+
+
+def test_find_order():
+    # links are directed: from the exit of each region (rows) or the start (last row) to the entry of each region
+    costs = np.array([[0, 9, 1],
+                      [9, 0, 9],
+                      [9, 1, 0],
+                      [1, 5, 5]], dtype=float)
+
+    assert list(find_order(costs, is_first_fixed=False)) == [0, 2, 1]
+    assert path_cost(costs, np.array([0, 2, 1])) == 3
+    assert list(find_order(costs, is_first_fixed=True)) == [0, 2, 1]
+    assert path_cost(costs, np.array([1, 0, 2])) == 15
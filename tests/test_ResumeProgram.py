@@ -0,0 +1,49 @@
+from pathlib import Path
+import pytest
+from Hybrid762.ResumeProgram import ResumeProgram
+
+
+def _end_of_layer_block(z: float, is_labelled: bool, layer_number: int) -> list[str]:
+    '''The end of layer block of the previous layer, as the ceramic post processor writes it at a layer change'''
+    lines = [";CERAMIC_LAYER_END", ";Dry and Photo", f"M225 #620=30 #622={z}", ";record end of layer data",
+             f"M111 #622={z}"]
+    if is_labelled:
+        lines += [f"IF [[#1005 EQ 0] AND [#1006 EQ 0]] GOTO {layer_number*2}", f"N{layer_number*2 - 1}",
+                  f"N{layer_number*2}"]
+    return lines + [";Purge nozzle", "M64 P20", ";End of layer change block"]
+
+
+def _program(is_labelled: bool) -> str:
+    lines = [";Hybrid", "G90 G58", "G0 Z5"]
+    for layer_number in (1, 2, 3):
+        z = 0.2*layer_number
+        lines.append(f";Layer {layer_number} of 3")
+        if layer_number > 1:
+            lines += _end_of_layer_block(round(z - 0.2, 1), is_labelled, layer_number)
+        lines += [f"G0 X0 Y0 Z{z:g}", "M15", f"G1 X10 A{layer_number}", "M16"]
+    return "\n".join(lines + ["M30"]) + "\n"
+
+
+@pytest.mark.parametrize("is_labelled", [True, False])
+def test_end_of_layer_block_of_previous_layer_is_skipped(tmp_path: Path, is_labelled: bool):
+    program_file = tmp_path / "part.tap"
+    program_file.write_text(_program(is_labelled))
+    output_file = tmp_path / "resume.tap"
+    ResumeProgram(program_file).write(3, output_file)
+
+    lines = output_file.read_text().splitlines()
+    assert lines[:3] == [";Hybrid", "G90 G58", "G0 Z5.4"]  # the header clears the printed height
+    assert lines[3:7] == [";Resuming at layer 3 of 3", "G58 G90", "M16", "G92 A2"]
+    layer_lines = lines[lines.index(";Layer 3 of 3") + 1:]
+    assert not any(line.startswith(("M225", "M111")) for line in layer_lines)
+    resumed_lines = (["N6"] if is_labelled else []) + [";Purge nozzle", "M64 P20"]
+    assert layer_lines[:len(resumed_lines)] == resumed_lines
+    assert layer_lines[-4:] == ["M15", "G1 X10 A3", "M16", "M30"]
+
+
+def test_missing_layer_is_rejected(tmp_path: Path):
+    program_file = tmp_path / "part.tap"
+    program_file.write_text(_program(False))
+
+    with pytest.raises(ValueError):
+        ResumeProgram(program_file).write(4, tmp_path / "resume.tap")
@@ -0,0 +1,38 @@
+from pathlib import Path
+import pytest
+from Hybrid762.SliceSplitter import SliceSplitter
+
+_HEADER = b"%\r\n(Planarising)\r\nG90 G94 G17\r\nG21\r\n"
+_FOOTER = b"M30\r\n%\r\n"
+
+
+def _write_batch(tmp_path: Path, body: bytes) -> Path:
+    batch_file = tmp_path / "batch.tap"
+    batch_file.write_bytes(_HEADER + body + _FOOTER)
+    (tmp_path / "slices").mkdir()
+    return batch_file
+
+
+def test_each_slice_gets_the_header_and_footer(tmp_path: Path):
+    batch_file = _write_batch(tmp_path, b";SLICE_START Planarising at 1.50\r\nG0 X1 Y1\r\n;SLICE_END\r\n"
+                                        b"M5\r\n"  # between the slices, in no file
+                                        b";SLICE_START Skim at 1.50\r\nG0 X2 Y2\r\nG1 Z1\r\n;SLICE_END\r\n")
+    slice_files = SliceSplitter().split(batch_file, tmp_path / "slices")
+
+    assert [path.name for path in slice_files] == ["Planarising at 1.50.tap", "Skim at 1.50.tap"]
+    assert slice_files[0].read_bytes() == _HEADER + b"G0 X1 Y1\r\n" + _FOOTER
+    assert slice_files[1].read_bytes() == _HEADER + b"G0 X2 Y2\r\nG1 Z1\r\n" + _FOOTER
+
+
+def test_batch_without_slices(tmp_path: Path):
+    assert SliceSplitter().split(_write_batch(tmp_path, b"G0 X1 Y1\r\n"), tmp_path / "slices") == []
+
+
+@pytest.mark.parametrize("body", [
+    b";SLICE_START A\r\nG0 X1\r\n;SLICE_START B\r\nG0 X2\r\n;SLICE_END\r\n",
+    b"G0 X1\r\n;SLICE_END\r\n",
+    b";SLICE_START A\r\nG0 X1\r\n",  # the post stopped before the end of the operation
+])
+def test_unpaired_markers(tmp_path: Path, body: bytes):
+    with pytest.raises(ValueError):
+        SliceSplitter().split(_write_batch(tmp_path, body), tmp_path / "slices")
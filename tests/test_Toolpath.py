@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from Hybrid762.Toolpath import Toolpath
+
+_HEADER = b"%\r\n(Planarising at 1.00)\r\nG90 G94 G17 G91.1\r\nG21\r\nG28 G91 Z0.\r\nG90\r\nT1 M6\r\nS5000 M3\r\nG54\r\n"
+_BODY = (b"G0 X10. Y5.\r\nG43 Z15. H1\r\nG0 Z5.\r\nG1 Z1. F300. (plunge)\r\nX20. F600.\r\nG2 X30. Y5. I5. J0.\r\n"
+         b"G0 Z15.\r\n")
+_FOOTER = b"M5\r\nG28 G91 Z0.\r\nG90\r\nM30\r\n%\r\n"
+_GCODE = _HEADER + _BODY + _FOOTER
+
+
+def test_round_trip():
+    toolpath = Toolpath(_GCODE)
+
+    assert (toolpath.header, toolpath.footer) == (_HEADER, _FOOTER)
+    assert toolpath.to_gcode() == _GCODE
+    assert list(toolpath.motion) == [0, -1, 0, 1, -1, 2, 0]
+    assert np.array_equal(toolpath.x, [10, np.nan, np.nan, np.nan, 20, 30, np.nan], equal_nan=True)
+    assert np.array_equal(toolpath.feed, [np.nan, np.nan, np.nan, 300, 600, np.nan, np.nan], equal_nan=True)
+    assert np.array_equal(toolpath.arc_centres[:, 5], [5, 0, np.nan], equal_nan=True)
+    minimum, maximum = toolpath.bounding_box()
+    assert list(minimum) == [10, 5, 1] and list(maximum) == [30, 5, 15]
+
+
+def test_only_changed_lines_are_formatted():
+    toolpath = Toolpath(_GCODE)
+    toolpath.x[4] = 12.25
+    toolpath.z[3] = np.nan
+    toolpath.feed[3] = 250
+
+    assert toolpath.to_gcode() == _GCODE.replace(b"G1 Z1. F300. (plunge)", b"G1 F250. (plunge)").replace(
+        b"X20. F600.", b"X12.25 F600.")
+    toolpath.y[1] = 3
+    with pytest.raises(ValueError):
+        toolpath.to_gcode()  # G43 Z15. H1 has no Y word
+
+
+def test_incremental_and_machine_coordinates_are_not_positions():
+    toolpath = Toolpath(_HEADER + b"G0 X1 Y1\r\nG91 G0 Z2\r\nG90\r\nG53 Z0\r\nG1 X2 Z-1\r\n" + _FOOTER)
+
+    assert np.array_equal(toolpath.z, [np.nan, np.nan, np.nan, np.nan, -1], equal_nan=True)
+    assert toolpath.to_gcode() == _HEADER + b"G0 X1 Y1\r\nG91 G0 Z2\r\nG90\r\nG53 Z0\r\nG1 X2 Z-1\r\n" + _FOOTER
+
+
+def test_digest_ignores_comments():
+    assert Toolpath(_GCODE).digest() == Toolpath(_GCODE.replace(b"(plunge)", b"(entry)")).digest()
+    assert Toolpath(_GCODE).digest() != Toolpath(_GCODE.replace(b"X20.", b"X21.")).digest()
@@ -0,0 +1,48 @@
+from Hybrid762.TravelOptimizer import TravelOptimizer, TravelStatistics
+
+
+def _island(x: float, a: float) -> list[bytes]:
+    '''An island as the ceramic post processor writes it, with the comments Fusion passes to onComment'''
+    return [b";rapid-dry\n",
+            f"G0 X{x} Y0 F6000\n".encode(),
+            b";shell\n",
+            b"M15\n",
+            f"G1 X{x + 5} Y0 F600 A{a + 0.5}\n".encode(),
+            f"G1 X{x + 5} Y5 A{a + 1}\n".encode(),
+            b"M16\n"]
+
+
+def _layer(xs: list[float]) -> list[bytes]:
+    lines = [b";Layer 2 of 3\n", b"G92 A0\n", b"G0 Z0.6 F6000\n"]
+    for index, x in enumerate(xs):
+        lines += _island(x, index)
+    return lines + [b";CERAMIC_LAYER_END\n", b"M400\n"]
+
+
+def test_islands_with_feature_comments_are_reordered():
+    statistics = TravelStatistics()
+    lines = TravelOptimizer().optimise_layer(_layer([0, 100, 10, 110, 20]), statistics)
+
+    assert statistics.reordered_layer_count == 1
+    assert statistics.island_count == 5
+    assert statistics.optimised_distance < statistics.original_distance
+    # the moves of an island may be joined in one item, when its extrusion is offset
+    lines = b"".join(lines).splitlines(keepends=True)
+    travels = [line for line in lines if line.startswith(b"G0 X")]
+    assert travels == [b"G0 X0 Y0 Z0.6 F6000\n", b"G0 X10 Y0 Z0.6 F6000\n", b"G0 X20 Y0 Z0.6 F6000\n",
+                       b"G0 X100 Y0 Z0.6 F6000\n", b"G0 X110 Y0 Z0.6 F6000\n"]
+    # each island keeps its comments, and the layer ends on the same extrusion
+    assert lines.count(b";rapid-dry\n") == 5 and lines.count(b";shell\n") == 5
+    assert lines[lines.index(b"G0 X10 Y0 Z0.6 F6000\n") - 1] == b";rapid-dry\n"
+    assert [line for line in lines if b" A" in line][-1] == b"G1 X115 Y5 A5\n"
+    assert lines[-2:] == [b";CERAMIC_LAYER_END\n", b"M400\n"]
+
+
+def test_markers_end_the_runs():
+    layer = _layer([0, 100, 10, 110, 20])
+    for island in range(4, 0, -1):
+        layer.insert(3 + 7*island, b";PLACEHOLDER_OVEREXTRUSION_REMOVAL at Z 0.60\n")
+    statistics = TravelStatistics()
+
+    assert TravelOptimizer().optimise_layer(layer, statistics) == layer
+    assert statistics.reordered_layer_count == 0
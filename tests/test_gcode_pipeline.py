@@ -0,0 +1,58 @@
+import math
+from pathlib import Path
+import sys
+import pytest
+from Hybrid762 import gcode_pipeline
+from Hybrid762.gcode_pipeline import TransformPipeline, read_chunks
+from Hybrid762.gcode_transforms import ArcFitter, Minifier
+
+
+def _program(layer_count: int) -> str:
+    '''Additive layers with a quarter circle milled after each one'''
+    quarter_circle = [f"G1 X{10 * math.cos(math.radians(angle)):.4f} Y{10 * math.sin(math.radians(angle)):.4f}"
+                      for angle in range(2, 91, 2)]
+    quarter_circle[0] += " F500"
+    lines = ["%", "G90"]
+    for layer_number in range(1, layer_count + 1):
+        lines += [f";Layer {layer_number} of {layer_count}", f"G0 X0 Y0 Z{layer_number * 0.5}", "M15"]
+        lines += [f"G1 X{x} Y{x % 7} F600 A{layer_number + x / 100}" for x in range(20)]
+        lines += ["M16", f";MILLING_INSERT_START LAYER_REMOVAL at Z {layer_number * 0.5:.2f}", "G90 G17",
+                  f"G0 X10 Y0 Z{layer_number * 0.5}", *quarter_circle, "G0 Z20", ";MILLING_INSERT_END"]
+    return "\n".join(lines + ["M30", "%"]) + "\n"
+
+
+def test_chunks_end_before_a_layer_comment():
+    lines = _program(5).splitlines(keepends=True)
+    chunks = list(read_chunks(lines, chunk_lines=100))
+
+    assert sum(chunks, []) == lines
+    assert all(len(chunk) >= 100 for chunk in chunks[:-1])
+    assert all(chunk[0].startswith(";Layer") for chunk in chunks[1:])
+    assert [len(chunk) for chunk in chunks] == [150, 148, 76]  # 74 lines per layer
+    assert list(read_chunks(lines, chunk_lines=1000)) == [lines]
+
+
+def test_sequential_and_parallel_runs_are_equal(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    source = tmp_path / "combined.tap"
+    source.write_text(_program(40), newline='\r\n')
+    transforms = [ArcFitter(), Minifier()]
+    sequential_output = tmp_path / "sequential.tap"
+    progress: list[float] = []
+    TransformPipeline(transforms, max_workers=1, chunk_lines=100).run(source, sequential_output, progress.append)
+
+    # the workers import the transforms from the add-in package, not the add-in module in the add-in folder
+    add_in_folder = Path(__file__).resolve().parents[1]
+    package_folder = tmp_path / "packages"
+    package_folder.mkdir()
+    (package_folder / "Hybrid762").symlink_to(add_in_folder, target_is_directory=True)
+    monkeypatch.setattr(sys, "path", [str(package_folder)] + [path for path in sys.path
+                                                              if Path(path or ".").resolve() != add_in_folder])
+    monkeypatch.setattr(gcode_pipeline, "MIN_PARALLEL_FILE_SIZE", 0)
+    parallel_output = tmp_path / "parallel.tap"
+    TransformPipeline(transforms, max_workers=2, chunk_lines=100).run(source, parallel_output)
+
+    assert parallel_output.read_bytes() == sequential_output.read_bytes()
+    sequential_text = sequential_output.read_bytes().decode()
+    assert "\r\n" in sequential_text and "\n" not in sequential_text.replace("\r\n", "")
+    assert sequential_text.count("G3 X0 Y10 I-10 J0 F500") == 40
+    assert progress == sorted(progress) and progress[-1] == 1.0
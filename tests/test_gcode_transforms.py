@@ -0,0 +1,91 @@
+import math
+import pytest
+from Hybrid762.gcode_transforms import ArcFitter, Minifier, trim_number
+
+
+def _minify(gcode: str) -> list[str]:
+    return list(Minifier()(gcode.splitlines(keepends=True)))
+
+
+def test_minifier_removes_repeated_words_and_comments():
+    assert _minify("%\nG90 G1 X1.500 Y2.0 F600.0 ; comment\nG01 X1.5 Y3 F600\n\nG1 X2 Y3\nG1 X2 Y3\n(comment)\n") == [
+        "%\n", "G90 G1 X1.5 Y2 F600\n", "Y3\n", "X2\n"]
+
+
+def test_minifier_keeps_structural_comments():
+    gcode = ";Layer 2 of 3\n;MILLING_INSERT_START LAYER_REMOVAL at Z 1.00\n(MSG, hello)\n;PLACEHOLDER_FINISHING at Z2\n"
+    assert _minify(gcode) == gcode.splitlines(keepends=True)
+
+
+@pytest.mark.parametrize("line", ["M15\n", "T1 M6\n", "N10\n", "IF [#1006 EQ 0] GOTO 7\n", "G28 G91 Z0\n"])
+def test_minifier_forgets_the_modal_state(line: str):
+    # the machine may arrive from elsewhere or move, so the next move is written in full
+    assert _minify(f"G90 G1 X2 Y3 F600\n{line}G1 X2 Y3 F600\n")[-1] == "G1 X2 Y3 F600\n"
+
+
+def test_minifier_forgets_the_position_in_machine_coordinates():
+    assert _minify("G90 G1 Z5\nG53 Z0\nG1 Z5\n") == ["G90 G1 Z5\n", "G53 Z0\n", "Z5\n"]
+    # the distance mode set with a return to the reference position still applies
+    assert _minify("G90 G1 X2\nG28 G91 Z0\nG90 G1 X5\n") == ["G90 G1 X2\n", "G28 G91 Z0\n", "G90 G1 X5\n"]
+
+
+def test_minifier_keeps_incremental_moves():
+    assert _minify("G91 G1 X1\nX1\nG90 G0 X+0.0\nX0\n") == ["G91 G1 X1\n", "X1\n", "G90 G0 X0\n"]
+
+
+def test_minifier_keeps_line_endings():
+    assert _minify("G90 G1 X1.0\r\nG1 X2 ;end\r\n") == ["G90 G1 X1\r\n", "X2\r\n"]
+
+
+@pytest.mark.parametrize("value, expected", [("1.500", "1.5"), ("+2.", "2"), ("-0.0", "0"), ("10", "10"), (".50", ".5")])
+def test_trim_number(value: str, expected: str):
+    assert trim_number(value) == expected
+
+
+def _circle_points(end_angle: int, step: int = 2, radius: float = 10) -> list[tuple[float, float]]:
+    '''Points on a circle around the origin from 0 degrees, every step degrees, negative angles for clockwise'''
+    return [(round(radius * math.cos(math.radians(angle)), 4), round(radius * math.sin(math.radians(angle)), 4))
+            for angle in range(0, end_angle + (step if end_angle > 0 else -step), step if end_angle > 0 else -step)]
+
+
+def _milling_insert(setup: str, points: list[tuple[float, float]], before_moves: tuple[str, ...] = ()) -> list[str]:
+    moves = [f"G1 X{x:.4f} Y{y:.4f}" + (" F500" if i == 0 else "") + "\n" for i, (x, y) in enumerate(points[1:])]
+    return [";MILLING_INSERT_START LAYER_REMOVAL at Z 1.00\n", setup, f"G0 X{points[0][0]} Y{points[0][1]} Z1\n",
+            *before_moves, *moves, "G0 Z5\n", ";MILLING_INSERT_END\n"]
+
+
+@pytest.mark.parametrize("end_angle, expected_arc", [(90, "G3 X0. Y10. I-10. J0. F500\n"),
+                                                     (-90, "G2 X0. Y-10. I-10. J0. F500\n")])
+def test_arc_fitter_replaces_moves_on_a_circle(end_angle: int, expected_arc: str):
+    lines = _milling_insert("G90 G17\n", _circle_points(end_angle))
+
+    assert list(ArcFitter()(lines)) == lines[:3] + [expected_arc, "G1\n"] + lines[-2:]
+
+
+def test_arc_fitter_only_fits_arcs_under_half_a_circle():
+    points = _circle_points(360)
+    assert ArcFitter()._fit_arc(points[:86]) is not None  # 170 degrees
+    assert ArcFitter()._fit_arc(points[:101]) is None  # 200 degrees
+
+    arcs = [line.split() for line in ArcFitter()(_milling_insert("G90 G17\n", points)) if line.startswith("G3")]
+    assert len(arcs) > 1
+    assert arcs[-1][1:3] == ["X10.", "Y0."]
+
+
+@pytest.mark.parametrize("setup, before_moves", [
+    ("G90 G18\n", ()),
+    ("G90 G17\n", ("G91\n",)),  # from a known start position
+    ("G17\n", ()),
+    ("G90 G17\n", ("G19\n",)),
+])
+def test_arc_fitter_needs_absolute_moves_in_the_xy_plane(setup: str, before_moves: tuple[str, ...]):
+    lines = _milling_insert(setup, _circle_points(90), before_moves)
+    assert list(ArcFitter()(lines)) == lines
+
+
+def test_arc_fitter_leaves_additive_moves():
+    lines = _milling_insert("G90 G17\n", _circle_points(90))
+    additive_lines = lines[1:-1]
+    assert list(ArcFitter()(additive_lines)) == additive_lines
+    extrusion_lines = [line.replace("\n", " A1\n") if line.startswith("G1") else line for line in lines]
+    assert list(ArcFitter()(extrusion_lines)) == extrusion_lines